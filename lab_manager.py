@@ -5,13 +5,14 @@ import shutil
 import subprocess
 from json import load
 from pathlib import Path
-from xml.etree.ElementTree import ParseError
 
 import PySimpleGUI as sg
 
-from t9a.pdf import get_version_from_PDF, match_titles, export_titles_to_json
-from t9a.sla import SLAFile
-from t9a import T9A_ICON
+from t9a.pdf import get_version_from_PDF, find_title_mismatch_async, export_titles_to_json
+from t9a.sla import SLAFile, METADATA_SECTIONS
+from t9a.etree import ParseError
+from t9a.worker import ensure_worker, stop_worker
+from t9a import T9A_ICON, EXPECTED_FRAMES
 
 
 SETTINGS_FILE = Path(__file__).parent / "lab_manager/t9a_lab_manager_settings.json"
@@ -21,7 +22,21 @@ CURRENT_LABS = ["ID", "WDG", "DL", "UD", "SE"]
 
 
 async def compare_rules(pdf1, pdf2):
-    return await asyncio.run(match_titles(pdf1, pdf2))
+    """Returns the first pair of titles that differ between two rules PDFs, or None if they match"""
+    return await find_title_mismatch_async(pdf1, pdf2)
+
+
+def describe_title(title):
+    return f"'{title.title}' (page {title.page})" if title else "nothing"
+
+
+def run_compare_rules(pdf1, pdf2):
+    """Runs compare_rules() to completion. Used as a long operation by the GUI, so errors are returned rather than raised."""
+    try:
+        return asyncio.run(compare_rules(pdf1, pdf2))
+    except Exception as err:
+        logging.exception(f"Couldn't compare {pdf1} and {pdf2}")
+        return err
 
 # TODO: Check number of rules frames against PDF page count to see if manual changes needed
 
@@ -107,7 +122,7 @@ def main():  # sourcery skip: use-fstring-for-concatenation
     tools_column = [
         [sg.Frame("Scribus File", [
             [sg.In(size=50, key='-FILE-', enable_events=True),
-             sg.FileBrowse(target='-FILE-', file_types=(("SLA Files", "*.sla"),)),],
+             sg.FileBrowse(target='-FILE-', file_types=(("SLA Files", "*.sla *.sla.gz"),)),],
             [sg.Button("Open in Scribus", key="-OPEN-SCRIBUS-", disabled=True, size=13),
              sg.Button("Check",key="-CHECK-SLA-",disabled=True)]])],
         [sg.Frame("Embedded Rules", [
@@ -141,6 +156,7 @@ def main():  # sourcery skip: use-fstring-for-concatenation
     window = sg.Window("T9A LAB Details", layout, resizable=True, icon=T9A_ICON, titlebar_icon=T9A_ICON)
     filename = None
     new_pdf = None
+    export_worker = None # Scribus export worker started for the exports, kept until the LAB Manager closes
 
     def add_edit_file(entry=None):
 
@@ -152,7 +168,7 @@ def main():  # sourcery skip: use-fstring-for-concatenation
             [
                 sg.Text("Filename", size=10),
                 sg.In(size=(60, 1), key="-NEW-FILE-"),
-                sg.FileBrowse(file_types=(("SLA Files", "*.sla"),))
+                sg.FileBrowse(file_types=(("SLA Files", "*.sla *.sla.gz"),))
             ],
             [sg.Button('OK', key="-SUBMIT-")]
         ]
@@ -170,6 +186,7 @@ def main():  # sourcery skip: use-fstring-for-concatenation
             return result
 
     def export_menu():
+        nonlocal export_worker
         quality_options = [
             [sg.Checkbox("High", default=True, key="-o-high-")],
             [sg.Checkbox("Low", default=True, key="-o-low-")],
@@ -190,6 +207,7 @@ def main():  # sourcery skip: use-fstring-for-concatenation
                 sg.Frame("Options", [
                     [sg.Checkbox("Do not export (PDFs already created)", default=False, key="-o-noexport-")],
                     [sg.Checkbox("Do not post-process (bookmarks, renaming, moving)", default=False, key="-o-noprocess-")],
+                    [sg.Checkbox("Keep Scribus open between exports", default=False, key="-o-worker-")],
                 ]),
             ],
             [sg.Text("Destination folder:")],
@@ -246,11 +264,20 @@ def main():  # sourcery skip: use-fstring-for-concatenation
 
                     # TODO: preflight selected files
                     for file in selected_files:
-                        lab = SLAFile(file)
+                        lab = SLAFile(file, sections=METADATA_SECTIONS, keep_text=EXPECTED_FRAMES, cache=True)
                         if "nopoints" in formats and not lab.check_nopoints():
                             sg.popup_ok(f"Couldn't find nopoints version of the rules for file: {file}. Please make sure _nopoints PDF is in the images folder.")
                             return
 
+                    if values["-o-worker-"] and not values["-o-noexport-"]:
+                        # keep one Scribus open for t9a_generate_labs.py to export with, so later exports don't wait for it to start
+                        try:
+                            if process := ensure_worker(0):
+                                export_worker = process
+                        except OSError as err:
+                            sg.popup_ok(str(err))
+                            return
+
                     logging.info(selected_files)
                     logging.info(qualities)
                     logging.info(formats)
@@ -263,6 +290,8 @@ def main():  # sourcery skip: use-fstring-for-concatenation
                         flags.append("--noexport")
                     if values["-o-noprocess-"]:
                         flags.append("--noprocess")
+                    if values["-o-worker-"]:
+                        flags.append("--worker")
                     if values["-OUT-DIR-"]:
                         dest = f"--dest {values['-OUT-DIR-']}"
                     else:
@@ -286,7 +315,7 @@ def main():  # sourcery skip: use-fstring-for-concatenation
 
     def load_file(filename):
         try:
-            lab = SLAFile(filename)
+            lab = SLAFile(filename, sections=METADATA_SECTIONS, keep_text=EXPECTED_FRAMES, cache=True)
             window["-FILE-"].update(filename)
             window["-OPEN-SCRIBUS-"].update(disabled=False)
             window["-OPEN-OLD-RULES-"].update(disabled=False)
@@ -354,26 +383,28 @@ def main():  # sourcery skip: use-fstring-for-concatenation
                     window['-RESULT-'].update("No file selected")
                     continue
                 window['-RESULT-'].update("Matching...")
+                window["-COMPARE-"].update(disabled=True)
+                # parse both PDFs in the background so the window stays responsive
+                window.perform_long_operation(lambda: run_compare_rules(rules_pdf, new_pdf), "-COMPARE-DONE-")
 
-                try:
-                    # TODO: parrallelise
-                    match = match_titles(rules_pdf, new_pdf)
-                    if match:
-                        window['-RESULT-'].update(
-                            'Titles match!',
-                            text_color="white",
-                            background_color="green",
-                        )
-
-                    else:
-                        window['-RESULT-'].update(
-                            'Titles do not match!',
-                            text_color="white",
-                            background_color="red",
-                        )
-
-                except:
+            case "-COMPARE-DONE-":
+                window["-COMPARE-"].update(disabled=False)
+                mismatch = values[event]
+                if isinstance(mismatch, Exception):
                     window['-RESULT-'].update('ERROR')
+                elif mismatch is None:
+                    window['-RESULT-'].update(
+                        'Titles match!',
+                        text_color="white",
+                        background_color="green",
+                    )
+                else:
+                    old_title, new_title = mismatch
+                    window['-RESULT-'].update(
+                        f'Titles do not match! {describe_title(old_title)} became {describe_title(new_title)}',
+                        text_color="white",
+                        background_color="red",
+                    )
 
             case "-REPLACE-":
                 # nopoints = os.path.splitext(new_pdf)[0] + '_nopoints.pdf'
@@ -383,11 +414,13 @@ def main():  # sourcery skip: use-fstring-for-concatenation
                 if nopoints.is_file():
                     logging.debug(f"Copying to: {new_pdf.parent / 'images'}")
                     copy_file(nopoints, new_pdf.parent)
-                lab.replace_pdf(new_pdf)
+                lab = SLAFile(filename) # full load, as lab was loaded read-only
+                new_version = window["-NEW-VERSION-"].get()
+                with lab.edit(): # write the file once for both changes
+                    lab.replace_pdf(new_pdf)
+                    lab.set_version(new_version)
                 rules_pdf = lab.get_embedded_rules()
                 window["-RULES-"].update(rules_pdf)
-                new_version = window["-NEW-VERSION-"].get()
-                lab.set_version(new_version)
 
             case "-OPEN-OLD-RULES-":
                 subprocess.Popen(window['-RULES-'].get(), shell=True)
@@ -443,6 +476,8 @@ def main():  # sourcery skip: use-fstring-for-concatenation
                     sg.popup_ok("All expected frames and styles are present.")
 
     window.close()
+    if export_worker:
+        stop_worker(0, export_worker)
 
 if __name__ == "__main__":
     main() 
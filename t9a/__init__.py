@@ -16,6 +16,18 @@ FOOTER_R = "FOOTER Right"
 
 EXPECTED_STYLES = [TOC1, TOC2, TOC_RULES, HEADER1, HEADER2, HEADER_RULES, FOOTER_L, FOOTER_R,]
 
+# {style: (group, level)} for parsing all headings in one pass with SLAFile.parse_header_groups()
+HEADER_GROUPS = {
+    HEADER1: ("background", 1),
+    HEADER2: ("background", 2),
+    HEADER_RULES: ("rules", 1),
+}
+
+# Fonts of chapter titles in the rules PDFs, as "font name,size" regexes (see t9a.pdf.get_titles())
+FONT_MAPPING = {
+    r"\w{6}\+Caladea-(Bold|Regular),2\d*": "chapter_title",
+}
+
 ######################
 ### base64-encoded ###
 ######################
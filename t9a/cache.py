@@ -0,0 +1,138 @@
+"""Contains a JSON sidecar cache for values that are expensive to compute from large files (e.g. parsing a .sla or the titles of a rules PDF)"""
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from t9a.records import Title
+
+CACHE_SUFFIX = ".cache.json"
+CACHE_VERSION = 2 # bump when the format of cached values changes
+
+
+def file_hash(filename, chunk_size=1024*1024):
+    """Returns the SHA-256 hex digest of a file's contents"""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class FileCache:
+    """Values computed from a source file, stored in a JSON file next to it.
+
+    The cache is keyed by the source's size and modification time. If those change but the
+    content hash is the same (e.g. the file was copied or touched) the cached values are kept,
+    otherwise they are discarded.
+    """
+
+    def __init__(self, source, cache_file=None):
+        self.source = Path(source)
+        self.cache_file = Path(cache_file) if cache_file else self.source.with_name(self.source.name + CACHE_SUFFIX)
+        self.key = {}
+        self.data = {}
+        self.batch_depth = 0
+        self.load()
+
+    def source_stat(self):
+        stat = self.source.stat()
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def load(self):
+        key = self.source_stat()
+        try:
+            with open(self.cache_file) as json_file:
+                cached = json.load(json_file)
+        except (OSError, ValueError):
+            cached = {}
+        cached_key = cached.get("key", {})
+        if cached.get("version") != CACHE_VERSION or cached_key.get("size") != key["size"]:
+            self.reset(key)
+        elif cached_key.get("mtime") == key["mtime"]:
+            self.key = cached_key
+            self.data = cached.get("data", {})
+        elif cached_key.get("sha256") == (sha256 := file_hash(self.source)):
+            logging.debug(f"{self.source} has a new modification time but the same content")
+            self.key = key | {"sha256": sha256}
+            self.data = cached.get("data", {})
+            self.save()
+        else:
+            self.reset(key | {"sha256": sha256})
+
+    def reset(self, key=None):
+        """Discards all cached values, e.g. after the source file has been rewritten"""
+        key = key or self.source_stat()
+        if "sha256" not in key:
+            key["sha256"] = file_hash(self.source)
+        self.key = key
+        self.data = {}
+
+    def get(self, section, name, default=None):
+        """Returns the cached value, or default if there isn't one"""
+        return self.data.get(section, {}).get(name, default)
+
+    def set(self, section, name, value):
+        """Stores a value and writes the cache file (at the end of a batch() block if in one). Returns the value for convenience."""
+        self.data.setdefault(section, {})[name] = value
+        if not self.batch_depth:
+            self.save()
+        return value
+
+    @contextmanager
+    def batch(self):
+        """Writes the cache file once at the end of the block, rather than for each value set in it"""
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.save()
+
+    def save(self):
+        temp_file = self.cache_file.with_name(self.cache_file.name + ".temp")
+        try:
+            with open(temp_file, "w") as json_file:
+                json.dump({"version": CACHE_VERSION, "key": self.key, "data": self.data}, json_file)
+            os.replace(temp_file, self.cache_file)
+        except OSError as err:
+            logging.warning(f"Couldn't write cache file {self.cache_file}: {err}")
+
+
+def titles_key(font_mapping, backend):
+    return json.dumps({"fonts": font_mapping, "backend": backend}, sort_keys=True)
+
+
+def get_cached_titles(pdf_file, font_mapping, details=False, backend=None):
+    """Returns the chapter titles cached for a rules PDF, or None if the PDF hasn't been parsed with this font mapping and backend since it last changed.
+    Doesn't need any PDF libraries, so can be used from within Scribus.
+
+    Args:
+        pdf_file (string): Full path to PDF
+        font_mapping (dict): Font mapping the titles were found with, see t9a.FONT_MAPPING
+        details (bool, optional): Include the order and y-position of each title. Defaults to False.
+        backend (string, optional): Title backend and library versions the titles were found with, see t9a.pdf.title_backend_id().
+            Defaults to None, which accepts titles found by any backend (for when the PDF libraries aren't available).
+
+    Returns:
+        [Title]: Cached titles or None
+    """
+    if not Path(pdf_file).is_file():
+        return None
+    cached = FileCache(pdf_file).data.get("titles", {})
+    if backend is not None:
+        titles = cached.get(titles_key(font_mapping, backend))
+    else:
+        titles = next((titles for key, titles in cached.items() if json.loads(key).get("fonts") == font_mapping), None)
+    if titles is None:
+        return None
+    titles = [Title(*title) for title in titles] # stored as lists
+    return titles if details else [Title(title.title, title.page) for title in titles]
+
+
+def set_cached_titles(pdf_file, font_mapping, backend, titles):
+    """Stores the chapter titles of a rules PDF found with backend. titles should include details so they can be used for any request."""
+    FileCache(pdf_file).set("titles", titles_key(font_mapping, backend), titles)
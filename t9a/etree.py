@@ -0,0 +1,40 @@
+"""Selects the XML library used for .sla files: lxml if it is installed, otherwise the standard library's ElementTree.
+
+Set the environment variable T9A_XML_BACKEND to "stdlib" to force ElementTree (e.g. for comparing the two).
+"""
+import os
+
+BACKEND = "stdlib"
+
+if os.environ.get("T9A_XML_BACKEND", "lxml") == "lxml":
+    try:
+        from lxml import etree as ET
+        BACKEND = "lxml"
+    except ImportError:
+        pass
+
+if BACKEND == "lxml":
+    ParseError = ET.XMLSyntaxError
+    # army books can have attributes (e.g. inline images) larger than lxml's default safety limits
+    PARSER_OPTIONS = {"huge_tree": True}
+else:
+    import xml.etree.ElementTree as ET
+    ParseError = ET.ParseError
+    PARSER_OPTIONS = {}
+
+
+def parse(source):
+    """Parses a whole document and returns an ElementTree"""
+    if BACKEND == "lxml":
+        return ET.parse(source, ET.XMLParser(**PARSER_OPTIONS))
+    return ET.parse(source)
+
+
+def iterparse(source, events=("end",)):
+    """Returns an iterator of (event, element) pairs while the document is being parsed"""
+    return ET.iterparse(source, events=events, **PARSER_OPTIONS)
+
+
+def is_element(node):
+    """False for comments and processing instructions, which lxml includes when iterating over a tree"""
+    return isinstance(node.tag, str)
@@ -13,6 +13,8 @@ except ImportError as err:
 
 import argparse
 import datetime
+import json
+import logging
 import os
 import re
 import shutil
@@ -20,15 +22,16 @@ import sys
 from pathlib import Path
 
 from t9a import EXPECTED_FRAMES
-from t9a.scribus import test_frames, ScribusLAB
 
 QUALITY_TYPES = ["high","low","print"]
-FORMAT_TYPES = ["full","nopoints","norules"]
+FORMAT_TYPES = ["full","nopoints","nopoints_patch","norules","norules_patch"]
+
+CONTENTS_PAGE = 7
 
 QUALITY_HIGH = {
     "quality":1, # 0:Max, 1:High, 2:Medium, 3:Low, 4:Minimum,
     "fontEmbedding":0,
-    "version":15,
+    "version":14,
     "embedPDF":True,
     "downsample":300,
     "resolution":300,
@@ -43,7 +46,7 @@ QUALITY_HIGH = {
 QUALITY_LOW = {
     "quality":3, # 0= Max, 1 = High, 2 = Medium, 3 = Low, 4 = Minimum,
     "fontEmbedding":0,
-    "version":15,
+    "version":14,
     "embedPDF":True,
     "downsample":100,
     "resolution":100,
@@ -58,7 +61,7 @@ QUALITY_LOW = {
 QUALITY_PRINT = {
     "quality":0, # Max,
     "fontEmbedding":0,
-    "version":13,
+    "version":14,
     "embedPDF":True,
     "downsample":300,
     "resolution":300,
@@ -66,28 +69,38 @@ QUALITY_PRINT = {
     "compressmtd":0, # Automatic compression,
     "outdst":1, # print,
     "useDocBleeds":True,
-    "cropMarks":False
+    "cropMarks":True
 }
 
 
 # globals
 quit = False
-num_files = 0
-progress_step = 0
 interactive = True
 no_export = False
 
 
-def create_norules(page_range):
+def split_sla_suffix(filename):
+    """Splits a document name into its base and extension, treating compressed .sla.gz files as one extension"""
+    if filename.lower().endswith('.sla.gz'):
+        return filename[:-7], filename[-7:]
+    return os.path.splitext(filename)
+
+
+def get_rules_pages():
+    rules_start = scribus.getAllText("rules_start")
+    rules_end = scribus.getAllText("rules_end")
+    return (int(rules_start),int(rules_end))
+
+
+def create_norules():
     """Removes rules pages from the LAB and adjust ToC etc.
     """
     try:
         scribus.selectObject("rules_links")
-    except: 
-        scribus.messageBox("Missing group 'rules_links'", str(err), scribus.ICON_CRITICAL)
-        sys.exit(1)
+    except scribus.NoValidObjectError as err:
+        raise scribus.NoValidObjectError("Missing group 'rules_links'") from err
 
-    # page_range = get_rules_pages()
+    page_range = get_rules_pages()
 
     scribus.deselectAll()
    
@@ -95,7 +108,8 @@ def create_norules(page_range):
     now = datetime.datetime.now()
     timestamp = now.strftime('%Y-%m-%dT%H-%M-%S')
     filename = scribus.getDocName()
-    backup_filename = os.path.splitext(filename)[0]+'_backup_'+timestamp+'.sla'
+    base, suffix = split_sla_suffix(filename)
+    backup_filename = base+'_backup_'+timestamp+suffix
     shutil.copy(filename,backup_filename) # don't use scribus built-in savceDocAs(), otherwise it will switch focus to the new file, which we don't want.
 
     # set version string
@@ -149,13 +163,46 @@ def create_norules(page_range):
     
     # save _norules version of file
     
-    new_filename = os.path.splitext(filename)[0].replace('_nopoints', '')+'_norules.sla'
+    new_filename = base.replace('_nopoints', '')+'_norules'+suffix
     scribus.saveDocAs(new_filename)
     # shutil.copy(filename,backup_filename)
 
-def export_pdf(filename,quality):
+def get_object_page(name):
+    """Returns the number of the page that an item is on"""
+    for page in range(1, scribus.pageCount()+1):
+        scribus.gotoPage(page)
+        if name in [item[0] for item in scribus.getPageItems()]:
+            return page
+
+
+def get_norules_patch_pages(rules_start):
+    """Returns the pages of the norules document that look different to the full document once the rules have been
+    removed: the page with the version name, the contents page and the pages after the rules (page numbers)"""
+    pages = {get_object_page("version_name"), CONTENTS_PAGE}
+    pages.update(range(rules_start, scribus.pageCount()+1))
+    return sorted(page for page in pages if page)
+
+
+def replace_with_nopoints():
+    """Replaces the embedded rules PDF with its '_nopoints' version"""
+    page_range = get_rules_pages()
+    for i in range(page_range[0],page_range[1]+1):
+        scribus.gotoPage(i)
+        for item in scribus.getPageItems():
+            if item[1] == 2: # if an image frame
+                file = scribus.getImageFile(item[0])
+                if file[-4:] == ".pdf":
+                    new_file = os.path.splitext(file)[0]+'_nopoints.pdf'
+                    if not Path(new_file).is_file():
+                        raise FileNotFoundError(f"Couldn't find file {new_file}")
+                    scribus.loadImage(new_file,item[0])
+
+
+def export_pdf(filename,quality,pages=None):
     pdf = scribus.PDFfile()
     pdf.file = filename
+    if pages:
+        pdf.pages = pages
     if quality == "high":
         preset = QUALITY_HIGH
     elif quality == "low":
@@ -164,8 +211,9 @@ def export_pdf(filename,quality):
         preset = QUALITY_PRINT
     for p in preset.items():
         setattr(pdf,p[0],p[1])
+    logging.info(f"Exporting {filename}")
     pdf.save()
-            
+
 
 def verify_quality(quality):
     if quality in QUALITY_TYPES:
@@ -201,20 +249,26 @@ def set_filename(filename,format,quality,version=""):
     #     new_filename = f"{os.path.split(filename)[0]}/t9a-fb_lab_{quality}_{army}_{format}_{lang}.pdf" # no version string needed for background book
     # else:
     #     new_filename = f"{os.path.split(filename)[0]}/t9a-fb_lab_{quality}_{army}_{format}_{version}_{lang}.pdf"
-    return f'{os.path.splitext(filename)[0]}_{format}_{quality}.pdf'
+    return f'{split_sla_suffix(filename)[0]}_{format}_{quality}.pdf'
 
 def prepare_format(format):
     pass
 
-def export_pdfs(formats,qualities):
-    global progress_step
-    global num_files
-    global interactive
-    global no_export
+def export_pdfs(formats,qualities,progress=None):
+    """Exports the open document in each of the formats and qualities. The document is changed (and saved as a _norules
+    file for the norules formats), so it should be closed without saving afterwards.
+
+    Args:
+        formats ([string]): Formats from FORMAT_TYPES
+        qualities ([string]): Qualities from QUALITY_TYPES
+        progress (function, optional): Called as progress(step, total, output_file) after each PDF is exported
 
-    lab = ScribusLAB
+    Returns:
+        [string]: The exported PDFs
+    """
     filename = scribus.getDocName()
     version_number = scribus.getAllText("version_number")
+    outputs = []
 
     # set version name from variables
     version = scribus.getAllText("edition") + ', ' + scribus.getAllText("full_title") + ' ' + scribus.getAllText("version_number")
@@ -226,39 +280,59 @@ def export_pdfs(formats,qualities):
     num_files = len(formats)*len(qualities)
     scribus.progressTotal(num_files)
 
-    def export_format(format, qualities):
-        global progress_step
-        global num_files
+    def export_format(format, qualities, pages=None):
         for o in qualities:
             output_file = set_filename(filename,format,o,version_number)
-            progress_step += 1
-            scribus.statusMessage("Exporting %i of %i: %s" % (progress_step, num_files, output_file))
-            export_pdf(output_file,o)
-            scribus.progressSet(progress_step)
+            scribus.statusMessage("Exporting %i of %i: %s" % (len(outputs)+1, num_files, output_file))
+            export_pdf(output_file,o,pages)
+            outputs.append(output_file)
+            scribus.progressSet(len(outputs))
+            if progress:
+                progress(len(outputs), num_files, output_file)
 
     if "full" in formats:
         export_format("full",qualities)
     if "nopoints" in formats:
-        lab.replace_with_nopoints()
+        replace_with_nopoints()
         
         version = scribus.getAllText("edition") + ', ' + scribus.getAllText("nopoints_title") + ' version ' + scribus.getAllText("version_number")
         scribus.setText(version,"version_name")
         scribus.setTextAlignment(scribus.ALIGN_CENTERED, "version_name")
 
         export_format("nopoints",qualities)
+    if "nopoints_patch" in formats:
+        # only the page with the version name, the rest of the nopoints PDF is made from the full PDF, see t9a.pdf.replace_embedded_pages()
+        version = scribus.getAllText("edition") + ', ' + scribus.getAllText("nopoints_title") + ' version ' + scribus.getAllText("version_number")
+        scribus.setText(version,"version_name")
+        scribus.setTextAlignment(scribus.ALIGN_CENTERED, "version_name")
 
-    if "norules" in formats:
+        pages = [get_object_page("version_name")]
+        with open(f'{split_sla_suffix(filename)[0]}_nopoints_patch.json', 'w') as json_file:
+            json.dump({"pages": pages}, json_file)
+        export_format("nopoints_patch",qualities,pages)
+
+    if "norules" in formats or "norules_patch" in formats:
         # remove rules
         scribus.statusMessage("Removing Rules")
+        rules_start = get_rules_pages()[0]
         create_norules()
-        export_format("norules",qualities)
+
+        if "norules" in formats:
+            export_format("norules",qualities)
+        if "norules_patch" in formats:
+            # only the pages needed to make the norules PDF from the full PDF, see t9a.pdf.remove_page_range()
+            pages = get_norules_patch_pages(rules_start)
+            with open(f'{split_sla_suffix(filename)[0]}_norules_patch.json', 'w') as json_file:
+                json.dump({"pages": pages}, json_file)
+            export_format("norules_patch",qualities,pages)
+    return outputs
 
 
 def main(argv):
     global no_export
     global interactive
     if len(argv)==1: # if called from within Scribus or with no arguments
-        new_args = scribus.valueDialog('Set Arguments', 'Set Arguments:\nOptions for --quality: high, low, print\nOptions for --format: full, nopoints, norules', '--quality high low --formats full')
+        new_args = scribus.valueDialog('Set Arguments', 'Set Arguments:\nOptions for --quality: high, low, print\nOptions for --format: full, nopoints, nopoints_patch, norules, norules_patch', '--quality high low --formats full')
         if new_args == '':
             scribus.messageBox("Script Cancelled","Script was cancelled or no arguments were provided")
             return
@@ -271,7 +345,7 @@ def main(argv):
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--quality', nargs='+', help='Which quality types do you want? Available: "high", "low" (RGB) and "print" (CMYK). Defaults to "high".', default="high")
-    parser.add_argument('--formats', '-f', nargs='+', help='Options: "full", "nopoints", and "norules". Default is "full".', default="full")
+    parser.add_argument('--formats', '-f', nargs='+', help='Options: "full", "nopoints", "nopoints_patch", "norules" and "norules_patch" (the patch formats are just the pages needed to derive nopoints or norules from full). Default is "full".', default="full")
     parser.add_argument('--quit', help='Quit Scribus after export (e.g. when called as part of external script)', action="store_true")
     parser.add_argument('--noexport', help="Don't export PDFs, just make the changes to the file and save", action="store_true")
 
@@ -0,0 +1,82 @@
+"""Contains a build manifest recording what each PDF exported from a document was built from, so PDFs whose inputs haven't changed can be skipped"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from t9a.cache import file_hash
+
+MANIFEST_SUFFIX = ".build.json"
+MANIFEST_VERSION = 1 # bump when the way inputs are hashed changes
+
+
+class BuildManifest:
+    """The hash of the inputs and the output file of each PDF built from a document, stored in a JSON file next to it.
+
+    The hashes of the input files are kept along with the size and modification time they were computed for, so
+    checking an unchanged build only needs to stat the inputs rather than read them.
+    """
+
+    def __init__(self, source, manifest_file=None):
+        self.source = Path(source)
+        self.manifest_file = Path(manifest_file) if manifest_file else self.source.with_name(self.source.name + MANIFEST_SUFFIX)
+        self.files = {} # path -> {"size", "mtime", "sha256"}
+        self.outputs = {} # artifact -> {"inputs", "output"}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_file) as json_file:
+                manifest = json.load(json_file)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get("version") == MANIFEST_VERSION:
+            self.files = manifest.get("files", {})
+            self.outputs = manifest.get("outputs", {})
+
+    def file_hash(self, filename):
+        """Returns the SHA-256 hex digest of a file, only reading it if it has changed since it was last hashed, or
+        "missing" if it doesn't exist"""
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return "missing"
+        key = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        entry = self.files.get(str(filename), {})
+        if {"size": entry.get("size"), "mtime": entry.get("mtime")} != key:
+            entry = self.files[str(filename)] = key | {"sha256": file_hash(filename)}
+        return entry["sha256"]
+
+    def inputs_hash(self, files, settings=None):
+        """Returns a hash of the contents of some files and any settings that change the output
+
+        Args:
+            files ([string]): Input files
+            settings (dict, optional): JSON-serialisable settings, e.g. the format and quality
+        """
+        inputs = {"files": {str(filename): self.file_hash(filename) for filename in files}, "settings": settings}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def is_current(self, artifact, inputs):
+        """Checks whether an artifact was last built from the same inputs and its output file still exists"""
+        entry = self.outputs.get(artifact)
+        return entry is not None and entry["inputs"] == inputs and Path(entry["output"]).is_file()
+
+    def output(self, artifact):
+        """Returns the output file last recorded for an artifact, or None"""
+        entry = self.outputs.get(artifact)
+        return Path(entry["output"]) if entry else None
+
+    def record(self, artifact, inputs, output):
+        """Stores the inputs hash and output file of an artifact that has been built. Call save() to write the manifest."""
+        self.outputs[artifact] = {"inputs": inputs, "output": str(output)}
+
+    def save(self):
+        temp_file = self.manifest_file.with_name(self.manifest_file.name + ".temp")
+        try:
+            with open(temp_file, "w") as json_file:
+                json.dump({"version": MANIFEST_VERSION, "files": self.files, "outputs": self.outputs}, json_file, indent=4)
+            os.replace(temp_file, self.manifest_file)
+        except OSError as err:
+            logging.warning(f"Couldn't write build manifest {self.manifest_file}: {err}")
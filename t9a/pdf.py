@@ -1,18 +1,47 @@
 '''Contains functions to analyse and manipulate both T9A slim rules PDFs and exported Full Army Books'''
+import asyncio
+import io
+import logging
+import math
+import multiprocessing
 import re
 import os
 import json
+import shutil
+import time
+import zlib
+from collections import Counter
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import zip_longest
 from pathlib import Path
+from typing import NamedTuple, Optional
 
-from pypdf import PdfWriter, PdfReader
-from py_pdf_parser.loaders import load_file
+from PIL import Image
+from pypdf import PdfWriter, PdfReader, __version__ as PYPDF_VERSION
+from pypdf.generic import (ArrayObject, ContentStream, DecodedStreamObject, DictionaryObject, FloatObject, IndirectObject,
+                           NameObject, NullObject, NumberObject, TextStringObject)
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LAParams, LTTextBox
+from py_pdf_parser.loaders import load_file, DEFAULT_LA_PARAMS
+
+from t9a import FONT_MAPPING
+from t9a.cache import get_cached_titles, set_cached_titles
+from t9a.records import OutlineItem, Title, build_outline
 
 
 DEFAULT_FILENAME = r"D:\9th age\Scribus LABs\LAB_ID\images\T9A-FB_2ed_ID_2021_beta4_EN.pdf"
 
-FONT_MAPPING = {
-    r"\w{6}\+Caladea-(Bold|Regular),2\d*": "chapter_title",
-}
+# How titles are found: "pdfminer" does a full layout analysis (as py_pdf_parser), "pypdf" only reads the text
+# drawn in each font, which is much faster. Set the environment variable T9A_TITLE_BACKEND to choose.
+TITLE_BACKENDS = ["pdfminer", "pypdf"]
+TITLE_BACKEND = os.environ.get("T9A_TITLE_BACKEND", "pdfminer")
+TITLE_BACKEND_PACKAGES = {"pdfminer": ["pdfminer.six", "py-pdf-parser"], "pypdf": ["pypdf"]} # versions that affect the titles found
+LINE_MARGIN = 0.5 # pdfminer's default LAParams.line_margin, for grouping lines into titles
+JPEG_QUALITY = [95, 85, 75, 50, 25] # roughly the JPEG quality of Scribus's image quality levels, Max to Minimum
+# pypdf versions (from, up to but not including) that the private parts of pypdf used by PdfInternals have been checked against
+SUPPORTED_PYPDF = ((3, 7), (3, 8))
+SPAWN_CONTEXT = multiprocessing.get_context("spawn") # see process_pool()
 
 
 def parse_title(text):
@@ -20,24 +49,186 @@ def parse_title(text):
     # return text
 
 
+def element_font(element):
+    """Returns the font of a pdfminer text box in the same "name,size" form that py_pdf_parser matches FONT_MAPPING against"""
+    characters = [character for line in element for character in line if hasattr(character, "fontname")]
+    name = Counter(character.fontname for character in characters).most_common(1)[0][0]
+    size = Counter(character.height for character in characters).most_common(1)[0][0]
+    return f"{name},{round(size, 1)}"
+
+
+def is_chapter_title(element):
+    font = element_font(element)
+    return any(re.match(pattern, font) for pattern, name in FONT_MAPPING.items() if name == "chapter_title")
+
+
+def font_descriptor(font):
+    """Returns the /FontDescriptor of a pypdf font dictionary, which composite fonts keep in their descendant font"""
+    if "/FontDescriptor" in font:
+        return font["/FontDescriptor"].get_object()
+    if "/DescendantFonts" in font:
+        descendant = font["/DescendantFonts"].get_object()[0].get_object()
+        if "/FontDescriptor" in descendant:
+            return descendant["/FontDescriptor"].get_object()
+    return {}
+
+
+def iter_page_titles_pypdf(filename):
+    """Yields the chapter titles on each page of a PDF, found by pypdf's text visitor instead of layout analysis.
+    Consecutive lines of text in a title font make up one title (with any other text on the same lines, as long as
+    most of it is in the title font), and positions are worked out the way pdfminer does, so the results match
+    iter_page_titles() for titles laid out like those in the T9A rules PDFs.
+
+    Yields:
+        [Title]: Titles on the next page with details, top to bottom
+    """
+    patterns = [re.compile(pattern) for pattern, name in FONT_MAPPING.items() if name == "chapter_title"]
+    index = 0
+    for page_number, page in enumerate(PdfReader(filename).pages, start=1):
+        found = [] # {"lines", "top", "bottom", "baseline", "x", "title_chars", "other_chars"} for each title
+        current = None
+        starts = [] # (cm, tm) when the text passed to the next visit_text() started
+
+        def visit_operand(operator, operands, cm, tm):
+            if operator in (b"Tj", b"TJ", b"'", b'"') and not starts:
+                starts.append((list(cm), list(tm)))
+
+        def visit_text(text, cm, tm, font, font_size):
+            nonlocal current
+            # pypdf passes the text matrix as it is when the text is flushed, which can be on the next line
+            if starts:
+                cm, tm = starts.pop()
+            if not text.strip():
+                return
+            if font is None:
+                current = None
+                return
+            # position and size in device space (horizontal text only, as in the rules PDFs)
+            scale, x, y = tm[3]*cm[3], tm[4]*cm[0]+tm[5]*cm[2]+cm[4], tm[4]*cm[1]+tm[5]*cm[3]+cm[5]
+            size = abs(font_size*scale)
+            descriptor = font_descriptor(font)
+            name = str(descriptor.get("/FontName", "unknown")).lstrip("/")
+            descent = float(descriptor.get("/Descent", 0))/1000*size
+            is_title = any(pattern.match(f"{name},{round(size, 1)}") for pattern in patterns)
+            if current is not None and abs(y - current["baseline"]) < 0.1: # same line
+                current["lines"][-1] += text.rstrip("\n")
+            elif not is_title:
+                current = None
+                return
+            elif current is not None and 0 < current["baseline"] - y <= size*(1 + LINE_MARGIN): # next line of the same title
+                current["lines"].append(text.strip())
+                current["bottom"] = y+descent
+                current["baseline"] = y
+            else:
+                current = {"lines": [text.strip()], "top": y+descent+size, "bottom": y+descent, "baseline": y, "x": x, "title_chars": 0, "other_chars": 0}
+                found.append(current)
+            current["title_chars" if is_title else "other_chars"] += len(text.strip())
+
+        page.extract_text(visitor_text=visit_text, visitor_operand_before=visit_operand)
+        titles = []
+        for box in sorted(found, key=lambda box: (-box["bottom"], box["x"])):
+            if box["other_chars"] > box["title_chars"]:
+                continue
+            index += 1
+            title = parse_title("\n".join(box["lines"]).strip())
+            if title != "Changelog":
+                titles.append(Title(title, page_number, box["top"], index))
+        yield titles
+
+
+def title_backend_id(backend=None):
+    """Returns the name of a title backend with the versions of the libraries it uses, e.g. "pypdf pypdf==3.7.0", so
+    titles found by different backends or library versions are cached separately
+
+    Args:
+        backend (string, optional): One of TITLE_BACKENDS. Defaults to TITLE_BACKEND.
+    """
+    backend = backend or TITLE_BACKEND
+    return " ".join([backend, *(f"{package}=={metadata.version(package)}" for package in TITLE_BACKEND_PACKAGES[backend])])
+
+
 def get_titles(filename,details=False):
+    """Returns the chapter titles of a rules PDF, from the cache next to the PDF if it hasn't changed since it was last parsed
+
+    Args:
+        filename (string): Full path to PDF
+        details (bool, optional): Include the order and y-position of each title. Defaults to False.
+
+    Returns:
+        [Title]: Titles in the order they appear
+    """
+    if (titles := get_cached_titles(filename, FONT_MAPPING, details, title_backend_id())) is not None:
+        return titles
+    titles = parse_titles(filename)
+    set_cached_titles(filename, FONT_MAPPING, title_backend_id(), titles)
+    return titles if details else [Title(title.title, title.page) for title in titles]
+
+
+def parse_titles(filename, backend=None):
+    """Uncached implementation of get_titles(), always including details
+
+    Args:
+        filename (string): Full path to PDF
+        backend (string, optional): One of TITLE_BACKENDS. Defaults to TITLE_BACKEND.
+    """
+    if (backend or TITLE_BACKEND) == "pypdf":
+        return [title for titles in iter_page_titles_pypdf(filename) for title in titles]
     doc = load_file(filename, font_mapping=FONT_MAPPING, font_mapping_is_regex=True)
     titles = doc.elements.filter_by_font("chapter_title")
     entries = []
     for index, item in enumerate(titles, start=1):
         title = parse_title(item.text())
         if title != "Changelog":
-            entry = {}
-            if details: 
-                entry['order'] = index
-            entry['title'] = title
-            entry['page'] = item.page_number
-            if details:
-                entry['ypos'] = item.bounding_box.y1
-            entries.append(entry)
+            entries.append(Title(title, item.page_number, item.bounding_box.y1, index))
     return entries
 
 
+def iter_page_titles(filename, details=False, backend=None):
+    """Lays out a PDF one page at a time and yields the list of chapter titles on each page, giving the same titles as get_titles().
+    Unlike get_titles() nothing is analysed until it's asked for, so callers can stop reading the file early.
+
+    Args:
+        filename (string): PDF file to read
+        details (bool, optional): Include the order and y-position of each title. Defaults to False.
+        backend (string, optional): One of TITLE_BACKENDS. Defaults to TITLE_BACKEND.
+
+    Yields:
+        [Title]: Titles on the next page, top to bottom
+    """
+    if (backend or TITLE_BACKEND) == "pypdf":
+        for titles in iter_page_titles_pypdf(filename):
+            yield titles if details else [Title(title.title, title.page) for title in titles]
+        return
+    index = 0
+    for page in extract_pages(filename, laparams=LAParams(**DEFAULT_LA_PARAMS)):
+        elements = sorted((element for element in page if isinstance(element, LTTextBox)), key=lambda element: (-element.y0, element.x0))
+        titles = []
+        for element in filter(is_chapter_title, elements):
+            index += 1
+            title = parse_title(element.get_text().strip())
+            if title != "Changelog":
+                titles.append(Title(title, page.pageid, element.y1, index) if details else Title(title, page.pageid))
+        yield titles
+
+
+def iter_titles(filename, details=False, backend=None):
+    """Yields the chapter titles of a PDF as they are found, see iter_page_titles()"""
+    for titles in iter_page_titles(filename, details, backend):
+        yield from titles
+
+
+def find_title_mismatch(titles1, titles2):
+    """Compares two sequences of titles, stopping at the first difference
+
+    Returns:
+        (Title, Title): The first pair of titles that differ, with None for a sequence that ended early, or None if they match
+    """
+    for title1, title2 in zip_longest(titles1, titles2):
+        if title1 != title2:
+            return title1, title2
+    return None
+
+
 def export_titles_to_json(pdf_file: str, json_file: str = ""):
     """Parses the titles from the given pdf file and creates a JSON file.
 
@@ -46,32 +237,107 @@ def export_titles_to_json(pdf_file: str, json_file: str = ""):
         json_file (_type_, optional): Filename of JSON file to export. If none provided, file is created in same location as pdf_file.
 
     Returns:
-        List of dictionaries of parsed titles
+        [Title]: List of parsed titles
     """
     titles = get_titles(pdf_file,details=True)
     pdf_file = Path(pdf_file)
     if not json_file:
         json_file = Path(pdf_file).with_suffix('.json')
     with open(json_file,"w") as outfile:
-        json.dump(titles,outfile,indent=4)
+        json.dump([title.to_dict() for title in titles],outfile,indent=4)
     return titles
 
 
+def process_pool(max_workers):
+    """Returns a pool of up to max_workers processes (no more than the number of CPUs) for CPU-bound work. The processes
+    are spawned rather than forked, as these pools are started from threads (e.g. the t9a_generate_labs.py pipeline or the
+    LAB Manager's background operations) and a forked process can deadlock on locks held by the other threads."""
+    return ProcessPoolExecutor(max_workers=max(1, min(max_workers, os.cpu_count() or 1)), mp_context=SPAWN_CONTEXT)
+
+
+async def get_titles_async(filenames, details=False):
+    """Parses the titles of several PDFs at the same time, in a process each up to the number of CPUs (layout analysis is CPU-bound)
+
+    Args:
+        filenames ([string]): PDF files to parse
+        details (bool, optional): Passed to get_titles(). Defaults to False.
+
+    Returns:
+        [[Title]]: Titles of each file, in the same order as filenames
+    """
+    loop = asyncio.get_running_loop()
+    with process_pool(len(filenames)) as pool:
+        return await asyncio.gather(*(loop.run_in_executor(pool, get_titles, filename, details) for filename in filenames))
+
+
+def queue_titles(filename, details, titles, stop):
+    """Puts the titles of a PDF on a queue as they are found, followed by None. Stops at the next page once stop is set.
+    If the whole PDF is read, its titles are cached for get_titles().
+    """
+    found = []
+    try:
+        for page_titles in iter_page_titles(filename, details=True):
+            if stop.is_set():
+                return
+            for title in page_titles:
+                titles.put(title if details else Title(title.title, title.page))
+            found.extend(page_titles)
+        set_cached_titles(filename, FONT_MAPPING, title_backend_id(), found)
+    finally:
+        titles.put(None)
+
+
+async def find_title_mismatch_async(pdf1, pdf2, details=False):
+    """Streams the titles of two PDFs in parallel, each in its own process, and stops both as soon as they differ.
+    If the PDFs match, both are read completely, which takes as long as parsing them with get_titles_async().
+    Titles already in the cache (see get_titles()) are used instead of reading the PDF.
+
+    Returns:
+        (Title, Title): The first pair of titles that differ, see find_title_mismatch(), or None if they match
+    """
+    cached = [get_cached_titles(pdf, FONT_MAPPING, details, title_backend_id()) for pdf in (pdf1, pdf2)]
+    if None not in cached:
+        return find_title_mismatch(*cached)
+
+    loop = asyncio.get_running_loop()
+    with SPAWN_CONTEXT.Manager() as manager, process_pool(2) as pool:
+        stop = manager.Event()
+        queues = []
+        readers = []
+        for pdf, titles in zip((pdf1, pdf2), cached):
+            queues.append(queue := manager.Queue())
+            if titles is None:
+                readers.append(loop.run_in_executor(pool, queue_titles, pdf, details, queue, stop))
+            else:
+                for title in titles + [None]:
+                    queue.put(title)
+        try:
+            while True:
+                title1, title2 = await asyncio.gather(*(loop.run_in_executor(None, queue.get) for queue in queues))
+                if title1 != title2:
+                    return title1, title2
+                if title1 is None:
+                    return None
+        finally:
+            stop.set()
+            await asyncio.gather(*readers) # raises any error from reading the PDFs
+
+
+async def match_titles_async(pdf1, pdf2, details=False):
+    """Checks whether two PDFs have the same titles, stopping at the first difference"""
+    return await find_title_mismatch_async(pdf1, pdf2, details) is None
+
+
 def match_titles(pdf1, pdf2,details=False):
-    pdf1_titles = get_titles(pdf1,details)
-    pdf2_titles = get_titles(pdf2,details)
-    return pdf1_titles == pdf2_titles
+    return asyncio.run(match_titles_async(pdf1, pdf2, details))
 
 
 def compare_pdfs(pdf1, pdf2,details=False):
-    pdf1_titles = get_titles(pdf1,details)
-    pdf2_titles = get_titles(pdf2,details)
-    print(pdf1_titles, tablefmt="simple")
-    print(pdf2_titles, tablefmt="simple")
-    if pdf1_titles == pdf2_titles:
-        print("Conents match!")
-    else:
+    if mismatch := asyncio.run(find_title_mismatch_async(pdf1, pdf2, details)):
         print("Contents don't match!")
+        print(f"First difference: {mismatch[0]} in {pdf1}, {mismatch[1]} in {pdf2}")
+    else:
+        print("Conents match!")
 
 
 def get_version_from_PDF(pdf):
@@ -89,7 +355,288 @@ def get_version_from_PDF(pdf):
     version_list = [r for r in result.groups() if r]
     return " ".join(version_list)
 
-def add_bookmarks_to_pdf(filename, bookmarks, output_filename=None):
+class UnsupportedPypdfError(Exception):
+    pass
+
+
+def check_pypdf_version():
+    """Raises UnsupportedPypdfError if the installed pypdf isn't one that PdfInternals has been checked against"""
+    version = tuple(int(part) for part in re.findall(r"\d+", PYPDF_VERSION)[:2])
+    if not SUPPORTED_PYPDF[0] <= version < SUPPORTED_PYPDF[1]:
+        raise UnsupportedPypdfError(f"Editing PDFs in place needs pypdf {'.'.join(map(str, SUPPORTED_PYPDF[0]))}.x "
+                                    f"(see requirements.txt), but pypdf {PYPDF_VERSION} is installed")
+
+
+class PdfInternals:
+    """The private parts of pypdf needed to edit a document in place (replacing and sweeping objects, refreshing the page
+    list, writing objects and reading encoded stream data). They aren't part of pypdf's API and change between versions,
+    so this is the only place they're used, and only with the versions in SUPPORTED_PYPDF.
+    """
+
+    def __init__(self, writer=None):
+        check_pypdf_version()
+        self.writer = writer
+
+    @property
+    def objects(self):
+        """The writer's objects, indexed by object number - 1"""
+        return self.writer._objects
+
+    @property
+    def catalog(self):
+        return self.writer._root_object
+
+    def roots(self):
+        """Returns references to the document catalog and info, from which every object that's used can be reached"""
+        return [self.writer._root, self.writer._info]
+
+    def add_object(self, obj):
+        return self.writer._add_object(obj)
+
+    def replace_object(self, reference, obj):
+        """Replaces the object that reference points to, so everything that refers to it uses obj instead"""
+        self.writer._replace_object(reference, obj)
+
+    def refresh_pages(self):
+        """Rebuilds the writer's page list after pages have been removed from the page tree"""
+        self.writer._flatten()
+
+    @staticmethod
+    def encoded_data(stream):
+        """Returns the data of a stream object as it's stored in the file, e.g. a whole JPEG for a /DCTDecode image"""
+        return stream._data
+
+    @staticmethod
+    def write_object(obj, stream):
+        """Writes an object to a file without encryption"""
+        obj.write_to_stream(stream, None)
+
+
+def find_startxref(pdf_file):
+    """Returns the offset of the last cross-reference section of an open PDF file"""
+    pdf_file.seek(0, os.SEEK_END)
+    pdf_file.seek(max(0, pdf_file.tell() - 1024))
+    tail = pdf_file.read()
+    if not (result := re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", tail)):
+        raise ValueError("Couldn't find startxref at the end of the file")
+    return int(result[1])
+
+
+class IncrementalOutlineWriter:
+    """Adds bookmarks to a PDF by appending an incremental update to the end of the file: the new outline items, the
+    catalog and any changed outline objects, and a cross-reference section pointing back to the original one.
+    The original bytes are left untouched, so adding bookmarks to a large PDF only writes a few kilobytes.
+
+    add_outline_item() works like PdfWriter's, so the same code can build the outline with either, but adding a whole
+    outline at once with add_outline() is quicker.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.internals = PdfInternals()
+        self.pdf_file = open(filename, "rb") # PdfReader only reads objects from the file as they're needed
+        self.reader = PdfReader(self.pdf_file)
+        self.trailer = self.reader.trailer
+        self.next_number = int(self.trailer["/Size"])
+        self.objects = {} # object number -> (generation, object) to write
+        # raw_get() returns references as they are, whereas [] resolves them to the objects
+        catalog = self.edit_object(self.trailer.raw_get("/Root"))
+        catalog[NameObject("/PageMode")] = NameObject("/UseOutlines") # Show Bookmarks
+        if "/Outlines" in catalog:
+            self.outline = catalog.raw_get("/Outlines")
+        else:
+            self.outline = self.add_object(DictionaryObject({NameObject("/Type"): NameObject("/Outlines"), NameObject("/Count"): NumberObject(0)}))
+            catalog[NameObject("/Outlines")] = self.outline
+
+    @staticmethod
+    def supports(filename):
+        """Checks whether a PDF can be updated incrementally. Files that are encrypted or use cross-reference streams need a full rewrite."""
+        with open(filename, "rb") as pdf_file:
+            pdf_file.seek(find_startxref(pdf_file))
+            if not pdf_file.read(4) == b"xref":
+                return False
+            reader = PdfReader(pdf_file)
+            return not reader.is_encrypted and "/XRefStm" not in reader.trailer
+
+    def add_object(self, obj):
+        reference = IndirectObject(self.next_number, 0, self.reader)
+        self.objects[self.next_number] = (0, obj)
+        self.next_number += 1
+        return reference
+
+    def edit_object(self, reference):
+        """Returns a copy of an existing object that will be written in the update, replacing the original"""
+        if reference.idnum not in self.objects:
+            self.objects[reference.idnum] = (reference.generation, DictionaryObject(reference.get_object()))
+        return self.objects[reference.idnum][1]
+
+    def add_outline_item(self, title, page_number, parent=None):
+        """Adds a bookmark after any existing children of parent
+
+        Args:
+            title (string): Text of the bookmark
+            page_number (int): Index of the page to go to, starting at 0
+            parent (IndirectObject, optional): Bookmark returned by a previous call. Defaults to the top level.
+
+        Returns:
+            IndirectObject: The new bookmark
+        """
+        return self.add_outline([OutlineItem(title, page_number+1, [])], parent)[0]
+
+    def add_outline(self, outline, parent=None):
+        """Adds a tree of bookmarks after any existing children of parent, creating every item once with its links and counts
+
+        Args:
+            outline ([OutlineItem]): Items to add, see build_outline()
+            parent (IndirectObject, optional): Bookmark returned by a previous call. Defaults to the top level.
+
+        Returns:
+            [IndirectObject]: The new items added directly to parent
+        """
+        if not outline:
+            return []
+        parent = parent or self.outline
+        references, count = self.add_items(outline, parent)
+        first = self.objects[references[0].idnum][1]
+        parent_item = self.edit_object(parent)
+        if "/Last" in parent_item:
+            first[NameObject("/Prev")] = parent_item.raw_get("/Last")
+            self.edit_object(parent_item.raw_get("/Last"))[NameObject("/Next")] = references[0]
+        else:
+            parent_item[NameObject("/First")] = references[0]
+        parent_item[NameObject("/Last")] = references[-1]
+
+        # open items count all their visible descendants (closed items have a negative count)
+        ancestor = parent
+        while ancestor is not None:
+            ancestor_item = self.edit_object(ancestor)
+            total = int(ancestor_item.get("/Count", 0))
+            ancestor_item[NameObject("/Count")] = NumberObject(total + count if total >= 0 else total - count)
+            ancestor = ancestor_item.raw_get("/Parent") if "/Parent" in ancestor_item else None
+        return references
+
+    def add_items(self, outline, parent):
+        """Creates the objects for a list of sibling items and their descendants
+
+        Returns:
+            ([IndirectObject], int): References to the items, and the number of items including descendants
+        """
+        references = []
+        count = 0
+        for entry in outline:
+            item = DictionaryObject({
+                NameObject("/Title"): TextStringObject(entry.text),
+                NameObject("/Parent"): parent,
+                NameObject("/A"): DictionaryObject({
+                    NameObject("/S"): NameObject("/GoTo"),
+                    NameObject("/D"): ArrayObject([self.reader.pages[entry.page-1].indirect_reference, NameObject("/Fit")]),
+                }),
+            })
+            reference = self.add_object(item)
+            if references:
+                item[NameObject("/Prev")] = references[-1]
+                self.objects[references[-1].idnum][1][NameObject("/Next")] = reference
+            if entry.children:
+                children, descendants = self.add_items(entry.children, reference)
+                item[NameObject("/First")] = children[0]
+                item[NameObject("/Last")] = children[-1]
+                item[NameObject("/Count")] = NumberObject(descendants)
+                count += descendants
+            references.append(reference)
+            count += 1
+        return references, count
+
+    def write(self):
+        """Appends the update to the file. If writing fails the file is truncated back to its original length."""
+        previous_xref = find_startxref(self.pdf_file)
+        with open(self.filename, "rb+") as pdf_file:
+            pdf_file.seek(0, os.SEEK_END)
+            original_length = pdf_file.tell()
+            try:
+                pdf_file.write(b"\n")
+                offsets = {}
+                for number, (generation, obj) in sorted(self.objects.items()):
+                    offsets[number] = pdf_file.tell()
+                    pdf_file.write(f"{number} {generation} obj\n".encode())
+                    self.internals.write_object(obj, pdf_file)
+                    pdf_file.write(b"\nendobj\n")
+
+                xref = pdf_file.tell()
+                # start with the head of the free list, as some readers expect every section to start at object 0
+                pdf_file.write(b"xref\n0 1\n0000000000 65535 f\r\n")
+                numbers = sorted(offsets)
+                while numbers: # one subsection for each run of consecutive object numbers
+                    run = 1
+                    while run < len(numbers) and numbers[run] == numbers[0] + run:
+                        run += 1
+                    pdf_file.write(f"{numbers[0]} {run}\n".encode())
+                    for number in numbers[:run]:
+                        pdf_file.write(f"{offsets[number]:010d} {self.objects[number][0]:05d} n\r\n".encode())
+                    numbers = numbers[run:]
+
+                trailer = DictionaryObject({
+                    NameObject("/Size"): NumberObject(self.next_number),
+                    NameObject("/Root"): self.trailer.raw_get("/Root"),
+                    NameObject("/Prev"): NumberObject(previous_xref),
+                })
+                for key in ("/Info", "/ID"):
+                    if key in self.trailer:
+                        trailer[NameObject(key)] = self.trailer.raw_get(key)
+                pdf_file.write(b"trailer\n")
+                self.internals.write_object(trailer, pdf_file)
+                pdf_file.write(f"\nstartxref\n{xref}\n%%EOF\n".encode())
+            except Exception:
+                pdf_file.truncate(original_length)
+                raise
+            finally:
+                self.pdf_file.close()
+
+
+def add_outline(output, outline, parent=None):
+    """Adds a tree of bookmarks to a PdfWriter or IncrementalOutlineWriter
+
+    Args:
+        output (PdfWriter or IncrementalOutlineWriter): Writer to add to
+        outline ([OutlineItem]): Items to add, see build_outline()
+        parent (optional): Outline item to add the items to. Defaults to the top level.
+    """
+    if isinstance(output, IncrementalOutlineWriter):
+        output.add_outline(outline, parent)
+        return
+    for item in outline:
+        add_outline(output, item.children, output.add_outline_item(item.text, item.page-1, parent))
+
+
+def add_bookmarks_to_pdf(filename, bookmarks, output_filename=None, incremental=False):
+    """Adds bookmarks to a PDF, replacing it or saving the result as output_filename
+
+    Args:
+        filename (string): PDF file
+        bookmarks ([Header]): Bookmarks in order, level 0 being the top level
+        output_filename (string, optional): File to write. Defaults to replacing filename.
+        incremental (bool, optional): Append the bookmarks to the file as an incremental update instead of rewriting it,
+            if the PDF supports it (see IncrementalOutlineWriter). Defaults to False.
+    """
+    add_outline_to_pdf(filename, build_outline(bookmarks), output_filename, incremental)
+
+
+def add_outline_to_pdf(filename, outline, output_filename=None, incremental=False):
+    """Adds a tree of bookmarks to a PDF, see add_bookmarks_to_pdf()
+
+    Args:
+        outline ([OutlineItem]): Top-level items, see build_outline()
+    """
+    if incremental:
+        if IncrementalOutlineWriter.supports(filename):
+            if output_filename:
+                shutil.copyfile(filename, output_filename)
+                filename = output_filename
+            output = IncrementalOutlineWriter(filename)
+            add_outline(output, outline)
+            output.write()
+            return
+        logging.info(f"{filename} can't be updated incrementally, rewriting the whole file")
+
     with open(filename, 'rb+') as pdf_file:
         input_pdf = PdfReader(pdf_file)
         output = PdfWriter()
@@ -98,18 +645,7 @@ def add_bookmarks_to_pdf(filename, bookmarks, output_filename=None):
         output.add_metadata(input_pdf.metadata)
         output.page_mode = "/UseOutlines" # Show Bookmarks
 
-    # TODO: Rewrite with recursion when my brain is less tired.
-
-    l0_mark = None
-    l1_mark = None
-    l2_mark = None
-    for mark in bookmarks:
-        if int(mark['level']) == 0:
-            l0_mark = output.add_outline_item(mark['text'], int(mark['page'])-1)
-        elif mark['level'] == 1:
-            l1_mark = output.add_outline_item(mark['text'], int(mark['page'])-1, l0_mark)
-        elif mark['level'] == 2:
-            l2_mark = output.add_outline_item(mark['text'], int(mark['page'])-1, l1_mark)
+    add_outline(output, outline)
     
     ### Have to use a temporary file because input file apparantly needs to stay open while output is written, otherwise you get a blank file
     temp_file = f"{filename}.temp"
@@ -124,4 +660,655 @@ def add_bookmarks_to_pdf(filename, bookmarks, output_filename=None):
         os.rename(temp_file,output_filename)
     else:
         os.remove(filename)
-        os.rename(temp_file, filename)
\ No newline at end of file
+        os.rename(temp_file, filename)
+
+
+def multiply_matrices(m, n):
+    """Returns the product of two PDF transformation matrices [a b c d e f], i.e. m applied before n"""
+    return [m[0]*n[0] + m[1]*n[2], m[0]*n[1] + m[1]*n[3],
+            m[2]*n[0] + m[3]*n[2], m[2]*n[1] + m[3]*n[3],
+            m[4]*n[0] + m[5]*n[2] + n[4], m[4]*n[1] + m[5]*n[3] + n[5]]
+
+
+def has_images(resources, checked):
+    """Checks whether some resources, or the forms they use, have any image XObjects
+
+    Args:
+        checked (dict): {object number: bool} of forms already checked, shared between calls
+    """
+    xobjects = resources.get("/XObject", DictionaryObject()) if resources else DictionaryObject()
+    for reference in xobjects.get_object().values():
+        xobject = reference.get_object()
+        if xobject.get("/Subtype") == "/Image":
+            return True
+        if xobject.get("/Subtype") == "/Form":
+            idnum = getattr(reference, "idnum", None)
+            if idnum not in checked:
+                checked[idnum] = has_images(xobject.get("/Resources"), checked)
+            if checked[idnum]:
+                return True
+    return False
+
+
+def find_image_sizes(pdf, content, resources, matrix, sizes, checked):
+    """Finds how big each image is drawn, following the transformations in a content stream and the forms it uses
+
+    Args:
+        sizes (dict): {object number: (reference, width, height)} of the largest size in points each image is drawn at,
+            updated with the images found
+        checked (dict): See has_images()
+    """
+    if not has_images(resources, checked):
+        return
+    xobjects = resources["/XObject"].get_object()
+    stack = []
+    for operands, operator in ContentStream(content, pdf).operations:
+        if operator == b"q":
+            stack.append(matrix)
+        elif operator == b"Q" and stack:
+            matrix = stack.pop()
+        elif operator == b"cm":
+            matrix = multiply_matrices([float(value) for value in operands], matrix)
+        elif operator == b"Do" and operands[0] in xobjects:
+            reference = xobjects.raw_get(operands[0])
+            xobject = reference.get_object()
+            if xobject.get("/Subtype") == "/Image" and isinstance(reference, IndirectObject):
+                width, height = math.hypot(matrix[0], matrix[1]), math.hypot(matrix[2], matrix[3])
+                _, largest_width, largest_height = sizes.get(reference.idnum, (None, 0, 0))
+                sizes[reference.idnum] = (reference, max(width, largest_width), max(height, largest_height))
+            elif xobject.get("/Subtype") == "/Form":
+                form_matrix = multiply_matrices([float(value) for value in xobject.get("/Matrix", [1, 0, 0, 1, 0, 0])], matrix)
+                find_image_sizes(pdf, xobject, xobject.get("/Resources"), form_matrix, sizes, checked)
+
+
+def image_mode(image):
+    """Returns the Pillow mode of an image XObject's pixels, or None if downsample_pdf() doesn't handle its format"""
+    colour_space = image.get("/ColorSpace")
+    if isinstance(colour_space, ArrayObject) and colour_space[0] == "/ICCBased":
+        colour_space = {1: "/DeviceGray", 3: "/DeviceRGB"}.get(colour_space[1].get_object().get("/N"))
+    if image.get("/BitsPerComponent") != 8 or "/Decode" in image or image.get("/ImageMask"):
+        return None
+    if image.get("/Filter") in ("/DCTDecode", "/FlateDecode", None):
+        return {"/DeviceGray": "L", "/DeviceRGB": "RGB"}.get(colour_space)
+
+
+def resample_image(data, filter, mode, size, new_size, quality):
+    """Decodes an image's pixels, resizes them and encodes them again. Run in a thread; Pillow releases the GIL.
+
+    Args:
+        data (bytes): JPEG data if filter is "/DCTDecode", else the decoded pixels
+        mode (string): Pillow mode, "L" or "RGB". Soft masks are given as "mask" and keep lossless compression.
+        quality (int): JPEG quality
+
+    Returns:
+        (bytes, string): The encoded image and its filter
+    """
+    if filter == "/DCTDecode":
+        image = Image.open(io.BytesIO(data))
+    else:
+        image = Image.frombytes("L" if mode == "mask" else mode, size, data)
+    image = image.resize(new_size, Image.LANCZOS)
+    if mode == "mask":
+        return zlib.compress(image.tobytes()), "/FlateDecode"
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=quality, optimize=True)
+    return output.getvalue(), "/DCTDecode"
+
+
+def downsample_pdf(filename, output_filename, dpi, quality=JPEG_QUALITY[3], max_workers=None):
+    """Makes a lower resolution copy of a PDF by downsampling the images that are drawn at more than the given
+    resolution, e.g. to make the low quality export of a book from the high quality one without exporting it from
+    Scribus again. Text, vector graphics, links and bookmarks are kept as they are.
+
+    Colour images are stored as JPEGs, like Scribus does with JPEG compression, and soft masks (transparency) are kept
+    lossless. Images in other formats (e.g. CMYK, indexed colours) and images drawn at or below the resolution are
+    left untouched.
+
+    Args:
+        filename (string): PDF file
+        output_filename (string): File to write
+        dpi (int): Resolution to downsample to
+        quality (int, optional): JPEG quality of downsampled images. Defaults to Scribus's "Low" quality.
+        max_workers (int, optional): Number of threads to resample images with. Defaults to one per CPU.
+
+    Returns:
+        int: Number of images downsampled
+    """
+    with open(filename, "rb") as pdf_file:
+        output = PdfWriter()
+        output.clone_document_from_reader(PdfReader(pdf_file))
+
+    internals = PdfInternals(output)
+    sizes = {}
+    checked = {}
+    for page in output.pages:
+        contents = page.get_contents()
+        if contents is not None:
+            find_image_sizes(output, contents, page.get("/Resources"), [1, 0, 0, 1, 0, 0], sizes, checked)
+
+    jobs = {} # {object number: (reference, mode, size, new_size)} of the images and soft masks to resample
+    for reference, width, height in sizes.values():
+        image = reference.get_object()
+        size = (int(image["/Width"]), int(image["/Height"]))
+        scale = max(width * dpi / 72 / size[0], height * dpi / 72 / size[1])
+        if scale >= 1 or not (mode := image_mode(image)):
+            continue
+        new_size = (max(1, round(size[0]*scale)), max(1, round(size[1]*scale)))
+        jobs[reference.idnum] = (reference, mode, size, new_size)
+        mask = image.raw_get("/SMask") if "/SMask" in image else None
+        if isinstance(mask, IndirectObject) and image_mode(mask.get_object()) == "L":
+            mask_image = mask.get_object()
+            jobs[mask.idnum] = (mask, "mask", (int(mask_image["/Width"]), int(mask_image["/Height"])), new_size)
+
+    def resample(reference, mode, size, new_size):
+        image = reference.get_object()
+        filter = image.get("/Filter")
+        data = PdfInternals.encoded_data(image) if filter == "/DCTDecode" else image.get_data()
+        return resample_image(data, filter, mode, size, new_size, quality)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        results = [(job, pool.submit(resample, *job)) for job in jobs.values()]
+        for (reference, _, _, new_size), result in results:
+            image = reference.get_object()
+            data, filter = result.result()
+            new_image = DecodedStreamObject()
+            new_image.set_data(data) # already encoded, it's written as it is
+            new_image.update({key: value for key, value in image.items() if key not in ("/Filter", "/DecodeParms", "/Length")})
+            new_image.update({
+                NameObject("/Width"): NumberObject(new_size[0]),
+                NameObject("/Height"): NumberObject(new_size[1]),
+                NameObject("/Filter"): NameObject(filter),
+            })
+            internals.replace_object(reference, new_image)
+
+    temp_file = f"{output_filename}.temp"
+    with open(temp_file, "wb") as pdf_file:
+        output.write(pdf_file)
+    os.replace(temp_file, output_filename)
+    return len(jobs)
+
+
+def derive_norules_bookmarks(bookmarks, rules_start, rules_end):
+    """Returns the bookmarks of the norules version of a book from those of the full version, without parsing the
+    _norules document: bookmarks to the rules pages are left out and those after them move back by the number of pages
+    removed, like the pages themselves (see remove_page_range()).
+
+    Args:
+        bookmarks ([Header]): Bookmarks of the full version
+        rules_start (int): First page of the rules, starting at 1
+        rules_end (int): Last page of the rules
+
+    Returns:
+        [Header]: Bookmarks of the norules version
+    """
+    removed = rules_end - rules_start + 1
+    return [bookmark._replace(page=bookmark.page - removed) if bookmark.page > rules_end else bookmark
+            for bookmark in bookmarks if not rules_start <= bookmark.page <= rules_end]
+
+
+class BookmarkResult(NamedTuple):
+    """Outcome of adding bookmarks to one PDF in add_bookmarks_to_pdfs(). error is None if it succeeded."""
+    filename: str
+    seconds: float
+    error: Optional[Exception] = None
+
+
+def bookmark_pdf_job(filename, outline, incremental):
+    """Runs add_outline_to_pdf() for add_bookmarks_to_pdfs(), timing it and catching any error so other PDFs carry on"""
+    start = time.perf_counter()
+    try:
+        add_outline_to_pdf(filename, outline, incremental=incremental)
+    except Exception as err:
+        return BookmarkResult(filename, time.perf_counter() - start, err)
+    return BookmarkResult(filename, time.perf_counter() - start)
+
+
+def add_bookmarks_to_pdfs(filenames, bookmarks, incremental=False, max_workers=None):
+    """Adds the same bookmarks to several PDFs (e.g. each format and quality of a book) in a pool of threads, as the work
+    is mostly reading and writing files (incremental updates only append a few KB). Threads are also safe to start from
+    the threads of the t9a_generate_labs.py pipeline, unlike forked processes. The outline is built once and shared. A
+    PDF that fails is logged and doesn't stop the others.
+
+    Args:
+        filenames ([string]): PDF files, each replaced by its bookmarked version
+        bookmarks ([Header]): Bookmarks in order, level 0 being the top level
+        incremental (bool, optional): See add_bookmarks_to_pdf(). Defaults to False.
+        max_workers (int, optional): Number of threads. Defaults to one per PDF, up to the number of CPUs.
+
+    Returns:
+        [BookmarkResult]: Result for each file, in the same order as filenames
+    """
+    if not filenames:
+        return []
+    outline = build_outline(bookmarks)
+    max_workers = max_workers or min(len(filenames), os.cpu_count() or 1)
+    start = time.perf_counter()
+    if max_workers == 1: # not worth starting a thread
+        results = [bookmark_pdf_job(filename, outline, incremental) for filename in filenames]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bookmarks") as pool:
+            results = list(pool.map(bookmark_pdf_job, filenames, [outline]*len(filenames), [incremental]*len(filenames)))
+
+    for result in results:
+        if result.error:
+            logging.error(f"Failed to add bookmarks to {result.filename}: {result.error!r}")
+        else:
+            logging.info(f"Added bookmarks to {result.filename} in {result.seconds:.2f}s")
+    failed = sum(1 for result in results if result.error)
+    logging.info(f"Bookmarked {len(results)-failed}/{len(results)} PDFs in {time.perf_counter()-start:.2f}s "
+                 f"using {max_workers} thread(s)")
+    return results
+
+
+def page_size(page):
+    """Returns the (width, height) of a page's crop box, which Scribus uses as the bounding box of an embedded page"""
+    box = page.cropbox
+    return float(box.width), float(box.height)
+
+
+def find_page_forms(resources, size, tolerance=0.5):
+    """Finds the Form XObjects in some resources (and the forms they use) that are the given size, i.e. embedded pages
+
+    Returns:
+        [IndirectObject]: References to the forms
+    """
+    forms = []
+    xobjects = resources.get("/XObject", DictionaryObject()) if resources else DictionaryObject()
+    for reference in xobjects.get_object().values():
+        xobject = reference.get_object()
+        if xobject.get("/Subtype") != "/Form":
+            continue
+        x0, y0, x1, y1 = (float(value) for value in xobject["/BBox"])
+        if abs(abs(x1-x0)-size[0]) <= tolerance and abs(abs(y1-y0)-size[1]) <= tolerance:
+            forms.append(reference)
+        else:
+            forms.extend(find_page_forms(xobject.get("/Resources"), size, tolerance))
+    return forms
+
+
+def page_to_form(writer, page, form):
+    """Makes a Form XObject in writer from a page of another PDF, to take the place of form
+
+    The new form is positioned so that its crop box lands where the bounding box of form was.
+    """
+    x0, y0 = (float(value) for value in form["/BBox"][:2])
+    box = page.cropbox
+    dx, dy = x0 - float(box.left), y0 - float(box.bottom)
+    a, b, c, d, e, f = (float(value) for value in form.get("/Matrix", [1, 0, 0, 1, 0, 0]))
+    data = DecodedStreamObject()
+    contents = page.get_contents()
+    data.set_data(contents.get_data() if contents is not None else b"")
+    new_form = data.flate_encode()
+    new_form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject(FloatObject(value) for value in (box.left, box.bottom, box.right, box.top)),
+        NameObject("/Matrix"): ArrayObject(FloatObject(value) for value in (a, b, c, d, dx*a + dy*c + e, dx*b + dy*d + f)),
+    })
+    if "/Resources" in page:
+        new_form[NameObject("/Resources")] = page["/Resources"].clone(writer)
+    return new_form
+
+
+def remove_unused_objects(writer):
+    """Replaces objects that can no longer be reached from the document catalog or info with null, so they aren't written"""
+    internals = PdfInternals(writer)
+    objects = internals.objects
+    used = set()
+    stack = internals.roots()
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.idnum in used:
+                continue
+            used.add(obj.idnum)
+            obj = objects[obj.idnum-1]
+        if isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+    for idnum in range(1, len(objects)+1):
+        if idnum not in used and objects[idnum-1] is not None:
+            objects[idnum-1] = NullObject()
+
+
+def same_content(form, page):
+    """Checks whether a form draws the same thing as a page, ignoring differences in whitespace"""
+    contents = page.get_contents()
+    page_data = contents.get_data() if contents is not None else b""
+    return form.get_data().split() == page_data.split()
+
+
+def replace_embedded_pages(filename, rules_pdf, page_map, output_filename, original_rules=None, patch_pdf=None, patch_pages=()):
+    """Replaces the rules PDF pages embedded in an exported book with the pages of another rules PDF, e.g. to make the
+    nopoints version of a book from the full version without exporting it from Scribus again.
+
+    Scribus embeds each page of a PDF image as a Form XObject the size of the page. Everything else, such as the text
+    and links on top of the rules and the bookmarks, is kept. Pages whose content changes in the other version (e.g. the
+    version name on the title page) can be swapped for the pages of a patch PDF exported with just those pages.
+
+    Args:
+        filename (string): Exported book PDF
+        rules_pdf (string): Rules PDF to embed instead, with the same page size as the one in filename
+        page_map ([(int, int)]): Which page of the rules is shown on each page of the book, as (book page, rules page)
+            pairs starting at 1, see t9a.sla.SLAFile.get_rules_page_map()
+        output_filename (string): File to write
+        original_rules (string, optional): Rules PDF embedded in filename, to tell its pages apart from other embedded
+            PDFs of the same size. Defaults to None.
+        patch_pdf (string, optional): PDF with the pages to swap in. Defaults to None.
+        patch_pages ([int], optional): Page numbers in the book of each page of patch_pdf, starting at 1
+
+    Returns:
+        int: Number of pages whose rules were replaced
+
+    Raises:
+        ValueError: If a page of the book doesn't show exactly one embedded page of the rules
+    """
+    rules = PdfReader(rules_pdf)
+    original = PdfReader(original_rules) if original_rules else None
+    with open(filename, "rb") as pdf_file:
+        output = PdfWriter()
+        output.clone_document_from_reader(PdfReader(pdf_file))
+
+    internals = PdfInternals(output)
+    replaced = set()
+    for book_page, rules_page in sorted(page_map):
+        if not 1 <= book_page <= len(output.pages) or not 1 <= rules_page <= len(rules.pages):
+            raise ValueError(f"Can't put page {rules_page} of {rules_pdf} ({len(rules.pages)} pages) on page {book_page} "
+                             f"of {filename} ({len(output.pages)} pages)")
+        new_page = rules.pages[rules_page-1]
+        forms = list({reference.idnum: reference for reference in
+                      find_page_forms(output.pages[book_page-1].get("/Resources"), page_size(new_page))}.values())
+        if len(forms) > 1 and original and rules_page <= len(original.pages):
+            forms = [reference for reference in forms if same_content(reference.get_object(), original.pages[rules_page-1])]
+        if len(forms) != 1:
+            raise ValueError(f"{filename}: Expected page {rules_page} of the rules on page {book_page}, "
+                             f"found {len(forms)} embedded pages of that size")
+        reference = forms[0]
+        if reference.idnum not in replaced: # the same form can be drawn on more than one page
+            internals.replace_object(reference, page_to_form(output, new_page, reference.get_object()))
+            replaced.add(reference.idnum)
+    if patch_pdf:
+        swap_in_patch(output, patch_pdf, patch_pages)
+    remove_unused_objects(output)
+
+    temp_file = f"{output_filename}.temp"
+    with open(temp_file, "wb") as pdf_file:
+        output.write(pdf_file)
+    os.replace(temp_file, output_filename)
+    return len(replaced)
+
+
+def link_target(item):
+    """Returns the /Dest of a link annotation or outline item, or the /D of its GoTo action: a destination array or the
+    name of a named destination"""
+    destination = item.get("/Dest")
+    if destination is None and "/A" in item:
+        action = item["/A"]
+        if action.get("/S") == "/GoTo":
+            destination = action.get("/D")
+    return destination
+
+
+def goes_to(item, pages, names=frozenset()):
+    """Checks whether a link annotation or outline item goes to any of the given pages (object numbers), directly or
+    through any of the given named destinations"""
+    if (page := link_page(item)) is not None:
+        return page.idnum in pages
+    if (destination := link_target(item)) is not None and not isinstance(destination, ArrayObject):
+        return str(destination) in names or str(destination).lstrip("/") in names
+    return False
+
+
+def destination_page(value):
+    """Returns the page reference of the value of a named destination (a destination array, or a dictionary with it in
+    /D), or None if it doesn't go to a page in the same document"""
+    value = value.get_object()
+    if isinstance(value, DictionaryObject):
+        value = value.get("/D")
+    if isinstance(value, ArrayObject) and value and isinstance(value[0], IndirectObject):
+        return value[0]
+
+
+def remove_name_tree_entries(node, pages, removed):
+    """Removes the entries of a /Dests name tree that go to any of the given pages (object numbers), adding their names
+    to removed. Kids left empty are removed and /Limits are updated.
+
+    Returns:
+        (string, string): The first and last names left under node, or None if there are none
+    """
+    names = []
+    if "/Names" in node:
+        kept = ArrayObject()
+        entries = node["/Names"]
+        for name, value in zip(entries[::2], entries[1::2]):
+            if (page := destination_page(value)) is not None and page.idnum in pages:
+                removed.add(str(name))
+            else:
+                kept.extend((name, value))
+                names.append(name)
+        node[NameObject("/Names")] = kept
+    if "/Kids" in node:
+        kids = ArrayObject()
+        for kid in node["/Kids"]:
+            if limits := remove_name_tree_entries(kid.get_object(), pages, removed):
+                kids.append(kid)
+                names.extend(limits)
+        node[NameObject("/Kids")] = kids
+    if not names:
+        return None
+    if "/Limits" in node:
+        node[NameObject("/Limits")] = ArrayObject([names[0], names[-1]])
+    return names[0], names[-1]
+
+
+def remove_named_destinations(catalog, pages):
+    """Removes the named destinations that go to any of the given pages (object numbers), from both the /Dests
+    dictionary and the /Dests name tree, so the pages can't be reached through them
+
+    Returns:
+        set: The names removed
+    """
+    removed = set()
+    if "/Dests" in catalog:
+        dests = catalog["/Dests"]
+        for name in list(dests):
+            if (page := destination_page(dests[name])) is not None and page.idnum in pages:
+                removed.add(str(name))
+                del dests[name]
+    if "/Names" in catalog and "/Dests" in catalog["/Names"]:
+        remove_name_tree_entries(catalog["/Names"]["/Dests"], pages, removed)
+    return removed
+
+
+def link_destination(item, named=None):
+    """Returns the destination array of a link annotation or outline item that goes to a page in the same document, or
+    None if it goes anywhere else (e.g. a web link)
+
+    Args:
+        named (dict, optional): Named destinations of the document (see PdfReader.named_destinations), to follow links
+            to them. Defaults to None, which doesn't follow them.
+    """
+    destination = link_target(item)
+    if named and destination is not None and not isinstance(destination, ArrayObject):
+        name = str(destination)
+        if (target := named.get(name, named.get(name.lstrip("/")))) is not None:
+            destination = target.dest_array
+    if isinstance(destination, ArrayObject) and destination and isinstance(destination[0], IndirectObject):
+        return destination
+
+
+def link_page(item, named=None):
+    """Returns the reference of the page that a link annotation or outline item goes to, or None if it isn't a link to a
+    page in the same document (e.g. a web link or, unless named is given, a named destination)"""
+    destination = link_destination(item, named)
+    return destination[0] if destination else None
+
+
+def remove_outline_items(parent, pages, names=frozenset()):
+    """Unlinks the outline items under parent that go to any of the given pages, along with their children
+
+    Args:
+        parent (DictionaryObject): Outline dictionary or item
+        pages (set): Object numbers of the pages
+        names (set, optional): Named destinations that went to the pages, see remove_named_destinations()
+
+    Returns:
+        int: Number of items left under parent that are shown when it's open, as used for /Count
+    """
+    kept = []
+    reference = parent.raw_get("/First") if "/First" in parent else None
+    while reference is not None:
+        item = reference.get_object()
+        if not goes_to(item, pages, names):
+            kept.append((reference, remove_outline_items(item, pages, names)))
+        reference = item.raw_get("/Next") if "/Next" in item else None
+
+    for key in ("/First", "/Last"):
+        parent.pop(NameObject(key), None)
+    if kept:
+        parent[NameObject("/First")] = kept[0][0]
+        parent[NameObject("/Last")] = kept[-1][0]
+    visible = 0
+    for i, (reference, count) in enumerate(kept):
+        item = reference.get_object()
+        item.pop(NameObject("/Prev"), None)
+        item.pop(NameObject("/Next"), None)
+        if i > 0:
+            item[NameObject("/Prev")] = kept[i-1][0]
+        if i < len(kept)-1:
+            item[NameObject("/Next")] = kept[i+1][0]
+        visible += 1 + (count if item.get("/Count", 0) > 0 else 0)
+
+    is_open = parent.get("/Type") == "/Outlines" or parent.get("/Count", 0) >= 0
+    parent.pop(NameObject("/Count"), None)
+    if visible:
+        parent[NameObject("/Count")] = NumberObject(visible if is_open else -visible)
+    return visible
+
+
+def replace_page_contents(writer, page, new_page):
+    """Replaces what's drawn on a page in writer with a page of another PDF, see replace_page_annotations() for its links"""
+    contents = new_page.get_contents()
+    data = DecodedStreamObject()
+    data.set_data(contents.get_data() if contents is not None else b"")
+    page[NameObject("/Contents")] = PdfInternals(writer).add_object(data.flate_encode())
+    page.pop(NameObject("/Resources"), None)
+    if "/Resources" in new_page:
+        page[NameObject("/Resources")] = new_page["/Resources"].clone(writer)
+    for box in ("/MediaBox", "/CropBox", "/BleedBox", "/TrimBox", "/ArtBox"):
+        page.pop(NameObject(box), None)
+        if box in new_page:
+            page[NameObject(box)] = new_page[box].clone(writer)
+
+
+def replace_page_annotations(writer, page, new_page, pages, named=None):
+    """Replaces the links and other annotations of a page in writer with those of a page of another PDF, which match its
+    content after replace_page_contents()
+
+    Args:
+        pages (dict): {object number of a page of the other PDF: page of writer it stands for}. Links to these pages go to
+            the pages of writer instead, and links to any other page of the other PDF are dropped.
+        named (dict, optional): Named destinations of the other PDF (see PdfReader.named_destinations)
+
+    Returns:
+        int: Number of links dropped
+    """
+    internals = PdfInternals(writer)
+    annotations = ArrayObject()
+    dropped = 0
+    for reference in new_page.get("/Annots", ArrayObject()):
+        annotation = reference.get_object()
+        destination = link_destination(annotation, named)
+        is_link = "/Dest" in annotation or annotation.get("/A", DictionaryObject()).get("/S") == "/GoTo"
+        if is_link and (destination is None or destination[0].idnum not in pages):
+            dropped += 1
+            continue
+        new_annotation = DictionaryObject({NameObject(key): value.clone(writer) for key, value in annotation.items()
+                                           if key not in ("/P", "/Parent", "/Dest", "/A") or (key == "/A" and not is_link)})
+        if is_link:
+            new_annotation[NameObject("/Dest")] = ArrayObject([pages[destination[0].idnum].indirect_reference] +
+                                                              [value.clone(writer) for value in destination[1:]])
+        new_annotation[NameObject("/P")] = page.indirect_reference
+        annotations.append(internals.add_object(new_annotation))
+    page.pop(NameObject("/Annots"), None)
+    if annotations:
+        page[NameObject("/Annots")] = annotations
+    return dropped
+
+
+def swap_in_patch(writer, patch_pdf, page_numbers):
+    """Swaps pages of writer for the pages of a patch PDF exported with just those pages, along with their links
+
+    Args:
+        patch_pdf (string): PDF with the pages to swap in
+        page_numbers ([int]): Page numbers in writer of each page of patch_pdf, starting at 1
+    """
+    patch = PdfReader(patch_pdf)
+    pages = {new_page.indirect_reference.idnum: writer.pages[number-1] for number, new_page in zip(page_numbers, patch.pages)}
+    named = patch.named_destinations
+    dropped = 0
+    for number, new_page in zip(page_numbers, patch.pages):
+        replace_page_contents(writer, writer.pages[number-1], new_page)
+        dropped += replace_page_annotations(writer, writer.pages[number-1], new_page, pages, named)
+    if dropped:
+        logging.warning(f"{patch_pdf}: Dropped {dropped} link(s) to pages that weren't in the patch")
+
+
+def remove_page_range(filename, first_page, last_page, output_filename, patch_pdf=None, patch_pages=()):
+    """Removes a range of pages from a PDF, e.g. to make the norules (background) version of a book from the full version
+    without exporting it from Scribus again.
+
+    Links, bookmarks and named destinations that go to the removed pages are removed, so nothing refers to the pages and
+    they aren't written. The rest still go to the same pages, which now have
+    lower page numbers. Pages whose content changes when the pages are removed in Scribus (e.g. the title, contents
+    and page numbers) can be swapped for the pages of a patch PDF exported with just those pages, along with their
+    links (see swap_in_patch()).
+
+    Args:
+        filename (string): PDF file
+        first_page (int): First page to remove, starting at 1
+        last_page (int): Last page to remove
+        output_filename (string): File to write
+        patch_pdf (string, optional): PDF with the pages to swap in. Defaults to None.
+        patch_pages ([int], optional): Page numbers in the new PDF of each page of patch_pdf, starting at 1
+
+    Returns:
+        int: Number of pages in the new PDF
+    """
+    with open(filename, "rb") as pdf_file:
+        output = PdfWriter()
+        output.clone_document_from_reader(PdfReader(pdf_file))
+
+    internals = PdfInternals(output)
+    removed = set()
+    for page in list(output.pages)[first_page-1:last_page]:
+        removed.add(page.indirect_reference.idnum)
+        parent = page["/Parent"]
+        parent[NameObject("/Kids")] = ArrayObject(kid for kid in parent["/Kids"] if kid.idnum != page.indirect_reference.idnum)
+        while parent is not None:
+            parent[NameObject("/Count")] = NumberObject(parent["/Count"] - 1)
+            parent = parent.get("/Parent")
+    internals.refresh_pages()
+
+    names = remove_named_destinations(internals.catalog, removed)
+    for page in output.pages:
+        if "/Annots" in page:
+            annotations = ArrayObject(annotation for annotation in page["/Annots"]
+                                      if not goes_to(annotation.get_object(), removed, names))
+            if annotations:
+                page[NameObject("/Annots")] = annotations
+            else:
+                del page["/Annots"]
+    if "/Outlines" in internals.catalog:
+        remove_outline_items(internals.catalog["/Outlines"], removed, names)
+
+    if patch_pdf:
+        swap_in_patch(output, patch_pdf, patch_pages)
+    remove_unused_objects(output)
+
+    temp_file = f"{output_filename}.temp"
+    with open(temp_file, "wb") as pdf_file:
+        output.write(pdf_file)
+    os.replace(temp_file, output_filename)
+    return len(output.pages)
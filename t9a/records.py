@@ -0,0 +1,67 @@
+"""Contains the record types shared by t9a.sla, t9a.pdf and t9a.scribus for headers, bookmarks and PDF titles.
+
+They are named tuples, so they have no per-instance __dict__, compare and sort like tuples, and are
+written by json.dump as plain lists (e.g. in the .sla cache). Use from_dict()/to_dict() where a JSON
+file is meant to be read or edited by hand.
+"""
+from typing import NamedTuple, Optional
+
+
+class Header(NamedTuple):
+    """A heading in a document, used for ToC entries and PDF bookmarks. Level 0 is a top-level bookmark."""
+    level: int
+    text: str
+    page: int
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Creates a Header from a {"level", "text", "page"} dictionary, converting numbers stored as strings"""
+        return cls(int(entry["level"]), entry["text"], int(entry["page"]))
+
+    def to_dict(self):
+        return self._asdict()
+
+
+class Title(NamedTuple):
+    """A chapter title found in a rules PDF. order and ypos are only set when the details are requested."""
+    title: str
+    page: int
+    ypos: Optional[float] = None
+    order: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Creates a Title from a dictionary as written by to_dict()"""
+        return cls(entry["title"], int(entry["page"]), entry.get("ypos"), entry.get("order"))
+
+    def to_dict(self):
+        """Returns the title as a dictionary, leaving out details that weren't set"""
+        return {key: value for key, value in self._asdict().items() if value is not None}
+
+
+class OutlineItem(NamedTuple):
+    """A bookmark in a PDF outline. page starts at 1, like Header."""
+    text: str
+    page: int
+    children: list
+
+
+def build_outline(headers):
+    """Nests a flat list of headers into an outline tree in one pass, keeping a stack of the current item at each level.
+    Each header becomes a child of the closest preceding header with a lower level, so any depth is supported.
+
+    Args:
+        headers ([Header]): Headers in document order
+
+    Returns:
+        [OutlineItem]: Top-level items
+    """
+    outline = []
+    stack = [] # (level, item) for the current item at each open level
+    for header in headers:
+        while stack and stack[-1][0] >= header.level:
+            stack.pop()
+        item = OutlineItem(header.text, header.page, [])
+        (stack[-1][1].children if stack else outline).append(item)
+        stack.append((header.level, item))
+    return outline
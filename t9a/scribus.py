@@ -18,7 +18,9 @@ import logging
 
 import t9a
 # from t9a import EXPECTED_STYLES, EXPECTED_FRAMES
-from t9a.sla import SLAFile
+from t9a.sla import SLAFile, HEADER_SECTIONS
+from t9a.records import Header, Title
+from t9a.cache import get_cached_titles
 
 #####################
 ### FOOTER CONFIG ###
@@ -86,7 +88,7 @@ class ScribusLAB:
     def __init__(self):
         logging.debug("Creating ScribusLAB")
         self.filename = scribus.getDocName()
-        self.lab = SLAFile(self.filename)
+        self.lab = SLAFile(self.filename, sections=HEADER_SECTIONS, cache=True)
         self.rules_start = int(scribus.getText('rules_start'))
         self.rules_end = int(scribus.getText("rules_end"))
         logging.debug("Getting Footer Y position")
@@ -136,18 +138,31 @@ class ScribusLAB:
 
     def load_titles_from_json(self,filename):
         with open(filename) as json_file:
-            return json.load(json_file)
+            return [Title.from_dict(entry) for entry in json.load(json_file)]
+
+    def load_rules_titles(self, rules_pdf):
+        """Returns the titles of the rules PDF from the title cache if it's up to date, otherwise from the .json exported next to the PDF
+
+        Raises:
+            FileNotFoundError: If the titles aren't cached and there's no .json file
+        """
+        if (titles := get_cached_titles(rules_pdf, t9a.FONT_MAPPING, details=True)) is not None:
+            return titles
+        json_file = Path(rules_pdf).with_suffix(".json")
+        if not json_file.is_file():
+            raise FileNotFoundError(f"Couldn't find {json_file}. Please parse the rules PDF in the LAB Manager and try again")
+        return self.load_titles_from_json(json_file)
 
     def add_rules_headers(self,titles):
         current_units = scribus.getUnit()
         scribus.setUnit(scribus.UNIT_POINTS)
         scribus.setActiveLayer('Notes')
         for title in titles:
-            page_number = title['page']+self.rules_start-2
+            page_number = title.page+self.rules_start-2
             scribus.gotoPage(page_number)
             # frame_name = title['title']+' Header'
-            frame_name = scribus.createText(56.58,841.89-title['ypos'],482,45)
-            scribus.setText(title['title'],frame_name)
+            frame_name = scribus.createText(56.58,841.89-title.ypos,482,45)
+            scribus.setText(title.title,frame_name)
             scribus.setParagraphStyle(t9a.HEADER_RULES, frame_name)
         scribus.setUnit(current_units)
         scribus.docChanged(True)
@@ -202,19 +217,19 @@ class ScribusLAB:
         # TODO: adjust size of frame based on number of headers
         text = ""
         char_count = 0
-        # if 2 in [h['level'] for h in headers]:
+        # if 2 in [h.level for h in headers]:
         #     print("We've got an L2!")
         header_details = []
         for i,entry in enumerate(headers):
-            header_detail = (i,char_count,entry['level'],entry['text'],entry['page'])
-            char_count += len(entry['text']) + len(str(entry['page'])) + 2
+            header_detail = (i,char_count,entry.level,entry.text,entry.page)
+            char_count += len(entry.text) + len(str(entry.page)) + 2
             # print(header_detail)
             header_details.append(header_detail)
-            # print(f"{i}:{entry['level']} - ({len(entry['text'])+len(str(entry['page']))+2}) {entry['text']},{entry['page']}")
+            # print(f"{i}:{entry.level} - ({len(entry.text)+len(str(entry.page))+2}) {entry.text},{entry.page}")
         # selectFrameText(19, 1, "TOC_Background")
         # setParagraphStyle("TOC level 2", "TOC_Background")
         for entry in headers:
-            line = f'{entry["text"]}\t{entry["page"]}\n'
+            line = f'{entry.text}\t{entry.page}\n'
             text += line
         scribus.setText(text, frame)
         try:
@@ -246,11 +261,7 @@ class ScribusLAB:
                 start += len(p) + 1
                 continue
             if p_style in heading_styles:
-                headings.append({
-                    'level': heading_styles.index(p_style)+1,
-                    'text': p,
-                    'page': page_number,
-                })
+                headings.append(Header(heading_styles.index(p_style)+1, p, page_number))
             start += len(p) + 1
         # scribus.deselectAll()
         return headings
@@ -284,7 +295,7 @@ class ScribusLAB:
 
     def create_toc_from_sla(self,background=True, rules=True):
         if background:
-            background_headers = self.lab.parse_headers_from_text_sla([t9a.HEADER1,t9a.HEADER2])
+            background_headers = self.lab.parse_header_groups(t9a.HEADER_GROUPS)["background"]
             logging.debug(f"Background headers: {background_headers}")
             self.set_toc_frame("TOC_Background", background_headers, [(1,t9a.TOC1),(2,t9a.TOC2)])
         if rules:
@@ -358,7 +369,7 @@ class ScribusLAB:
 
     def set_footers(self):
         self.remove_footers()
-        background_headers = self.lab.parse_headers_from_text_sla([t9a.HEADER1])
+        background_headers = [h for h in self.lab.parse_header_groups(t9a.HEADER_GROUPS)["background"] if h.level == 1]
         rules_headers = self.parse_headings_frames(range(self.rules_start,self.rules_end),[t9a.HEADER_RULES])
         headers = background_headers + rules_headers
         pages = range(8, scribus.pageCount())
@@ -374,8 +385,8 @@ class ScribusLAB:
                 continue
 
             for x in headers:
-                if x["page"] == page:
-                    current_header = x["text"]
+                if x.page == page:
+                    current_header = x.text
             if "_UD_" in scribus.getDocName():
                 self.create_footer_UD(page, current_header)
             elif "_SE_" in scribus.getDocName():
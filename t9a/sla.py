@@ -1,22 +1,419 @@
 """Contains methods for interacting with the .sla file for a 9th Age Full/Legendary Army Book"""
 
+from contextlib import contextmanager
 from pathlib import Path
-import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import gzip
 import logging
-
-from t9a import EXPECTED_FRAMES, EXPECTED_STYLES, VERSION_FRAME
+import os
+import re
+
+from t9a import EXPECTED_FRAMES, EXPECTED_STYLES, HEADER_GROUPS, VERSION_FRAME
+from t9a.cache import FileCache
+from t9a.records import Header
+from t9a import etree
+from t9a.etree import ET
+
+
+# Sets of DOCUMENT children to keep when loading a file read-only (see SLAFile)
+METADATA_SECTIONS = {"PAGEOBJECT", "STYLE", "LAYERS"} # frames, styles, layers and embedded rules
+HEADER_SECTIONS = {"PAGEOBJECT", "Marks"} # headers and variable text
+FILE_SECTIONS = {"PAGEOBJECT", "MASTEROBJECT"} # image frames on pages and master pages
+CACHED_SECTIONS = METADATA_SECTIONS | HEADER_SECTIONS | FILE_SECTIONS # everything the cached queries need
+MARK_DERIVED_SECTIONS = ("marks", "header_groups") # cache sections computed from the marks, see invalidate_marks()
+MISSING = object() # returned by cache lookups that find nothing, as None can be a cached value
+
+
+# a complete start tag, allowing for '>' inside quoted attribute values
+START_TAG_RE = re.compile(rb"""<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>""")
+ATTRIBUTE_RE = re.compile(rb"""\s([^\s=/>]+)\s*=\s*("[^"]*"|'[^']*')""")
+COPY_CHUNK_SIZE = 1024*1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_gzipped(filename):
+    """Checks whether a file is gzip-compressed (e.g. a .sla.gz saved by Scribus) from its first bytes"""
+    with open(filename, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_sla(filename, mode="rb", compress=None):
+    """Opens a .sla file in binary mode, decompressing or compressing gzipped files as a stream
+
+    Args:
+        filename (string): Full path to file
+        mode (string, optional): "rb" or "wb". Defaults to "rb".
+        compress (bool, optional): When writing, whether to gzip the output. Defaults to compressing if filename ends with .gz
+
+    Returns:
+        file: Binary file object
+    """
+    if mode == "rb":
+        compress = is_gzipped(filename)
+    elif compress is None:
+        compress = str(filename).endswith(".gz")
+    return gzip.open(filename, mode) if compress else open(filename, mode)
+
+
+def strip_sla_suffix(filename):
+    """Returns the filename without its .sla or .sla.gz extension, e.g. for naming exported PDFs"""
+    filename = str(filename)
+    for suffix in (".sla.gz", ".sla"):
+        if filename.lower().endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def escape_attribute(value):
+    """Escapes an attribute value the same way as ElementTree"""
+    for char, entity in (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"), ("\r", "&#13;"), ("\n", "&#10;"), ("\t", "&#09;")):
+        value = value.replace(char, entity)
+    return value
+
+
+def find_start_tags(source, ordinals):
+    """Finds the byte offsets of the start tags of the given elements without building a tree
+
+    Args:
+        source (file): Binary file object positioned at the start of the document
+        ordinals ({int}): Positions of elements in document order (i.e. the order of Element.iter())
+
+    Returns:
+        dict: {ordinal: byte offset of the element's '<'}
+    """
+    parser = xml.parsers.expat.ParserCreate()
+    offsets = {}
+    count = 0
+    def start_element(name, attrs):
+        nonlocal count
+        if count in ordinals:
+            offsets[count] = parser.CurrentByteIndex
+        count += 1
+    parser.StartElementHandler = start_element
+    parser.ParseFile(source)
+    return offsets
+
+
+def patch_attributes(source, output, edits, compress=None):
+    """Copies an XML file, replacing or adding only the given attributes and leaving every other byte untouched.
+    Gzipped files are patched while streaming through the (de)compression, without seeking.
+
+    Args:
+        source (string): File to read
+        output (string): File to write
+        edits (dict): {ordinal: {attribute: value}} where ordinal is the element's position in document order
+        compress (bool, optional): Whether to gzip the output, see open_sla()
+    """
+    with open_sla(source) as f:
+        offsets = find_start_tags(f, set(edits))
+    if len(offsets) != len(edits):
+        raise ValueError(f"Couldn't find all edited elements in {source}")
+    with open_sla(source) as src, open_sla(output, "wb", compress) as out:
+        pending = b"" # bytes read from source but not yet written
+        position = 0 # offset of pending in source
+        for ordinal, offset in sorted(offsets.items(), key=lambda item: item[1]):
+            while position + len(pending) <= offset: # copy everything up to the start tag unchanged
+                out.write(pending)
+                position += len(pending)
+                if not (pending := src.read(COPY_CHUNK_SIZE)):
+                    raise ValueError(f"Unexpected end of file before byte {offset} of {source}")
+            out.write(pending[:offset-position])
+            pending = pending[offset-position:]
+            position = offset
+            while not (match := START_TAG_RE.match(pending)):
+                if not (chunk := src.read(COPY_CHUNK_SIZE)):
+                    raise ValueError(f"Unterminated start tag at byte {offset} of {source}")
+                pending += chunk
+            out.write(patch_start_tag(match[0], edits[ordinal]))
+            pending = pending[match.end():]
+            position += match.end()
+        out.write(pending)
+        while chunk := src.read(COPY_CHUNK_SIZE):
+            out.write(chunk)
+
+
+def patch_start_tag(tag, attributes):
+    """Returns the start tag with the given attributes replaced, or appended if they weren't already present"""
+    attributes = dict(attributes)
+    def replace_value(match):
+        name = match[1].decode("utf-8")
+        if name not in attributes:
+            return match[0]
+        value = escape_attribute(attributes.pop(name)).encode("utf-8")
+        return match[0][:match.start(2)-match.start()] + b'"' + value + b'"'
+    tag = ATTRIBUTE_RE.sub(replace_value, tag)
+    if attributes: # new attributes go before the closing '>' or '/>'
+        end = len(tag) - (2 if tag.endswith(b"/>") else 1)
+        new = b"".join(f' {name}="{escape_attribute(value)}"'.encode("utf-8") for name, value in attributes.items())
+        tag = tag[:end] + new + tag[end:]
+    return tag
 
 
 class InvalidMarkError(Exception):
     pass
 
 
+class ReadOnlyError(Exception):
+    pass
+
+
 class SLAFile:
+    # Attributes that only exist once the document has been parsed (see load())
+    PARSED_ATTRIBUTES = {"tree", "root", "frames", "objects_by_layer", "objects_by_type", "master_objects", "styles", "layers", "marks"}
+
+    def __init__(self, filename, sections=None, keep_text=True, cache=False):
+        """Loads a .sla (or gzipped .sla.gz) file. By default the whole document is parsed and can be edited and saved.
+
+        If sections is given, the file is streamed with iterparse and only the listed DOCUMENT children
+        are kept, everything else (and any inline image data) being discarded as it is read. The result
+        is read-only.
+
+        If cache is True, results of the query methods are stored in a sidecar file next to the .sla
+        (see t9a.cache) and the document is only parsed when a query isn't in the cache. Values for the
+        cache are shared with other callers, so they're computed from all the cached sections and text.
+        The first query that isn't cached fills in the usual queries from that one parse (see fill_cache()),
+        which is then discarded so sections and keep_text still limit what's kept in memory.
 
-    def __init__(self, filename):
+        Args:
+            filename (string): Full path to .sla file
+            sections ({string}, optional): Tags of DOCUMENT children to keep, e.g. METADATA_SECTIONS. Defaults to None (whole document).
+            keep_text (bool or [string], optional): When streaming, keep StoryText for all frames (True), no frames (False), or only the named frames. Defaults to True.
+            cache (bool, optional): Use the sidecar cache. Defaults to False.
+        """
         self.filename = filename
-        self.tree = ET.parse(filename)
-        self.root = self.tree.getroot()
+        self.sections = sections
+        self.keep_text = keep_text
+        self.read_only = sections is not None
+        self.cache = FileCache(filename) if cache else None
+        self.mark_tables = {}
+        self.edit_depth = 0
+        self.pending_output = None
+        self.attribute_edits = {} # element -> {attribute: value}, see set_attribute()
+        self.tree_modified = False
+        self.full_text_depth = 0
+        if self.cache is None:
+            self.load()
+
+    def __getattr__(self, name):
+        # only called for missing attributes, i.e. when the document is needed but hasn't been parsed yet
+        if name in SLAFile.PARSED_ATTRIBUTES:
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(f"'SLAFile' object has no attribute '{name}'")
+
+    def load(self):
+        """Parses the file and builds the lookup tables"""
+        logging.debug(f"Parsing {self.filename}")
+        if self.read_only and self.full_text_depth:
+            # values stored in the cache are shared with other callers, so they must come from the complete set of sections
+            self.root = self.stream_sections(self.sections | CACHED_SECTIONS, True)
+            self.tree = ET.ElementTree(self.root)
+        elif self.read_only:
+            self.root = self.stream_sections(self.sections, self.keep_text)
+            self.tree = ET.ElementTree(self.root)
+        else:
+            self.loaded_stat = self.file_stat()
+            with open_sla(self.filename) as f:
+                self.tree = etree.parse(f)
+            self.root = self.tree.getroot()
+        self.build_indexes()
+
+    def file_stat(self):
+        stat = os.stat(self.filename)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def cached(self, section, name, compute):
+        """Returns a value from the sidecar cache if present, otherwise computes it with compute() and stores it. The cache
+        isn't used while there are unsaved edits, as its values are for the file on disk."""
+        if self.cache is None or self.has_unsaved_edits():
+            return compute()
+        if (value := self.cache.get(section, name, MISSING)) is MISSING:
+            with self.full_text() as reparsed, self.cache.batch():
+                if reparsed:
+                    self.fill_cache()
+                if (value := self.cache.get(section, name, MISSING)) is MISSING:
+                    value = self.cache.set(section, name, compute())
+        return value
+
+    def fill_cache(self):
+        """Computes the values of the usual queries, so that a cold cache costs one parse of the document rather than one
+        for each query. Values the document doesn't have (e.g. a missing frame) are left for the query that asks for them."""
+        queries = [self.test_frames, self.test_styles, self.get_embedded_rules, self.get_rules_page_map,
+                   self.get_linked_files, self.get_marks, lambda: self.get_marks("3"),
+                   lambda: self.parse_header_groups(HEADER_GROUPS)]
+        queries += [lambda layer=layer: self.get_layer_number(layer) for layer in self.layers]
+        queries += [lambda frame=frame: self.get_text(frame) for frame in {*EXPECTED_FRAMES, VERSION_FRAME} if frame in self.frames]
+        for query in queries:
+            try:
+                query()
+            except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+                pass
+
+    @contextmanager
+    def full_text(self):
+        """Parses the cached sections with all their text for the duration of the block, for computing values for the
+        cache, then goes back to the document as loaded with sections and keep_text
+
+        Yields:
+            bool: True if the block has the document to itself, i.e. it was parsed again for this block
+        """
+        complete = not self.read_only or (self.keep_text is True and CACHED_SECTIONS <= self.sections)
+        if complete or self.full_text_depth:
+            yield False
+            return
+        parsed = {name: self.__dict__.pop(name) for name in SLAFile.PARSED_ATTRIBUTES if name in self.__dict__}
+        self.full_text_depth += 1
+        try:
+            yield True
+        finally:
+            self.full_text_depth -= 1
+            for name in SLAFile.PARSED_ATTRIBUTES:
+                self.__dict__.pop(name, None) # the complete document, if it was needed
+            self.__dict__.update(parsed)
+
+    def stream_sections(self, sections, keep_text):
+        """Parses the file with iterparse, clearing elements that aren't needed as soon as they've been read
+
+        Returns:
+            Element: Root of the pruned document
+        """
+        stack = []
+        with open_sla(self.filename) as f:
+            for event, element in etree.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    stack.append(element)
+                    continue
+                stack.pop()
+                if len(stack) != 2 or stack[-1].tag != "DOCUMENT":
+                    continue
+                # element is a direct child of DOCUMENT and has been read completely
+                document = stack[-1]
+                if element.tag not in sections:
+                    document.remove(element)
+                    element.clear()
+                elif element.tag in ("PAGEOBJECT", "MASTEROBJECT"):
+                    element.attrib.pop("ImageData", None) # inline images
+                    if keep_text is True or (keep_text and element.get("ANNAME") in keep_text):
+                        continue
+                    for storytext in element.findall("StoryText"):
+                        element.remove(storytext)
+        return element
+
+    def check_writable(self):
+        if self.read_only:
+            raise ReadOnlyError(f"{self.filename} was loaded read-only")
+
+    @contextmanager
+    def edit(self):
+        """Groups edits so that the file is only written once, when the block ends. Blocks can be nested.
+        If the block raises an exception nothing is written (the changes remain in memory). Saving to two different
+        files in one block raises ValueError, as only one file is written.
+
+        Example:
+            with lab.edit():
+                lab.replace_pdf(new_pdf)
+                lab.set_version(new_version)
+        """
+        self.check_writable()
+        self.edit_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.edit_depth -= 1
+            if self.edit_depth == 0:
+                self.pending_output = None
+            raise
+        self.edit_depth -= 1
+        if self.edit_depth == 0 and self.pending_output:
+            output_file, self.pending_output = self.pending_output, None
+            self.write(output_file)
+
+    def save(self, output_file=None):
+        """Writes the document to its own file or output_file. Inside an edit() block the write is deferred until the block ends,
+        and every save in the block must be to the same file.
+
+        Args:
+            output_file (string, optional): Full path to save a copy of the file. Defaults to None.
+        """
+        self.check_writable()
+        if self.edit_depth:
+            target = output_file or self.filename
+            if self.pending_output and Path(self.pending_output) != Path(target):
+                raise ValueError(f"Can't save to both {self.pending_output} and {target} in one edit() block")
+            self.pending_output = target
+        else:
+            self.write(output_file or self.filename)
+
+    def set_attribute(self, element, name, value):
+        """Sets an attribute of an element and records the change, so that save() can patch just the changed
+        attributes into a copy of the original file instead of re-serialising the whole document.
+        Any other change to the tree must be followed by mark_modified().
+        """
+        element.set(name, value)
+        self.attribute_edits.setdefault(element, {})[name] = value
+
+    def has_unsaved_edits(self):
+        """Checks whether the document in memory has been changed since it was loaded or last saved to its own file"""
+        return self.tree_modified or bool(self.attribute_edits)
+
+    def mark_modified(self):
+        """Records that the tree has been changed other than through set_attribute(), so the whole document must be written"""
+        self.tree_modified = True
+
+    def write(self, filename):
+        """Writes the document to a temporary file and renames it over filename, so that it's never left half-written.
+        If the only changes are attribute edits and the original file hasn't changed on disk, those attributes are
+        patched into a byte-for-byte copy of the original, preserving Scribus' formatting.
+        """
+        temp_file = f"{filename}.temp"
+        # keep a compressed document compressed when saving over it
+        compress = str(filename).endswith(".gz") or (Path(filename) == Path(self.filename) and is_gzipped(self.filename))
+        if self.tree_modified or not self.attribute_edits:
+            with open_sla(temp_file, "wb", compress) as f:
+                self.tree.write(f)
+        elif self.file_stat() != self.loaded_stat:
+            logging.warning(f"{self.filename} has changed on disk since it was loaded, writing the whole document")
+            with open_sla(temp_file, "wb", compress) as f:
+                self.tree.write(f)
+        else:
+            ordinals = {element: ordinal for ordinal, element in enumerate(filter(etree.is_element, self.root.iter())) if element in self.attribute_edits}
+            patch_attributes(self.filename, temp_file, {ordinals[element]: attributes for element, attributes in self.attribute_edits.items()}, compress)
+        os.replace(temp_file, filename)
+        logging.debug(f"Saved {filename}")
+        if Path(filename) == Path(self.filename):
+            # the file on disk now matches the tree
+            self.loaded_stat = self.file_stat()
+            self.attribute_edits = {}
+            self.tree_modified = False
+            self.reset_cache()
+
+    def build_indexes(self):
+        """Builds lookup tables for page objects, master page objects, styles, layers and marks in a single pass over the document.
+        Where names are duplicated the first element is kept, matching the behaviour of ElementTree's find()
+        """
+        self.frames = {} # ANNAME -> PAGEOBJECT
+        self.objects_by_layer = {} # LAYER -> [PAGEOBJECT]
+        self.objects_by_type = {} # PTYPE -> [PAGEOBJECT]
+        self.master_objects = [] # [MASTEROBJECT]
+        self.styles = {} # NAME -> STYLE
+        self.layers = {} # NAME -> LAYERS
+        self.marks = {} # label -> Mark
+        self.mark_tables = {}
+        for element in self.root.find("DOCUMENT"):
+            if element.tag == "PAGEOBJECT":
+                if name := element.get("ANNAME"):
+                    self.frames.setdefault(name, element)
+                self.objects_by_layer.setdefault(element.get("LAYER"), []).append(element)
+                self.objects_by_type.setdefault(element.get("PTYPE"), []).append(element)
+            elif element.tag == "MASTEROBJECT":
+                self.master_objects.append(element)
+            elif element.tag == "STYLE":
+                self.styles.setdefault(element.get("NAME"), element)
+            elif element.tag == "LAYERS":
+                self.layers.setdefault(element.get("NAME"), element)
+            elif element.tag == "Marks":
+                for mark in element:
+                    self.marks.setdefault(mark.get("label"), mark)
 
     def test_frames(self,frames=EXPECTED_FRAMES):
         '''Tests if a list of frames is present in the document. If frames isn't specified, default list of expected frames is used.
@@ -27,11 +424,8 @@ class SLAFile:
         Returns:
             [string]: A list of missing frames    
         '''
-        return [
-            frame
-            for frame in frames
-            if self.root.find(f'./DOCUMENT/PAGEOBJECT[@ANNAME="{frame}"]') is None
-        ]
+        frame_names = set(self.cached("names", "frames", lambda: list(self.frames)))
+        return [frame for frame in frames if frame not in frame_names]
     
     def test_styles(self, styles=EXPECTED_STYLES):
         """
@@ -43,11 +437,8 @@ class SLAFile:
         Returns:
             [string]: A list of missing styles
         """
-        return [
-            style
-            for style in styles
-            if self.root.find(f'./DOCUMENT/STYLE[@NAME="{style}"]') is None
-        ]
+        style_names = set(self.cached("names", "styles", lambda: list(self.styles)))
+        return [style for style in styles if style not in style_names]
 
     def get_layer_number(self,layer):
         """Returns layer number for the given layer name
@@ -58,8 +449,7 @@ class SLAFile:
         Returns:
             string: Layer number
         """        
-        layer = self.root.find(f'./DOCUMENT/LAYERS[@NAME="{layer}"]')
-        return layer.get("NUMMER")
+        return self.cached("layers", layer, lambda: self.layers[layer].get("NUMMER"))
 
     def replace_pdf(self,new_pdf,output_file=None):
         """Replaces embedded rules PDF with new one, optionally saving as a new file
@@ -68,14 +458,12 @@ class SLAFile:
             new_pdf (string): Full path to new rules PDF
             output_file (string, optional): Full path to save new copy of file. Defaults to None.
         """        
+        self.check_writable()
         rules_layer = self.get_layer_number("Rules")
-        for element in self.root.findall(f'./DOCUMENT/PAGEOBJECT[@LAYER="{rules_layer}"]'):
+        for element in self.objects_by_layer.get(rules_layer, []):
             if "PFILE" in element.attrib and element.get("PFILE")[-4:] == ".pdf":
-                element.set("PFILE",str(new_pdf))
-        if output_file:
-            self.tree.write(output_file)
-        else:
-            self.tree.write(self.filename)
+                self.set_attribute(element, "PFILE", str(new_pdf))
+        self.save(output_file)
 
     def get_text(self,frame):
         """Get the text content from a specified text frame
@@ -87,9 +475,7 @@ class SLAFile:
             string: Content of text frame
         """
         # TODO: Get all text in cases of multiple ITEXT nodes
-        element = self.root.find(f'./DOCUMENT/PAGEOBJECT[@ANNAME="{frame}"]')
-        text_box = element.find('StoryText').find('ITEXT')
-        return text_box.get('CH')
+        return self.cached("text", frame, lambda: self.frames[frame].find('StoryText').find('ITEXT').get('CH'))
 
     def set_version(self,version):
         """Set version number text frame to new value
@@ -97,11 +483,12 @@ class SLAFile:
         Args:
             version (string): New version
         """
-        element = self.root.find(f'./DOCUMENT/PAGEOBJECT[@ANNAME="{VERSION_FRAME}"]')
+        self.check_writable()
+        element = self.frames[VERSION_FRAME]
         version_text_box = element.find('StoryText').find('ITEXT')
         current_version = version_text_box.get('CH')
-        version_text_box.set('CH', version)
-        self.tree.write(self.filename)
+        self.set_attribute(version_text_box, 'CH', version)
+        self.save()
         logging.info(f"{self.filename}: Changed {current_version} to {version}")
 
     def get_embedded_rules(self):
@@ -112,9 +499,95 @@ class SLAFile:
         """        
         sla_dir = Path(self.filename).parent
         rules_layer = self.get_layer_number("Rules")
-        element = self.root.find(f'./DOCUMENT/PAGEOBJECT[@LAYER="{rules_layer}"]')
-        if element.get("PFILE")[-4:] == ".pdf":
-            return sla_dir / Path(element.get("PFILE"))
+        pfile = self.cached("rules", "embedded", lambda: self.objects_by_layer[rules_layer][0].get("PFILE"))
+        if pfile and pfile[-4:] == ".pdf":
+            return sla_dir / Path(pfile)
+
+    def get_rules_page_map(self):
+        """Returns which page of the embedded rules PDF is shown on each page of the document, from the image frames on
+        the Rules layer. Scribus stores the page of a PDF shown in a frame in its Pagenumber attribute, counting from 1
+        (0 or no attribute being the first page).
+
+        Returns:
+            [(int, int)]: Sorted (document page, rules PDF page) pairs, both counting from 1. A page shows more than one
+            rules page if it has a pair for each.
+        """
+        rules_layer = self.get_layer_number("Rules")
+        def read_pages():
+            pfile = self.cached("rules", "embedded", lambda: self.objects_by_layer[rules_layer][0].get("PFILE"))
+            return sorted({(int(element.get("OwnPage"))+1, max(1, int(element.get("Pagenumber", 0))))
+                           for element in self.objects_by_layer.get(rules_layer, []) if element.get("PFILE") == pfile})
+        return [tuple(pair) for pair in self.cached("rules", "pages", read_pages)] # stored as lists
+
+    def get_linked_files(self):
+        """Returns the full paths of the files linked to the document's image frames, including those on master pages,
+        e.g. images and the rules PDF
+
+        Returns:
+            [Path]: Linked files, without duplicates
+        """
+        sla_dir = Path(self.filename).parent
+        def read_files():
+            elements = [element for elements in self.objects_by_type.values() for element in elements] + self.master_objects
+            return sorted({element.get("PFILE") for element in elements if element.get("PFILE")})
+        pfiles = self.cached("files", "frames", read_files) # not "linked", which was cached without the master pages
+        return [sla_dir / Path(pfile) for pfile in pfiles]
+
+    def get_marks(self, mark_type=None):
+        """Returns the text values of the marks in the document. Where a label is used more than once the first mark is used.
+
+        Args:
+            mark_type (str, optional): Only include marks of this type, e.g. "3" for Variable Text. Defaults to all marks.
+
+        Returns:
+            dict: {label: text} for every mark
+        """
+        def read_marks():
+            if mark_type is None:
+                return {label: mark.get("str") for label, mark in self.marks.items()}
+            marks = {}
+            for mark in self.root.iterfind("./DOCUMENT/Marks/Mark"):
+                if mark.get("type") == mark_type:
+                    marks.setdefault(mark.get("label"), mark.get("str"))
+            return marks
+        return self.cached("marks", mark_type or "all", read_marks)
+
+    def get_mark_table(self, mark_type=None):
+        """Returns the same as get_marks(), but keeps the table in memory so that repeated lookups are O(1)"""
+        if mark_type not in self.mark_tables:
+            self.mark_tables[mark_type] = self.get_marks(mark_type)
+        return self.mark_tables[mark_type]
+
+    def invalidate_marks(self):
+        """Rebuilds the mark index and discards the mark tables and everything cached from the marks (including the
+        header groups, which contain variable text), so later lookups see the new values. Call after editing Marks in the tree."""
+        self.mark_tables = {}
+        if "root" in self.__dict__:
+            self.marks = {}
+            for mark in self.root.iterfind("./DOCUMENT/Marks/Mark"):
+                self.marks.setdefault(mark.get("label"), mark)
+        if self.cache is not None:
+            for section in MARK_DERIVED_SECTIONS:
+                self.cache.data.pop(section, None)
+            self.cache.save()
+
+    def invalidate_styles(self):
+        """Rebuilds the style index and discards everything cached from the styles (the style names and the header
+        groups, which are found by style), so later lookups see the new names. Call after renaming a STYLE in the tree."""
+        if "root" in self.__dict__:
+            self.styles = {}
+            for style in self.root.iterfind("./DOCUMENT/STYLE"):
+                self.styles.setdefault(style.get("NAME"), style)
+        if self.cache is not None:
+            self.cache.data.get("names", {}).pop("styles", None)
+            self.cache.data.pop("header_groups", None)
+            self.cache.save()
+
+    def reset_cache(self):
+        """Discards cached values after the file has been rewritten"""
+        if self.cache is not None:
+            self.cache.reset()
+        self.mark_tables = {}
 
     def parse_headers(self,styles):
         """Scans file for text frames with given style applied and returns a list of entries with label, text, and page
@@ -122,10 +595,11 @@ class SLAFile:
         Args:
             styles (string): A list of text styles to scan for
         Returns:
-            list: A list of {text:string, page:int} dictionaries
+            [Header]: A list of headers, all at level 1
         """        
         entries = []
-        for element in self.root.findall("./DOCUMENT/PAGEOBJECT[@PTYPE='4']"):
+        lower_styles = {x.lower() for x in styles}
+        for element in self.objects_by_type.get("4", []):
             page = int(element.get("OwnPage"))+1 # Scribus interal page numbers start at 0, so are 1 less than 'real' page numbers 
             for storytext in element:
                 if page > 7: # after Contents page
@@ -133,7 +607,7 @@ class SLAFile:
                     for child in storytext:
                         if (
                             child.tag == "DefaultStyle"
-                            and str(child.get("PARENT")).lower() in [x.lower() for x in styles]
+                            and str(child.get("PARENT")).lower() in lower_styles
                         ):
                             is_header = True
                         if is_header:
@@ -144,9 +618,8 @@ class SLAFile:
                             elif child.tag == "ITEXT":
                                 text = child.get("CH")
                             if text: 
-                                entry = {"text": text, "page": page}
-                                entries.append(entry)
-        return sorted(entries, key=lambda k: k['page'])
+                                entries.append(Header(1, text, page))
+        return sorted(entries, key=lambda k: k.page)
 
     def parse_headers_multilevel(self, style_map):
         """Scans file for text frames with given style applied and returns a list of entries with label, text, and page
@@ -154,10 +627,11 @@ class SLAFile:
         Args:
             style_map: A list of (int,string) tuples of TOC level and style name. E.g. [(1,"HEADER Level 1"),(2,"HEADER Level 2")]
         Returns:
-            list: A list of {"level": int, "text":string, "page":int} dictionaries
+            [Header]: A list of headers
         """
         entries = []
-        for element in self.root.findall("./DOCUMENT/PAGEOBJECT[@PTYPE='4']"):
+        style_levels = {style.lower(): level for level, style in reversed(style_map)} # first entry wins for duplicate styles
+        for element in self.objects_by_type.get("4", []):
             # Scribus interal page numbers start at 0, so are 1 less than 'real' page numbers
             page = int(element.get("OwnPage"))+1
             for storytext in element:
@@ -166,12 +640,10 @@ class SLAFile:
                     for child in storytext:
                         if (
                             child.tag == "DefaultStyle"
-                            # and str(child.get("PARENT")).lower() in [x[1].lower() for x in style_map]
+                            and str(child.get("PARENT")).lower() in style_levels
                         ):
-                            for style in style_map:
-                                if str(child.get("PARENT")).lower() == style[1].lower():
-                                    is_header = True
-                                    level = style[0]
+                            is_header = True
+                            level = style_levels[str(child.get("PARENT")).lower()]
                         if is_header:
                             text = None
                             if child.tag == "MARK":
@@ -180,19 +652,15 @@ class SLAFile:
                             elif child.tag == "ITEXT":
                                 text = child.get("CH")
                             if text:
-                                entry = {"level":level,"text": text, "page": page}
-                                entries.append(entry)
-        return sorted(entries, key=lambda k: k['page'])
+                                entries.append(Header(level, text, page))
+        return sorted(entries, key=lambda k: k.page)
 
 
     def lookup_labels(self,labels):
-        marks = self.root.find("./DOCUMENT/Marks")
+        variable_text = self.get_mark_table("3")
         for entry in labels:
             if entry["label"] != "":
-                entry["text"] = entry["label"]
-                for mark in marks:
-                    if mark.get("type") == "3" and mark.get("label") == entry["label"]:
-                        entry["text"] = mark.get("str")
+                entry["text"] = variable_text.get(entry["label"], entry["label"])
 
         return labels
 
@@ -209,8 +677,8 @@ class SLAFile:
             str: Value of the Variable Text mark
         """
         try:
-            return self.root.find(f'./DOCUMENT/Marks/Mark[@label="{label}"]').get('str')
-        except:
+            return self.get_mark_table()[label]
+        except KeyError:
             raise InvalidMarkError(f"{label} is not a valid Mark")
     
     def parse_headers_from_text_sla(self,header_styles):
@@ -220,10 +688,33 @@ class SLAFile:
             header_styles ([str]): List of style names in hierarchical order (e.g. ["HEADER Level 1", "HEADER Level 2"])
 
         Returns:
-            dict[level,text,page]: list of {"level":int, "text":str, "page":int} header entries
+            [Header]: list of header entries
+        """
+        style_map = {style: ("headers", level) for level, style in enumerate(header_styles, start=1)}
+        return self.parse_header_groups(style_map)["headers"]
+
+    def parse_header_groups(self, style_map):
+        """Searches every text frame once for text formatted with any of the given styles, sorting the headings into groups.
+        Style names are matched case-insensitively.
+
+        Args:
+            style_map (dict): {style name: (group, level)}, e.g. {"HEADER Level 1": ("background", 1), "HEADER Rules": ("rules", 1)}
+
+        Returns:
+            dict: {group: [Header]} with an entry for every group in style_map
         """
-        headers = []
-        elements = sorted(self.root.findall("./DOCUMENT/PAGEOBJECT[@PTYPE='4']"), key=lambda e: (int(e.get("OwnPage")), float(e.get("YPOS"))))
+        key = "|".join(f"{style}={group}:{level}" for style, (group, level) in sorted(style_map.items()))
+        groups = self.cached("header_groups", key, lambda: self.scan_header_groups(style_map))
+        if self.cache is None:
+            return groups
+        # headers come back from the JSON cache as [level, text, page] lists
+        return {group: [Header(*header) for header in headers] for group, headers in groups.items()}
+
+    def scan_header_groups(self, style_map):
+        """Uncached implementation of parse_header_groups()"""
+        styles = {style.lower(): group_level for style, group_level in style_map.items()}
+        groups = {group: [] for group, _ in style_map.values()}
+        elements = sorted(self.objects_by_type.get("4", []), key=lambda e: (int(e.get("OwnPage")), float(e.get("YPOS"))))
 
         for element in elements:
             page = int(element.get("OwnPage"))+1
@@ -256,13 +747,13 @@ class SLAFile:
                             elif child.tag in ["para","trail"]:
                                 style = child.get("PARENT") or frame_style
 
-                    if text and style in header_styles:
-                        level = header_styles.index(style)+1
+                    if text and style and style.lower() in styles:
+                        group, level = styles[style.lower()]
                         text = text.replace('\u00ad', '') # remove hidden soft hyphens
-                        headers.append({"level":level,"text": text, "page": page})
+                        groups[group].append(Header(level, text, page))
                         frame_style = style = None
                         text = None
-        return headers
+        return groups
 
     def check_nopoints(self):
         """Checks if nopoints version of the embedded rules PDF exists in the correct folder
@@ -0,0 +1,227 @@
+"""Contains the client side of the Scribus export worker (t9a_export_server.py): a headless Scribus that stays open and
+exports each document sent to it, so exports don't pay for starting Scribus and scanning fonts every time.
+
+Workers listen on a Unix socket (a named pipe on Windows) numbered by index, so several can run at once. Connections
+must authenticate with a random key made each time the worker is started, which is kept in a file only the current user
+can read (see worker_authkey()), so other users can't send the worker jobs. Messages are JSON objects sent with
+multiprocessing.connection:
+    {"file", "formats", "qualities"}: export a document. The worker replies with a {"event": "progress", "step", "total",
+        "output"} message for each PDF, then {"event": "done", "outputs"} or {"event": "error", "message"}.
+    {"command": "ping"}: replies with {"event": "pong"}
+    {"command": "quit"}: closes Scribus
+"""
+import getpass
+import json
+import logging
+import os
+import queue
+import secrets
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from pathlib import Path
+
+SERVER_SCRIPT = Path(__file__).resolve().parent.parent / "t9a_export_server.py"
+WORKER_START_TIMEOUT = 120 # seconds for Scribus to start and scan fonts
+WORKER_STOP_TIMEOUT = 30
+PING_TIMEOUT = 5 # seconds for a worker to answer before it's taken to be busy exporting
+
+
+class WorkerError(Exception):
+    """An export that failed in the worker"""
+
+
+def worker_dir():
+    """Returns the directory for the worker sockets, keys and logs, which only the current user can use: a t9a-export
+    folder in $XDG_RUNTIME_DIR if it's set, otherwise a t9a-export-<user> folder in the temp directory
+
+    Raises:
+        PermissionError: If the directory already exists but isn't a private directory of the current user (e.g.
+            another user made it, or it's a symlink), as they could then read the keys or pretend to be a worker
+    """
+    if runtime_dir := os.environ.get("XDG_RUNTIME_DIR"):
+        directory = Path(runtime_dir) / "t9a-export"
+    else:
+        directory = Path(tempfile.gettempdir()) / f"t9a-export-{getpass.getuser()}"
+    directory.mkdir(mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{directory} isn't a directory, so can't be used for the Scribus export workers")
+    if sys.platform != "win32" and (info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700):
+        raise PermissionError(f"{directory} must be owned by you and only usable by you (mode 700) to be used for the "
+                              f"Scribus export workers")
+    return directory
+
+
+def worker_address(index=0):
+    """Returns the address that worker number index listens on"""
+    if sys.platform == "win32":
+        return rf"\\.\pipe\t9a-export-{getpass.getuser()}-{index}"
+    return str(worker_dir() / f"export-{index}.sock")
+
+
+def worker_log(index=0):
+    """Returns the file that worker number index writes Scribus' output to"""
+    return worker_dir() / f"export-{index}.log"
+
+
+def worker_key_file(index=0):
+    """Returns the file holding the authentication key of worker number index"""
+    return worker_dir() / f"export-{index}.key"
+
+
+def create_worker_authkey(index=0):
+    """Makes a new random authentication key for worker number index, replacing any previous one
+
+    Returns:
+        bytes: The key
+    """
+    key = secrets.token_bytes(32)
+    key_file = worker_key_file(index)
+    key_file.unlink(missing_ok=True) # so the new file is created with the permissions below
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def worker_authkey(index=0):
+    """Returns the authentication key of worker number index, or None if it hasn't been started"""
+    try:
+        return worker_key_file(index).read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def connect(index=0):
+    """Opens a connection to worker number index
+
+    Raises:
+        ConnectionError: If the worker hasn't been started, or uses a different key (e.g. it was started by another user)
+        OSError: If the worker isn't running
+    """
+    if (authkey := worker_authkey(index)) is None:
+        raise ConnectionRefusedError(f"Scribus export worker {index} hasn't been started")
+    try:
+        return Client(worker_address(index), authkey=authkey)
+    except AuthenticationError as err:
+        raise ConnectionRefusedError(f"Scribus export worker {index} didn't accept the key in {worker_key_file(index)}") from err
+
+
+def send_message(conn, message):
+    conn.send_bytes(json.dumps(message).encode())
+
+
+def receive_message(conn):
+    return json.loads(conn.recv_bytes())
+
+
+def ping(index=0, timeout=PING_TIMEOUT):
+    """Checks whether worker number index is running. Workers handle one connection at a time, so one that's exporting
+    a document doesn't answer until it's finished: a worker that takes the connection but doesn't answer within timeout
+    seconds is taken to be busy, and so running. A worker that isn't running refuses the connection straight away."""
+    answers = queue.Queue()
+
+    def send_ping():
+        try:
+            with connect(index) as conn:
+                send_message(conn, {"command": "ping"})
+                answers.put(receive_message(conn).get("event") == "pong")
+        except (OSError, EOFError, ValueError):
+            answers.put(False)
+    # Client() has no timeout, so wait for it in a thread, which finishes when the worker gets to the ping
+    threading.Thread(target=send_ping, name=f"ping-worker-{index}", daemon=True).start()
+    try:
+        return answers.get(timeout=timeout)
+    except queue.Empty:
+        return True # busy
+
+
+def start_worker(index=0, timeout=WORKER_START_TIMEOUT):
+    """Starts a headless Scribus running the export server as worker number index and waits until it accepts jobs. The
+    worker is given a new authentication key, unless worker number index is already running (e.g. it was left running
+    by another run), in which case it's left alone with the key it has.
+
+    Returns:
+        Popen: The Scribus process, or None if the worker was already running
+
+    Raises:
+        OSError: If Scribus can't be found, exits or doesn't start listening in time
+    """
+    if ping(index): # a new key would lock out the running worker, which would then be left running for good
+        logging.info(f"Scribus export worker {index} is already running")
+        return None
+    if not (scribus_exe := shutil.which("scribus")):
+        raise OSError("Couldn't launch Scribus. Make sure that the scribus executable is in your PATH environment variable")
+    logging.info(f"Starting Scribus export worker {index}")
+    create_worker_authkey(index)
+    with open(worker_log(index), "w") as log_file:
+        process = subprocess.Popen([scribus_exe, "--no-gui", "--no-splash", "-py", str(SERVER_SCRIPT), "--index", str(index)],
+                                   stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while not ping(index):
+        if process.poll() is not None:
+            raise OSError(f"Scribus export worker {index} exited with code {process.returncode}, see {worker_log(index)}")
+        if time.monotonic() > deadline:
+            process.kill()
+            raise OSError(f"Scribus export worker {index} didn't start within {timeout}s, see {worker_log(index)}")
+        time.sleep(0.5)
+    return process
+
+
+def ensure_worker(index=0):
+    """Starts worker number index if it isn't already running (e.g. it hasn't been started yet, or Scribus crashed)
+
+    Returns:
+        Popen: The Scribus process if one was started, otherwise None
+    """
+    return start_worker(index)
+
+
+def stop_worker(index=0, process=None):
+    """Asks worker number index to close Scribus, and waits for process (as returned by start_worker) to exit"""
+    try:
+        with connect(index) as conn:
+            send_message(conn, {"command": "quit"})
+    except (OSError, EOFError):
+        pass # not running
+    if process:
+        try:
+            process.wait(WORKER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def submit_export(filename, formats, qualities, index=0, progress=None):
+    """Exports a document with worker number index and waits for it to finish
+
+    Args:
+        filename (string): .sla file to export
+        formats ([string]): Formats to export, see t9a.export.FORMAT_TYPES
+        qualities ([string]): Qualities to export, see t9a.export.QUALITY_TYPES
+        progress (function, optional): Called with each progress message from the worker
+
+    Returns:
+        [string]: The exported PDFs
+
+    Raises:
+        ConnectionError: If the worker isn't running, doesn't accept the key or stops during the export
+        WorkerError: If the export fails
+    """
+    try:
+        with connect(index) as conn:
+            send_message(conn, {"file": str(Path(filename).resolve()), "formats": list(formats), "qualities": list(qualities)})
+            while (message := receive_message(conn))["event"] == "progress":
+                if progress:
+                    progress(message)
+    except (EOFError, FileNotFoundError) as err:
+        raise ConnectionError(f"Lost connection to Scribus export worker {index}") from err
+    if message["event"] == "error":
+        raise WorkerError(message["message"])
+    return message["outputs"]
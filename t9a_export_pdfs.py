@@ -25,6 +25,7 @@ import datetime
 import shutil
 from pathlib import Path
 import logging
+import json
 
 # log_path = Path(scribus.getDocName()).parent/f'export {datetime.datetime.now().strftime("%Y-%m-%d %H%M%S") }.log'
 log_path = Path(scribus.getDocName()).parent/'export.log' 
@@ -36,7 +37,9 @@ logging.basicConfig(
  )
 
 QUALITY_TYPES = ["high","low","print"]
-FORMAT_TYPES = ["full","nopoints","norules"]
+FORMAT_TYPES = ["full","nopoints","nopoints_patch","norules","norules_patch"]
+
+CONTENTS_PAGE = 7
 
 EXPECTED_FRAMES = ["rules_start", "rules_end", "epilogue_page", "edition", "version_number", "full_title", "norules_title", "nopoints_title", "rules_links"]
 
@@ -85,6 +88,13 @@ QUALITY_PRINT = {
 }
 
 
+def split_sla_suffix(filename):
+    """Splits a document name into its base and extension, treating compressed .sla.gz files as one extension"""
+    if filename.lower().endswith('.sla.gz'):
+        return filename[:-7], filename[-7:]
+    return os.path.splitext(filename)
+
+
 def test_frames():
     missing_frames = []
     try:
@@ -127,7 +137,8 @@ def create_norules():
     now = datetime.datetime.now()
     timestamp = now.strftime('%Y-%m-%dT%H-%M-%S')
     filename = scribus.getDocName()
-    backup_filename = os.path.splitext(filename)[0]+'_backup_'+timestamp+'.sla'
+    base, suffix = split_sla_suffix(filename)
+    backup_filename = base+'_backup_'+timestamp+suffix
     shutil.copy(filename,backup_filename) # don't use scribus built-in savceDocAs(), otherwise it will switch focus to the new file, which we don't want.
 
     # set version string
@@ -181,13 +192,29 @@ def create_norules():
     
     # save _norules version of file
     
-    new_filename = os.path.splitext(filename)[0].replace('_nopoints', '')+'_norules.sla'
+    new_filename = base.replace('_nopoints', '')+'_norules'+suffix
     scribus.saveDocAs(new_filename)
     # shutil.copy(filename,backup_filename)
 
-def export_pdf(filename,quality):
+def get_object_page(name):
+    """Returns the number of the page that an item is on"""
+    for page in range(1, scribus.pageCount()+1):
+        scribus.gotoPage(page)
+        if name in [item[0] for item in scribus.getPageItems()]:
+            return page
+
+def get_norules_patch_pages(rules_start):
+    """Returns the pages of the norules document that look different to the full document once the rules have been
+    removed: the page with the version name, the contents page and the pages after the rules (page numbers)"""
+    pages = {get_object_page("version_name"), CONTENTS_PAGE}
+    pages.update(range(rules_start, scribus.pageCount()+1))
+    return sorted(page for page in pages if page)
+
+def export_pdf(filename,quality,pages=None):
     pdf = scribus.PDFfile()
     pdf.file = filename
+    if pages:
+        pdf.pages = pages
     if quality == "high":
         preset = QUALITY_HIGH
     elif quality == "low":
@@ -312,7 +339,7 @@ def set_filename(filename,format,quality,version=""):
     #     new_filename = f"{os.path.split(filename)[0]}/t9a-fb_lab_{quality}_{army}_{format}_{lang}.pdf" # no version string needed for background book
     # else:
     #     new_filename = f"{os.path.split(filename)[0]}/t9a-fb_lab_{quality}_{army}_{format}_{version}_{lang}.pdf"
-    return f'{os.path.splitext(filename)[0]}_{format}_{quality}.pdf'
+    return f'{split_sla_suffix(filename)[0]}_{format}_{quality}.pdf'
 
 def prepare_format(format):
     pass
@@ -336,14 +363,14 @@ def export_pdfs(formats,qualities):
     num_files = len(formats)*len(qualities)
     scribus.progressTotal(num_files)
 
-    def export_format(format, qualities):
+    def export_format(format, qualities, pages=None):
         global progress_step
         global num_files
         for o in qualities:
             output_file = set_filename(filename,format,o,version_number)
             progress_step += 1
             scribus.statusMessage("Exporting %i of %i: %s" % (progress_step, num_files, output_file))
-            export_pdf(output_file,o)
+            export_pdf(output_file,o,pages)
             scribus.progressSet(progress_step)
 
 
@@ -360,20 +387,38 @@ def export_pdfs(formats,qualities):
         scribus.setTextAlignment(scribus.ALIGN_CENTERED, "version_name")
 
         export_format("nopoints",qualities)
+    if "nopoints_patch" in formats:
+        # only the page with the version name, the rest of the nopoints PDF is made from the full PDF, see t9a.pdf.replace_embedded_pages()
+        version = scribus.getAllText("edition") + ', ' + scribus.getAllText("nopoints_title") + ' version ' + scribus.getAllText("version_number")
+        scribus.setText(version,"version_name")
+        scribus.setTextAlignment(scribus.ALIGN_CENTERED, "version_name")
+
+        pages = [get_object_page("version_name")]
+        with open(f'{split_sla_suffix(filename)[0]}_nopoints_patch.json', 'w') as json_file:
+            json.dump({"pages": pages}, json_file)
+        export_format("nopoints_patch",qualities,pages)
 
-    if "norules" in formats:
+    if "norules" in formats or "norules_patch" in formats:
         # remove rules
         scribus.statusMessage("Removing Rules")
+        rules_start = get_rules_pages()[0]
         create_norules()
-        
-        export_format("norules",qualities)
+
+        if "norules" in formats:
+            export_format("norules",qualities)
+        if "norules_patch" in formats:
+            # only the pages needed to make the norules PDF from the full PDF, see t9a.pdf.remove_page_range()
+            pages = get_norules_patch_pages(rules_start)
+            with open(f'{split_sla_suffix(filename)[0]}_norules_patch.json', 'w') as json_file:
+                json.dump({"pages": pages}, json_file)
+            export_format("norules_patch",qualities,pages)
 
 
 def main(argv):
     global no_export
     global interactive
     if len(argv)==1: # if called from within Scribus or with no arguments
-        new_args = scribus.valueDialog('Set Arguments', 'Set Arguments:\nOptions for --quality: high, low, print\nOptions for --format: full, nopoints, norules', '--quality high low --formats full')
+        new_args = scribus.valueDialog('Set Arguments', 'Set Arguments:\nOptions for --quality: high, low, print\nOptions for --format: full, nopoints, nopoints_patch, norules, norules_patch', '--quality high low --formats full')
         if new_args == '':
             scribus.messageBox("Script Cancelled","Script was cancelled or no arguments were provided")
             return
@@ -386,7 +431,7 @@ def main(argv):
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--quality', nargs='+', help='Which quality types do you want? Available: "high", "low" (RGB) and "print" (CMYK). Defaults to "high".', default="high")
-    parser.add_argument('--formats', '-f', nargs='+', help='Options: "full", "nopoints", and "norules". Default is "full".', default="full")
+    parser.add_argument('--formats', '-f', nargs='+', help='Options: "full", "nopoints", "nopoints_patch", "norules" and "norules_patch" (the patch formats are just the pages needed to derive nopoints or norules from full). Default is "full".', default="full")
     parser.add_argument('--quit', help='Quit Scribus after export (e.g. when called as part of external script)', action="store_true")
     parser.add_argument('--noexport', help="Don't export PDFs, just make the changes to the file and save", action="store_true")
 
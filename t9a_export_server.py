@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Keeps a headless Scribus open and exports the documents sent to it, see t9a.worker for the protocol. Started by
+t9a.worker.start_worker() as:
+
+    scribus --no-gui --no-splash -py t9a_export_server.py --index 0
+"""
+import sys
+
+try:
+    # Please do not use 'from scribus import *' . If you must use a 'from import',
+    # Do so _after_ the 'import scribus' and only import the names you need, such
+    # as commonly used constants.
+    import scribus
+except ImportError as err:
+    print("This Python script is written for the Scribus scripting interface.")
+    print("It can only be run from within Scribus.")
+    sys.exit(1)
+
+import argparse
+import logging
+import os
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+from t9a.export import export_pdfs, FORMAT_TYPES, QUALITY_TYPES
+from t9a.worker import ping, receive_message, send_message, worker_address, worker_authkey, worker_key_file
+
+logging.basicConfig(
+     stream=sys.stdout,
+     level=logging.INFO,
+     format= '[%(asctime)s] %(levelname)s - %(message)s',
+     datefmt='%H:%M:%S'
+ )
+
+
+def check_job(job):
+    """Raises ValueError if a job isn't a file with known formats and qualities"""
+    if not os.path.isfile(job.get("file", "")):
+        raise ValueError(f"Couldn't find file {job.get('file')}")
+    if unknown := [f for f in job.get("formats", []) if f not in FORMAT_TYPES]:
+        raise ValueError(f"{', '.join(unknown)} not valid format(s). Valid formats are: {FORMAT_TYPES}")
+    if unknown := [q for q in job.get("qualities", []) if q not in QUALITY_TYPES]:
+        raise ValueError(f"{', '.join(unknown)} not valid quality(s). Valid qualities are: {QUALITY_TYPES}")
+
+
+def run_job(conn, job):
+    """Opens the document, exports it and closes it without saving, sending progress and the result to conn"""
+    def progress(step, total, output):
+        try:
+            send_message(conn, {"event": "progress", "step": step, "total": total, "output": output})
+        except OSError:
+            pass # the client has gone, but finish the export anyway
+
+    try:
+        check_job(job)
+        logging.info(f"Exporting {job['file']}: {' '.join(job['formats'])} / {' '.join(job['qualities'])}")
+        scribus.openDoc(job["file"])
+        try:
+            outputs = export_pdfs(job["formats"], job["qualities"], progress)
+        finally:
+            if scribus.haveDoc():
+                scribus.closeDoc()
+    except Exception as err:
+        logging.exception(f"Failed to export {job.get('file')}")
+        send_message(conn, {"event": "error", "message": str(err)})
+    else:
+        logging.info(f"Finished exporting {job['file']}")
+        send_message(conn, {"event": "done", "outputs": outputs})
+
+
+def serve(index):
+    """Handles connections one at a time, as Scribus can only work on one document at once, until told to quit. Only
+    connections with the key made by t9a.worker.start_worker() are accepted."""
+    address = worker_address(index)
+    if (authkey := worker_authkey(index)) is None:
+        raise FileNotFoundError(f"Couldn't find the authentication key {worker_key_file(index)}")
+    if os.path.exists(address) and not ping(index): # left behind by a worker that crashed
+        os.remove(address)
+    with Listener(address, authkey=authkey) as listener:
+        logging.info(f"Listening on {address}")
+        while True:
+            try:
+                with listener.accept() as conn:
+                    message = receive_message(conn)
+                    if message.get("command") == "quit":
+                        break
+                    elif message.get("command") == "ping":
+                        send_message(conn, {"event": "pong"})
+                    else:
+                        run_job(conn, message)
+            except (OSError, EOFError, ValueError, AuthenticationError) as err:
+                logging.warning(f"Connection failed: {err}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', type=int, default=0, help='Worker number, which sets the socket or named pipe to listen on')
+    args = parser.parse_args(argv[1:])
+    try:
+        serve(args.index)
+    finally:
+        if scribus.haveDoc():
+            scribus.closeDoc()
+        scribus.fileQuit()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -7,10 +7,20 @@ import shutil
 import sys
 import re
 import logging
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import NamedTuple
 
 import t9a
-from t9a.sla import SLAFile
-from t9a.pdf import add_bookmarks_to_pdf
+from t9a.sla import SLAFile, CACHED_SECTIONS, strip_sla_suffix
+from t9a.pdf import add_bookmarks_to_pdfs, derive_norules_bookmarks, downsample_pdf, remove_page_range, replace_embedded_pages
+from t9a.manifest import BuildManifest
+from t9a.worker import ensure_worker, stop_worker, submit_export
+from t9a.records import Header
 
 
 ### Constants ####
@@ -19,11 +29,17 @@ LOW_DPI = 100
 
 QUALITY_TYPES = ["high","low","print"]
 FORMAT_TYPES = ["full","nopoints","norules"]
+
+MEMORY_PER_JOB = 2 * 1024**3 # rough peak memory of a headless Scribus exporting a LAB, for the default --jobs
+# scripts that the PDFs depend on, for the build manifest. t9a_export_pdfs.py and t9a/export.py include the export presets.
+SCRIPT_FILES = [Path(__file__).resolve(), *(Path(__file__).resolve().with_name(script) for script in ("t9a_export_pdfs.py", "t9a_export_server.py")),
+                *(Path(t9a.__file__).resolve().parent / module for module in ("export.py", "pdf.py", "sla.py", "records.py"))]
+LOG_FORMAT = '[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s'
 ##################
 
 logging.basicConfig(
      level=logging.INFO, 
-     format= '[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
+     format= LOG_FORMAT,
      datefmt='%H:%M:%S'
  )
 
@@ -34,6 +50,42 @@ def dir_path(path):
     else:
         raise argparse.ArgumentTypeError(f"readable_dir:{path} is not a valid path")
 
+def available_memory():
+    """Returns the physical memory available to new processes in bytes, or None if it can't be found"""
+    try:
+        with open("/proc/meminfo") as meminfo: # Linux: includes memory used for caches that can be freed
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if sys.platform == "win32":
+        import ctypes
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)] + [
+                (name, ctypes.c_ulonglong) for name in ("ullTotalPhys", "ullAvailPhys", "ullTotalPageFile", "ullAvailPageFile",
+                                                        "ullTotalVirtual", "ullAvailVirtual", "ullAvailExtendedVirtual")]
+        status = MemoryStatus(dwLength=ctypes.sizeof(MemoryStatus))
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def default_jobs():
+    """Returns how many books to export at once: one per CPU, as long as there's enough memory for each Scribus"""
+    jobs = os.cpu_count() or 1
+    if (memory := available_memory()) is not None:
+        jobs = min(jobs, memory // MEMORY_PER_JOB)
+    return max(1, jobs)
+
+def positive_int(value):
+    if (number := int(value)) < 1:
+        raise argparse.ArgumentTypeError(f"{value} must be at least 1")
+    return number
+
 def run_command(cmd,text=None,details=False):
 
     # TODO: create version to log internal functions as well as external
@@ -55,15 +107,61 @@ def run_command(cmd,text=None,details=False):
     result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
     return result
 
-def generate_pdfs(input): # call Scribus to generate PDFs
-    format_args = ' '.join(args.formats)
-    quality_args = ' '.join(args.quality)
+def deriving():
+    """Checks whether PDFs are made from others exported in this run. With --noexport the existing PDFs (exported or
+    made by an earlier run) are used as they are, as the exports needed to make them weren't done."""
+    return args.derive and not args.noexport
+
+def derived_formats():
+    """Returns the formats that are made from the full PDFs instead of being exported from Scribus"""
+    if not deriving():
+        return []
+    return ["nopoints", "norules"] if args.derive_norules else ["nopoints"]
+
+def export_formats(formats=None):
+    """Returns the formats to export from Scribus to build the given formats (defaults to --formats). Derived formats need
+    the full PDF instead."""
+    formats = list(formats or args.formats)
+    if derived := [f for f in derived_formats() if f in formats]:
+        if "nopoints" in derived:
+            formats[formats.index("nopoints")] = "nopoints_patch" # just the title page
+        if "norules" in derived:
+            formats[formats.index("norules")] = "norules_patch" # just the pages that can't be derived
+        if "full" not in formats:
+            formats.insert(0, "full")
+    return formats
+
+def export_qualities(qualities=None):
+    """Returns the qualities to export from Scribus to build the given qualities (defaults to --quality). Low quality PDFs
+    are derived from the high quality ones."""
+    qualities = list(qualities or args.quality)
+    if deriving() and "low" in qualities:
+        qualities.remove("low")
+        if "high" not in qualities:
+            qualities.insert(0, "high")
+    return qualities
+
+def generate_pdfs(input, formats=None, qualities=None, worker=None): # call Scribus to generate PDFs
+    """Exports the PDFs of a book from Scribus, with the export worker numbered worker (see t9a.worker) if given, otherwise
+    by running t9a_export_pdfs.py in a new Scribus process"""
+    if worker is not None:
+        def log_progress(message):
+            logging.info(f"Exported {message['output']} ({message['step']}/{message['total']})")
+        logging.info(f"Exporting {os.path.basename(input)} with Scribus export worker {worker}")
+        submit_export(input, export_formats(formats), export_qualities(qualities), worker, log_progress)
+        return
+    format_args = ' '.join(export_formats(formats))
+    quality_args = ' '.join(export_qualities(qualities))
     try:
-        run_command(f'scribus "{input}" --no-gui --no-splash -py ./t9a_export_pdfs.py --quit --format {format_args} --quality {quality_args}',
+        result = run_command(f'scribus "{input}" --no-gui --no-splash -py ./t9a_export_pdfs.py --quit --format {format_args} --quality {quality_args}',
                     text=f"Opening {os.path.basename(input)} in Scribus and exporting PDF(s)")
     except OSError as err:
-        print("Couldn't launch Scribus. Make sure that the scribus executable is in your PATH environment variable")
-        sys.exit(1)
+        raise OSError("Couldn't launch Scribus. Make sure that the scribus executable is in your PATH environment variable") from err
+    for output in (result.stdout, result.stderr):
+        if output.strip():
+            logging.info(f"Scribus output for {os.path.basename(input)}:\n{output.rstrip()}")
+    if result.returncode:
+        logging.warning(f"Scribus exited with code {result.returncode} for {input}")
 
 def rename_file(filename, version):
     t9a_pattern = r't9a-fb_lab_(\w+)_(\w+)_v\d+_(\w+)_(\w+)\.pdf'
@@ -92,16 +190,17 @@ def rename_file(filename, version):
 
 def get_bookmarks(sla_file: SLAFile, include_rules: bool=True):
     # TODO: move into package
-    custom_bookmarks = [{"level":"0", "text":"Cover", "page":"1"},{"level":"0", "text":"Credits", "page":"4"},{"level":"0","text":"Contents","page":"7"}] #TODO: parameterise and split into function calls
+    custom_bookmarks = [Header(0, "Cover", 1), Header(0, "Credits", 4), Header(0, "Contents", 7)] #TODO: parameterise and split into function calls
 
-    background_headers = sla_file.parse_headers_from_text_sla([t9a.HEADER1,t9a.HEADER2])
-    rules_headers = sla_file.parse_headers_from_text_sla([t9a.HEADER_RULES])
+    headers = sla_file.parse_header_groups(t9a.HEADER_GROUPS)
+    background_headers = headers["background"]
+    rules_headers = headers["rules"]
         
     # for entry in background_headers + rules_headers:
-    #     entry['level'] += 1
+    #     entry = entry._replace(level=entry.level+1)
     
-    background_entry = [{"level":0, "text":"Background", "page":background_headers[0]['page']}]
-    rules_entry = [{"level":0, "text":"Rules", "page":rules_headers[0]['page']}]
+    background_entry = [Header(0, "Background", background_headers[0].page)]
+    rules_entry = [Header(0, "Rules", rules_headers[0].page)]
 
     bookmarks = custom_bookmarks + background_entry + background_headers + rules_entry + rules_headers
 
@@ -126,32 +225,117 @@ def get_bookmarks(sla_file: SLAFile, include_rules: bool=True):
     # return lookup_labels(labels)
     
 
-def process_pdf(input): # parse TOC and create bookmarks
-
-    sla = SLAFile(input)
+def check_inputs(files):
+    """Raises FileNotFoundError if any of the files that PDFs are derived from are missing, before anything is written"""
+    if missing := [str(f) for f in files if not Path(f).is_file()]:
+        raise FileNotFoundError(f"Can't derive PDFs without {', '.join(missing)}. Export the book again.")
+
+def remove_patch(base, format, qualities):
+    """Removes the patch PDFs and page list exported to derive a format, once every PDF has been made from them (so a run
+    that fails can be repeated)"""
+    for q in qualities:
+        Path(f"{base}_{format}_patch_{q}.pdf").unlink(missing_ok=True)
+    Path(f"{base}_{format}_patch.json").unlink(missing_ok=True)
+
+def derive_low_quality(input, formats=None):
+    """Makes the low quality PDFs from the high quality PDFs exported by Scribus by downsampling their images"""
+    base = strip_sla_suffix(input)
+    check_inputs(f"{base}_{f}_high.pdf" for f in export_formats(formats))
+    for f in export_formats(formats):
+        high_pdf = f"{base}_{f}_high.pdf"
+        low_pdf = f"{base}_{f}_low.pdf"
+        start = time.perf_counter()
+        images = downsample_pdf(high_pdf, low_pdf, LOW_DPI)
+        logging.info(f"Created {low_pdf} from {high_pdf} ({images} images downsampled) in {time.perf_counter()-start:.2f}s")
+
+def derive_nopoints(input, sla: SLAFile, qualities=None):
+    """Makes the nopoints PDFs from the full PDFs by swapping the embedded rules pages for the nopoints rules PDF and the
+    title page for the one from the nopoints_patch export (see t9a.pdf.replace_embedded_pages())"""
+    qualities = qualities or args.quality
+    rules = sla.get_embedded_rules()
+    nopoints_rules = rules.with_name(f"{rules.stem}_nopoints.pdf")
+    base = strip_sla_suffix(input)
+    check_inputs([nopoints_rules, f"{base}_nopoints_patch.json"] +
+                 [f"{base}_{f}_{q}.pdf" for q in qualities for f in ["full", "nopoints_patch"]])
+    page_map = sla.get_rules_page_map()
+    with open(f"{base}_nopoints_patch.json") as json_file:
+        patch_pages = json.load(json_file)["pages"]
+    for q in qualities:
+        full_pdf = f"{base}_full_{q}.pdf"
+        nopoints_pdf = f"{base}_nopoints_{q}.pdf"
+        start = time.perf_counter()
+        pages = replace_embedded_pages(full_pdf, nopoints_rules, page_map, nopoints_pdf, rules, f"{base}_nopoints_patch_{q}.pdf", patch_pages)
+        logging.info(f"Created {nopoints_pdf} from {full_pdf} ({pages} rules pages replaced) in {time.perf_counter()-start:.2f}s")
+    remove_patch(base, "nopoints", qualities)
+
+def derive_norules(input, sla: SLAFile, qualities=None):
+    """Makes the norules PDFs from the full PDFs by removing the rules pages and swapping in the pages from the norules_patch
+    export whose content changes (see t9a.pdf.remove_page_range())"""
+    qualities = qualities or args.quality
+    base = strip_sla_suffix(input)
+    check_inputs([f"{base}_norules_patch.json"] + [f"{base}_{f}_{q}.pdf" for q in qualities for f in ["full", "norules_patch"]])
+    rules_start = int(sla.get_text("rules_start"))
+    rules_end = int(sla.get_text("rules_end"))
+    with open(f"{base}_norules_patch.json") as json_file:
+        patch_pages = json.load(json_file)["pages"]
+    for q in qualities:
+        full_pdf = f"{base}_full_{q}.pdf"
+        norules_pdf = f"{base}_norules_{q}.pdf"
+        start = time.perf_counter()
+        remove_page_range(full_pdf, rules_start, rules_end, norules_pdf, f"{base}_norules_patch_{q}.pdf", patch_pages)
+        logging.info(f"Created {norules_pdf} from {full_pdf} (pages {rules_start}-{rules_end} removed) in {time.perf_counter()-start:.2f}s")
+    remove_patch(base, "norules", qualities)
+
+def process_pdf(input, formats=None, qualities=None): # parse TOC and create bookmarks
+    """Derives, renames and bookmarks the PDFs of a book in the given formats and qualities (default --formats and --quality)
+
+    Returns:
+        {string: string}: Bookmarked PDF for each "<format>_<quality>" built
+    """
+    formats = formats or args.formats
+    qualities = qualities or args.quality
+
+    sla = SLAFile(input, sections=CACHED_SECTIONS, cache=True)
     version = sla.get_text("version_number")
 
-    files = []
-    if "high" or "low" in args.quality:
-        if "full" or "nopoints" in args.formats:
+    if deriving() and "low" in qualities:
+        derive_low_quality(input, formats)
+    if "nopoints" in formats and "nopoints" in derived_formats():
+        derive_nopoints(input, sla, qualities)
+    if "norules" in formats and "norules" in derived_formats():
+        derive_norules(input, sla, qualities)
+
+    files = {}
+    if "high" or "low" in qualities:
+        if "full" or "nopoints" in formats:
             full_bookmarks = get_bookmarks(sla, include_rules=True)
-        if "norules" in args.formats:
-            input_norules = str(Path(input).parents[0] / Path(input).stem) + "_norules.sla"
-            logging.info(f"Getting bookmarks from: {input_norules}")
-            norules_sla = SLAFile(input_norules)
-            norules_bookmarks = get_bookmarks(norules_sla, include_rules=False)
-
-        for q in args.quality:
-            for f in args.formats:
-                original_pdf = f"{os.path.splitext(input)[0]}_{f}_{q}.pdf"
+        if "norules" in formats:
+            norules_bookmarks = derive_norules_bookmarks(full_bookmarks, int(sla.get_text("rules_start")), int(sla.get_text("rules_end")))
+
+        full_pdfs = []
+        norules_pdfs = []
+        artifacts = {}
+        for q in qualities:
+            for f in formats:
+                original_pdf = f"{strip_sla_suffix(input)}_{f}_{q}.pdf"
                 new_pdf = rename_file(original_pdf,version)
                 shutil.copy(original_pdf,new_pdf)
-                files.append(new_pdf)
+                artifacts[new_pdf] = f"{f}_{q}"
                 if f in ["full","nopoints"]:
-                    add_bookmarks_to_pdf(new_pdf,full_bookmarks)
+                    full_pdfs.append(new_pdf)
                 else:
-                    add_bookmarks_to_pdf(new_pdf,norules_bookmarks)
-    if "print" in args.quality:
+                    norules_pdfs.append(new_pdf)
+
+        # each new_pdf is our own copy, so the bookmarks can be appended to it rather than rewriting it
+        results = add_bookmarks_to_pdfs(full_pdfs, full_bookmarks, incremental=True) if full_pdfs else []
+        if norules_pdfs:
+            results += add_bookmarks_to_pdfs(norules_pdfs, norules_bookmarks, incremental=True)
+        for result in results:
+            if result.error:
+                logging.error(f"Leaving out {result.filename}, it has no bookmarks")
+            else:
+                files[artifacts[result.filename]] = result.filename
+    if "print" in qualities:
         # no need for bookmarks in print version
         pass
 
@@ -175,8 +359,213 @@ def create_nopoints(input):
     run_command(cmd,False,"Creating nopoints version of file")
 
 
-def main(argv):
-    global args
+class BookLog(logging.Filter):
+    """Copies the log messages logged while working on a book to <name>_generate.log next to its .sla file, whichever
+    thread they're logged from"""
+    def __init__(self, job):
+        super().__init__()
+        self.threads = set()
+        self.handler = logging.FileHandler(f"{strip_sla_suffix(job)}_generate.log", mode="w", delay=True)
+        self.handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt='%H:%M:%S'))
+        self.handler.addFilter(self)
+        logging.getLogger().addHandler(self.handler)
+
+    def filter(self, record):
+        return record.thread in self.threads
+
+    @contextmanager
+    def capture(self):
+        """Logs messages from the current thread to the book's log until the end of the with block"""
+        self.threads.add(threading.get_ident())
+        try:
+            yield
+        finally:
+            self.threads.discard(threading.get_ident())
+
+    def close(self):
+        logging.getLogger().removeHandler(self.handler)
+        self.handler.close()
+
+class Progress:
+    """Counts the books through the export and processing stages and logs the overall progress"""
+    def __init__(self, total):
+        self.total = total
+        self.exported = 0
+        self.processed = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def update(self, job, stage, error=None):
+        with self.lock:
+            if error:
+                self.failed.append(job)
+                message = f"Failed to {stage}"
+            elif stage == "skip": # already up to date
+                self.exported += 1
+                self.processed += 1
+                message = "Nothing to build for"
+            else:
+                setattr(self, f"{stage}ed", getattr(self, f"{stage}ed") + 1)
+                message = f"Finished {stage}ing"
+            logging.info(f"[{self.exported}/{self.total} exported, {self.processed}/{self.total} processed, {len(self.failed)} failed] "
+                         f"{message} {job}")
+
+class BookPlan(NamedTuple):
+    """What to build for a book: the formats and qualities of its PDFs that are out of date"""
+    formats: list
+    qualities: list
+    inputs: dict # {"<format>_<quality>": inputs hash} of the PDFs to record in the build manifest
+
+def build_inputs(job, sla: SLAFile):
+    """Returns the files that a book's PDFs are built from: the document, the images and PDFs linked to it, the nopoints
+    rules PDF and the scripts that export and process it (which include the export presets)"""
+    files = [Path(job), *sla.get_linked_files(), *SCRIPT_FILES]
+    if rules := sla.get_embedded_rules():
+        files.append(rules.with_name(f"{rules.stem}_nopoints.pdf"))
+    return files
+
+def plan_book(job):
+    """Works out which of a book's PDFs need building by comparing the hash of their inputs with the build manifest
+    (see t9a.manifest), so unchanged PDFs aren't exported again.
+
+    Returns:
+        BookPlan: PDFs to build, or None if they're all up to date
+    """
+    if args.noexport or args.noprocess: # only part of the build, so nothing to compare or record
+        return BookPlan(args.formats, args.quality, {})
+    manifest = BuildManifest(job)
+    files = build_inputs(job, SLAFile(job, sections=CACHED_SECTIONS, cache=True))
+    inputs = {(f, q): manifest.inputs_hash(files, {"format": f, "quality": q, "derive": args.derive, "derive_norules": args.derive_norules, "low_dpi": LOW_DPI})
+              for f in args.formats for q in args.quality}
+    output_dir = Path(args.dest or Path(job).parent)
+    stale = []
+    for (f, q), digest in inputs.items():
+        if args.force or not manifest.is_current(f"{f}_{q}", digest):
+            stale.append((f, q))
+        elif (output := manifest.output(f"{f}_{q}")).parent.resolve() != output_dir.resolve():
+            # up to date, but built for another destination
+            logging.info(f"Copying {output} to {output_dir}")
+            shutil.copy2(output, output_dir / output.name)
+            manifest.record(f"{f}_{q}", digest, output_dir / output.name)
+    manifest.save() # keep the file hashes and copies for next time
+    if not stale:
+        return None
+    formats = [f for f in args.formats if any(f == stale_format for stale_format, _ in stale)]
+    qualities = [q for q in args.quality if any(q == stale_quality for _, stale_quality in stale)]
+    logging.info(f"Building {', '.join(f'{f}_{q}' for f, q in stale)} for {job}")
+    return BookPlan(formats, qualities, {f"{f}_{q}": inputs[(f, q)] for f in formats for q in qualities})
+
+class ExportWorkers:
+    """Scribus export workers (see t9a.worker) shared by the export threads, each used for one book at a time. Workers are
+    only started when a book needs exporting, so nothing is started if every book is up to date, and a worker is started
+    again if Scribus has crashed. Workers that were already running are left running."""
+    def __init__(self, count):
+        self.idle = queue.Queue()
+        for index in range(count):
+            self.idle.put(index)
+        self.started = {} # index -> Popen of the workers started here
+
+    @contextmanager
+    def worker(self):
+        index = self.idle.get()
+        try:
+            if process := ensure_worker(index):
+                self.started[index] = process
+            yield index
+        finally:
+            self.idle.put(index)
+
+    def close(self, keep=False):
+        """Stops the workers started here, unless keep is set"""
+        if keep:
+            return
+        for index, process in self.started.items():
+            logging.info(f"Stopping Scribus export worker {index}")
+            stop_worker(index, process)
+
+def export_book(job, workers: ExportWorkers = None):
+    """Exports the out of date PDFs of a book from Scribus, using one of workers if given
+
+    Returns:
+        BookPlan: PDFs to process, or None if they're all up to date
+    """
+    if (plan := plan_book(job)) is None:
+        return None
+    if not args.noexport:
+        logging.info(f"Opening Scribus with file {job}")
+        if workers:
+            with workers.worker() as worker:
+                generate_pdfs(job, plan.formats, plan.qualities, worker)
+        else:
+            generate_pdfs(job, plan.formats, plan.qualities)
+        logging.info(f"Done with Scribus for file: {job}")
+    return plan
+
+def process_book(job, plan: BookPlan):
+    if not args.noprocess:
+        logging.info(f"Processing file {job}")
+        new_files = process_pdf(job, plan.formats, plan.qualities)
+        if args.dest:
+            logging.info(f"Moving files to {args.dest}")
+            move_pdfs(new_files.values(),args.dest)
+            new_files = {artifact: f"{args.dest}/{os.path.basename(f)}" for artifact, f in new_files.items()}
+        if plan.inputs:
+            manifest = BuildManifest(job)
+            for artifact, f in new_files.items():
+                manifest.record(artifact, plan.inputs[artifact], f)
+            manifest.save()
+
+def run_stage(stage, job, log: BookLog, *stage_args):
+    """Runs export_book or process_book for a book, logging any error to the book's log before raising it"""
+    with log.capture():
+        try:
+            return {"export": export_book, "process": process_book}[stage](job, *stage_args)
+        except Exception:
+            logging.exception(f"Failed to {stage} {job}")
+            raise
+
+def run_pipeline(jobs, workers, export_workers: ExportWorkers = None):
+    """Exports the books with up to workers Scribus processes at once (export_workers if given). Each book's PDFs are processed (derived,
+    bookmarked and moved) in another thread as soon as it's exported, while the next books are still exporting.
+
+    Returns:
+        [string]: Books that failed
+    """
+    logs = {job: BookLog(job) for job in jobs}
+    progress = Progress(len(jobs))
+    exported = queue.Queue() # (book, plan) ready to process, then None when all exports are done
+
+    def process_exported():
+        while (item := exported.get()) is not None:
+            job, plan = item
+            try:
+                run_stage("process", job, logs[job], plan)
+                progress.update(job, "process")
+            except Exception as err:
+                progress.update(job, "process", err)
+
+    consumer = threading.Thread(target=process_exported, name="process")
+    consumer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export") as pool:
+            futures = {pool.submit(run_stage, "export", job, logs[job], export_workers): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                if future.exception():
+                    progress.update(job, "export", future.exception())
+                elif (plan := future.result()) is None:
+                    progress.update(job, "skip")
+                else:
+                    progress.update(job, "export")
+                    exported.put((job, plan))
+    finally:
+        exported.put(None)
+        consumer.join()
+        for log in logs.values():
+            log.close()
+    return progress.failed
+
+def build_parser():
     parser = argparse.ArgumentParser()
     # parser.add_argument("input", help=".sla files")
     parser.add_argument('file', type=argparse.FileType('r'), nargs='+')
@@ -185,33 +574,42 @@ def main(argv):
     parser.add_argument('--formats', '-f', nargs='+', help='Options: "full", "nopoints", and "norules". Default is "full".', default=["full", "nopoints"])
     parser.add_argument('--quality', '-q', nargs='+', help='Which qualities of file do you want? Available: "high", "low", and "print". Defaults to "high" and "low"', default=["high", "low"])
     parser.add_argument('--dest','-d', help='destination directory',type=dir_path)
+    parser.add_argument('--derive', help='Make the nopoints PDFs from the full PDFs, and the low quality PDFs from the high quality PDFs, instead of exporting them all from Scribus. Default is on.', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--derive-norules', help='With --derive, also make the norules PDFs from the full PDFs and a small export of the pages that change. Links on those pages to pages that weren\'t exported with them are dropped. Default is off.', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--jobs', '-j', help='Number of books to export at once. Defaults to the number of CPUs, fewer if there isn\'t enough memory for that many Scribus processes.', type=positive_int, default=None)
+    parser.add_argument('--worker', help='Export with persistent headless Scribus processes that are sent each book in turn (see t9a_export_server.py), instead of starting Scribus for every book. Only connections with the key made when a worker starts are accepted. Default is off.', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--keep-workers', help='Leave the Scribus export workers running when finished, for the next run to use.', action="store_true", default=False)
+    parser.add_argument('--force', help='Build all the PDFs, even those whose inputs haven\'t changed since they were last built.', action="store_true", default=False)
     parser.add_argument('--details', action="store_true", default=False)
     parser.add_argument('--year', '-y')
     parser.add_argument('--version', '-v')
-    args = parser.parse_args(argv)
+    return parser
+
+def main(argv):
+    global args
+    args = build_parser().parse_args(argv)
 
     # TODO: Validate format and quality options (using type= and functions) 
 
     # print(args.formats)
     # print(args.quality)
 
-    for f in args.file:
-        job = f.name
-        if not args.noexport:
-            logging.info(f"Opening Scribus with file {job}")
-            generate_pdfs(job) # TODO: maybe parallelise
-            logging.info(f"Done with Scribus for file: {job}")
-        if not args.noprocess:
-            logging.info(f"Processing file {job}")
-            new_files = process_pdf(job)
-            if args.dest:
-                print(f"Moving files to {args.dest}")
-                move_pdfs(new_files,args.dest)
+    jobs = [f.name for f in args.file]
+    workers = min(args.jobs or default_jobs(), len(jobs))
+    logging.info(f"Building {len(jobs)} book(s), {workers} at a time")
+    export_workers = ExportWorkers(workers) if args.worker and not args.noexport else None
+    try:
+        failed = run_pipeline(jobs, workers, export_workers)
+    finally:
+        if export_workers:
+            export_workers.close(args.keep_workers)
 
     # All done
     now = datetime.now()
-    time = now.strftime("%H:%M:%S")
-    print(f"{time}: Completed")
+    if failed:
+        print(f"{now.strftime('%H:%M:%S')}: Completed with {len(failed)} failed book(s): {', '.join(failed)}")
+        sys.exit(1)
+    print(f"{now.strftime('%H:%M:%S')}: Completed")
 
 
 if __name__ == '__main__':
@@ -59,13 +59,11 @@ def export_menu():
 
     def set_rules_headers():
         rules_pdf = Path(lab.get_embedded_rules())
-        # json_file = rules.parents[1] / Path(rules.name).with_suffix(".json")
-        json_file = rules_pdf.with_suffix(".json")
-        if not Path(json_file).is_file():
-            scribus.messageBox("Couldn't find JSON file",f"Couldn't find {json_file}. Please run get_rules_json.py externally and try again")
-            raise FileNotFoundError(f"Couldn't find {json_file}. Please run get_rules_json.py externally and try again")
         try:
-            titles = lab.load_titles_from_json(json_file)
+            titles = lab.load_rules_titles(rules_pdf)
+        except FileNotFoundError as err:
+            scribus.messageBox("Couldn't find JSON file", str(err))
+            raise
         except Exception as err:
             scribus.messageBox("Error loading JSON file", err)
             return
@@ -246,7 +244,7 @@ def export_menu():
 def main():
     doc_name = Path(scribus.getDocName())
     logging.debug("\n\n*******************************\nn)")
-    if doc_name.suffix != ".sla":
+    if not doc_name.name.lower().endswith((".sla", ".sla.gz")):
         scribus.messageBox("File not found", f"{doc_name} is not a valid .sla file. This script should only be run with an open T9A LAB file.")
         return
     
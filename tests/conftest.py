@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1])) # needed to run from subdirectory
+
+# the other scripts in this folder are run by hand on a real .sla or PDF (e.g. python tests/test_bookmarks.py file.sla)
+collect_ignore = [
+    "test_bookmarks.py",
+    "test_marks.py",
+    "test_parse_headings.py",
+    "test_remove_all.py",
+    "test_remove_footers.py",
+    "test_remove_hyperlinks.py",
+    "test_remove_rules_headers.py",
+    "test_sla_styles_frames.py",
+    "test_styles.py",
+]
@@ -5,6 +5,7 @@ from tabulate import tabulate
 
 sys.path.append(str(Path(__file__).parents[1])) # needed to run from subdirectory
 from t9a.pdf import add_bookmarks_to_pdf
+from t9a.records import Header
 from t9a.sla import SLAFile
 from t9a_generate_labs import get_bookmarks
 
@@ -15,7 +16,7 @@ output_pdf = input_pdf.with_name(f"{input_pdf.stem}_bookmarked.pdf")
 lab = SLAFile(sla_file)
 
 bookmarks = get_bookmarks(lab)
-print(tabulate(bookmarks, tablefmt='simple'))
+print(tabulate(bookmarks, headers=Header._fields, tablefmt='simple'))
 
 try:
     add_bookmarks_to_pdf(input_pdf,bookmarks,output_pdf)
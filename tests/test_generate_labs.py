@@ -0,0 +1,149 @@
+"""Tests for how t9a_generate_labs.py decides what to export from Scribus and what to derive. Run with python -m pytest tests"""
+import json
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+
+import t9a_generate_labs
+from t9a.records import Header
+
+BOOK = "t9a-fb_lab_id_en_v1"
+
+
+class FakeSLA:
+    """Stands in for the SLAFile of a book, which process_pdf() only needs the version and bookmarks of"""
+    rules = None # embedded rules PDF
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_text(self, frame):
+        return {"version_number": "1.0", "rules_start": "3", "rules_end": "4"}[frame]
+
+    def get_embedded_rules(self):
+        return self.rules
+
+    def get_rules_page_map(self):
+        return [(3, 1), (4, 2)]
+
+    def get_linked_files(self):
+        return []
+
+
+def parse_args(*argv):
+    t9a_generate_labs.args = t9a_generate_labs.build_parser().parse_args(list(argv))
+    return t9a_generate_labs.args
+
+
+@pytest.fixture
+def book(tmp_path, monkeypatch):
+    sla = tmp_path / f"{BOOK}.sla"
+    sla.write_text("")
+    monkeypatch.setattr(t9a_generate_labs, "SLAFile", FakeSLA)
+    monkeypatch.setattr(FakeSLA, "rules", tmp_path / "rules.pdf")
+    monkeypatch.setattr(t9a_generate_labs, "get_bookmarks", lambda sla, include_rules=True: [Header(0, "Cover", 1)])
+    return sla
+
+
+def make_pdf(filename, pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(595, 842)
+    with open(filename, "wb") as pdf_file:
+        writer.write(pdf_file)
+
+
+def test_noexport_keeps_existing_pdfs(book, tmp_path, monkeypatch):
+    args = parse_args(str(book), "--noexport")
+    assert args.derive # the default
+    assert t9a_generate_labs.derived_formats() == []
+    assert t9a_generate_labs.export_formats() == ["full", "nopoints"]
+    assert t9a_generate_labs.export_qualities() == ["high", "low"]
+
+    # PDFs exported by Scribus in an earlier run, with no patch exports next to them
+    exported = {}
+    for pages, f in enumerate(["full", "nopoints"], 1):
+        for q in ["high", "low"]:
+            make_pdf(tmp_path / f"{BOOK}_{f}_{q}.pdf", pages)
+            exported[tmp_path / f"{BOOK}_{f}_{q}.pdf"] = (tmp_path / f"{BOOK}_{f}_{q}.pdf").read_bytes()
+
+    files = t9a_generate_labs.process_pdf(str(book))
+
+    assert sorted(files) == ["full_high", "full_low", "nopoints_high", "nopoints_low"]
+    for pdf, data in exported.items():
+        assert pdf.read_bytes() == data
+    assert len(PdfReader(files["nopoints_low"]).pages) == 2
+
+
+def test_export_derives(book):
+    parse_args(str(book), "--formats", "full", "nopoints", "norules")
+    assert t9a_generate_labs.derived_formats() == ["nopoints"]
+    assert t9a_generate_labs.export_formats() == ["full", "nopoints_patch", "norules"]
+    assert t9a_generate_labs.export_qualities() == ["high"]
+
+
+def make_nopoints_inputs(tmp_path, patch_json=True):
+    """Makes the files that the nopoints PDFs are derived from, as exported by Scribus"""
+    make_pdf(tmp_path / "rules_nopoints.pdf", 2)
+    for q in ["high", "low"]:
+        make_pdf(tmp_path / f"{BOOK}_full_{q}.pdf", 5)
+        make_pdf(tmp_path / f"{BOOK}_nopoints_patch_{q}.pdf", 1)
+    if patch_json:
+        (tmp_path / f"{BOOK}_nopoints_patch.json").write_text(json.dumps({"pages": [1]}))
+    return [tmp_path / f"{BOOK}_nopoints_patch_{q}.pdf" for q in ["high", "low"]] + [tmp_path / f"{BOOK}_nopoints_patch.json"]
+
+
+def test_derive_nopoints_missing_input(book, tmp_path, monkeypatch):
+    parse_args(str(book))
+    make_nopoints_inputs(tmp_path, patch_json=False)
+    monkeypatch.setattr(t9a_generate_labs, "replace_embedded_pages", lambda *args: pytest.fail("derived without the page list"))
+
+    with pytest.raises(FileNotFoundError, match="nopoints_patch.json"):
+        t9a_generate_labs.derive_nopoints(str(book), FakeSLA())
+
+    assert (tmp_path / f"{BOOK}_nopoints_patch_high.pdf").exists()
+
+
+def test_derive_nopoints_keeps_patch_until_done(book, tmp_path, monkeypatch):
+    parse_args(str(book))
+    patch = make_nopoints_inputs(tmp_path)
+    made = []
+
+    def replace_embedded_pages(full_pdf, rules_pdf, page_map, output_filename, *args):
+        if made and fail:
+            raise ValueError("Couldn't find the rules")
+        make_pdf(output_filename, 5)
+        made.append(output_filename)
+        return 2
+    monkeypatch.setattr(t9a_generate_labs, "replace_embedded_pages", replace_embedded_pages)
+
+    fail = True
+    with pytest.raises(ValueError):
+        t9a_generate_labs.derive_nopoints(str(book), FakeSLA())
+    assert all(f.exists() for f in patch) # so the run can be repeated
+
+    fail = False
+    made.clear()
+    t9a_generate_labs.derive_nopoints(str(book), FakeSLA())
+    assert len(made) == 2
+    assert not any(f.exists() for f in patch)
+
+
+def test_new_destination_gets_current_pdfs(book, tmp_path):
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    parse_args(str(book), "--formats", "full", "--quality", "high", "--dest", str(first))
+    plan = t9a_generate_labs.plan_book(str(book))
+    assert plan.formats == ["full"]
+    # as if process_book() had built and moved the PDF
+    manifest = t9a_generate_labs.BuildManifest(book)
+    make_pdf(first / f"{BOOK}_full_high.pdf", 1)
+    manifest.record("full_high", plan.inputs["full_high"], first / f"{BOOK}_full_high.pdf")
+    manifest.save()
+    assert t9a_generate_labs.plan_book(str(book)) is None
+
+    parse_args(str(book), "--formats", "full", "--quality", "high", "--dest", str(second))
+    assert t9a_generate_labs.plan_book(str(book)) is None
+    assert (second / f"{BOOK}_full_high.pdf").read_bytes() == (first / f"{BOOK}_full_high.pdf").read_bytes()
+    assert t9a_generate_labs.BuildManifest(book).output("full_high") == second / f"{BOOK}_full_high.pdf"
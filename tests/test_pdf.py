@@ -0,0 +1,348 @@
+"""Tests for the functions in t9a.pdf that edit PDFs with pypdf's internals (see PdfInternals). Run with python -m pytest tests"""
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, FloatObject, NameObject, TextStringObject
+
+import t9a.pdf
+from t9a.pdf import UnsupportedPypdfError, add_bookmarks_to_pdf, add_bookmarks_to_pdfs, downsample_pdf, get_titles_async, match_titles, remove_page_range, replace_embedded_pages
+from t9a.records import Header
+
+
+def make_pdf(filename, pages, bookmarks=()):
+    """Writes a PDF of blank pages, with top-level bookmarks given as (title, page number starting at 1)"""
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(595, 842)
+    for title, page in bookmarks:
+        writer.add_outline_item(title, page-1)
+    with open(filename, "wb") as pdf_file:
+        writer.write(pdf_file)
+
+
+def add_link(writer, page, rect, target):
+    """Adds a link to a page of writer that goes to the page numbered target (starting at 1), a named destination or a URL"""
+    link = DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject("/Link"),
+        NameObject("/Rect"): ArrayObject(FloatObject(value) for value in rect),
+    })
+    if isinstance(target, int):
+        action = {NameObject("/S"): NameObject("/GoTo"),
+                  NameObject("/D"): ArrayObject([writer.pages[target-1].indirect_reference, NameObject("/Fit")])}
+    elif target.startswith("http"):
+        action = {NameObject("/S"): NameObject("/URI"), NameObject("/URI"): TextStringObject(target)}
+    else:
+        action = {NameObject("/S"): NameObject("/GoTo"), NameObject("/D"): TextStringObject(target)}
+    link[NameObject("/A")] = DictionaryObject(action)
+    writer.add_annotation(page-1, link)
+
+
+def read_links(filename, page):
+    """Returns the links on a page as (rect, page number starting at 1, named destination or URL)"""
+    reader = PdfReader(filename)
+    links = []
+    for reference in reader.pages[page-1].get("/Annots", []):
+        annotation = reference.get_object()
+        if "/Dest" in annotation:
+            target = reader.get_page_number(annotation["/Dest"][0].get_object()) + 1
+        elif annotation["/A"]["/S"] == "/GoTo" and not isinstance(annotation["/A"]["/D"], ArrayObject):
+            target = str(annotation["/A"]["/D"]) # named destination
+        elif annotation["/A"]["/S"] == "/GoTo":
+            target = reader.get_page_number(annotation["/A"]["/D"][0].get_object()) + 1
+        else:
+            target = annotation["/A"]["/URI"]
+        links.append(([float(value) for value in annotation["/Rect"]], target))
+    return links
+
+
+def read_outline(filename):
+    """Returns the bookmarks of a PDF as nested (title, page number starting at 1, children) tuples"""
+    reader = PdfReader(filename)
+
+    def convert(items):
+        result = []
+        for item in items:
+            if isinstance(item, list):
+                title, page, _ = result[-1]
+                result[-1] = (title, page, convert(item))
+            else:
+                result.append((item.title, reader.get_destination_page_number(item)+1, []))
+        return result
+    return convert(reader.outline)
+
+
+def text_content(text):
+    return f"BT /F1 12 Tf 50 500 Td ({text}) Tj ET".encode()
+
+
+def write_raw_pdf(filename, pages, forms=()):
+    """Writes a PDF with pages of text, where a page can draw some forms (embedded pages) as well as its text
+
+    Args:
+        pages ([(text, (width, height), [form index])]): Pages to write
+        forms ([(text, (width, height))]): Forms drawn by the pages
+    """
+    font = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, font]
+    form_numbers = []
+    for text, (width, height) in forms:
+        content = text_content(text)
+        objects.append(b"<< /Type /XObject /Subtype /Form /BBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Length %d >>\nstream\n%s\nendstream" % (width, height, len(content), content))
+        form_numbers.append(len(objects))
+    kids = []
+    for text, (width, height), drawn in pages:
+        content = b"".join(b"q 0.5 0 0 0.5 0 0 cm /X%d Do Q " % index for index in drawn) + text_content(text)
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        xobjects = b" ".join(b"/X%d %d 0 R" % (index, form_numbers[index]) for index in drawn)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> /XObject << %s >> >> >>" % (width, height, len(objects), xobjects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+    objects.append(b"<< /Producer (Scribus) >>") # pypdf needs the document info that Scribus always writes
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f\r\n" % (len(objects)+1)
+    data += b"".join(b"%010d 00000 n\r\n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects)+1, len(objects), xref)
+    with open(filename, "wb") as pdf_file:
+        pdf_file.write(data)
+
+
+RULES_SIZE = (595, 842)
+BOOK_SIZE = (420, 595)
+
+
+def make_rules(filename, version, pages=3):
+    write_raw_pdf(filename, [(f"{version} rules page {number}", RULES_SIZE, []) for number in range(1, pages+1)])
+
+
+def make_book(filename):
+    """Writes a 5 page book showing pages 2 and 3 of the full rules on pages 3 and 4, and a full page decoration of the
+    same size as the rules on page 4"""
+    write_raw_pdf(filename, [
+        ("full version", BOOK_SIZE, []),
+        ("background", BOOK_SIZE, []),
+        ("rules header 1", BOOK_SIZE, [0]),
+        ("rules header 2", BOOK_SIZE, [2, 1]),
+        ("epilogue", BOOK_SIZE, []),
+    ], [("full rules page 2", RULES_SIZE), ("full rules page 3", RULES_SIZE), ("decoration", RULES_SIZE)])
+
+
+def page_texts(filename):
+    return [page.extract_text() for page in PdfReader(filename).pages]
+
+
+def outline_count(filename):
+    return int(PdfReader(filename).trailer["/Root"]["/Outlines"]["/Count"])
+
+
+def image_sizes(filename):
+    """Returns the (width, height) of every image XObject in a PDF"""
+    sizes = []
+    for page in PdfReader(filename).pages:
+        xobjects = page["/Resources"].get("/XObject", {})
+        for reference in xobjects.values():
+            image = reference.get_object()
+            if image["/Subtype"] == "/Image":
+                sizes.append((int(image["/Width"]), int(image["/Height"])))
+    return sizes
+
+
+def test_incremental_bookmarks(tmp_path):
+    pdf = tmp_path / "book.pdf"
+    make_pdf(pdf, 4)
+    original = pdf.read_bytes()
+
+    add_bookmarks_to_pdf(pdf, [Header(0, "Background", 1), Header(1, "History", 2), Header(0, "Rules", 3)], incremental=True)
+
+    assert pdf.read_bytes().startswith(original) # appended, not rewritten
+    assert read_outline(pdf) == [("Background", 1, [("History", 2, [])]), ("Rules", 3, [])]
+    assert outline_count(pdf) == 3
+    assert PdfReader(pdf).trailer["/Root"]["/PageMode"] == "/UseOutlines"
+
+
+def test_second_incremental_append(tmp_path):
+    pdf = tmp_path / "book.pdf"
+    make_pdf(pdf, 4)
+    add_bookmarks_to_pdf(pdf, [Header(0, "Background", 1), Header(1, "History", 2)], incremental=True)
+    first_update = pdf.read_bytes()
+
+    add_bookmarks_to_pdf(pdf, [Header(0, "Epilogue", 4)], incremental=True)
+
+    assert pdf.read_bytes().startswith(first_update)
+    assert pdf.read_bytes().count(b"%%EOF") == 3
+    assert read_outline(pdf) == [("Background", 1, [("History", 2, [])]), ("Epilogue", 4, [])]
+    assert outline_count(pdf) == 3
+
+
+def test_add_bookmarks_to_pdfs(tmp_path):
+    pdfs = [tmp_path / f"book_{number}.pdf" for number in range(3)]
+    for pdf in pdfs:
+        make_pdf(pdf, 4)
+    (tmp_path / "broken.pdf").write_bytes(b"not a PDF")
+
+    results = add_bookmarks_to_pdfs(pdfs + [tmp_path / "broken.pdf"], [Header(0, "Background", 1), Header(1, "History", 2)],
+                                    incremental=True)
+
+    assert [result.filename for result in results] == pdfs + [tmp_path / "broken.pdf"]
+    assert [result.error is None for result in results] == [True, True, True, False]
+    for pdf in pdfs:
+        assert read_outline(pdf) == [("Background", 1, [("History", 2, [])])]
+
+
+def test_remove_page_range_shifts_outline(tmp_path):
+    pdf = tmp_path / "book.pdf"
+    output = tmp_path / "norules.pdf"
+    make_pdf(pdf, 10, [("Background", 1), ("Rules", 5), ("Epilogue", 8)])
+
+    assert remove_page_range(pdf, 4, 6, output) == 7
+
+    assert len(PdfReader(output).pages) == 7
+    assert read_outline(output) == [("Background", 1, []), ("Epilogue", 5, [])]
+    assert outline_count(output) == 2
+
+
+def test_remove_page_range_patch_links(tmp_path):
+    pdf = tmp_path / "book.pdf"
+    patch = tmp_path / "patch.pdf"
+    output = tmp_path / "norules.pdf"
+    writer = PdfWriter()
+    for _ in range(10):
+        writer.add_blank_page(595, 842)
+    add_link(writer, 2, (10, 10, 100, 20), 5) # contents entries for the rules and the epilogue
+    add_link(writer, 2, (10, 30, 100, 40), 8)
+    add_link(writer, 3, (10, 10, 100, 20), 8)
+    with open(pdf, "wb") as pdf_file:
+        writer.write(pdf_file)
+    # the contents page and epilogue after removing pages 4-6, where the epilogue's entry has moved up
+    writer = PdfWriter()
+    for _ in range(2):
+        writer.add_blank_page(595, 842)
+    add_link(writer, 1, (10, 10, 100, 20), 2)
+    add_link(writer, 1, (10, 50, 100, 60), "https://www.the-ninth-age.com")
+    add_link(writer, 1, (10, 70, 100, 80), "missing")
+    with open(patch, "wb") as pdf_file:
+        writer.write(pdf_file)
+
+    remove_page_range(pdf, 4, 6, output, patch, [2, 5])
+
+    assert read_links(output, 2) == [([10, 10, 100, 20], 5), ([10, 50, 100, 60], "https://www.the-ninth-age.com")]
+    assert read_links(output, 3) == [([10, 10, 100, 20], 5)] # not patched, so its link is kept
+    assert read_links(output, 5) == []
+    page = PdfReader(output).pages[1]
+    assert page["/Annots"][0].get_object().raw_get("/P").idnum == page.indirect_reference.idnum
+
+
+def test_remove_page_range_named_destinations(tmp_path):
+    pdf = tmp_path / "book.pdf"
+    output = tmp_path / "norules.pdf"
+    writer = PdfWriter()
+    for _ in range(10):
+        writer.add_blank_page(595, 842)
+    writer.add_named_destination("rules", 4)
+    writer.add_named_destination("epilogue", 7)
+    writer._root_object[NameObject("/Dests")] = DictionaryObject({
+        NameObject("/magic"): ArrayObject([writer.pages[5].indirect_reference, NameObject("/Fit")])})
+    add_link(writer, 2, (10, 10, 100, 20), "rules")
+    add_link(writer, 2, (10, 30, 100, 40), "epilogue")
+    add_link(writer, 2, (10, 50, 100, 60), "/magic")
+    for title, name in [("Rules", "rules"), ("Epilogue", "epilogue")]:
+        item = writer.add_outline_item(title, 0).get_object()
+        item.pop(NameObject("/A"), None)
+        item[NameObject("/Dest")] = TextStringObject(name)
+    with open(pdf, "wb") as pdf_file:
+        writer.write(pdf_file)
+
+    remove_page_range(pdf, 4, 6, output)
+
+    reader = PdfReader(output)
+    catalog = reader.trailer["/Root"]
+    assert catalog["/Names"]["/Dests"]["/Names"][::2] == ["epilogue"]
+    assert dict(catalog["/Dests"]) == {}
+    assert read_links(output, 2) == [([10, 30, 100, 40], "epilogue")]
+    assert [item.title for item in reader.outline] == ["Epilogue"]
+    assert len(re.findall(rb"/Type\s*/Page\b", output.read_bytes())) == 7 # the removed pages aren't written
+
+
+def test_downsample_pdf(tmp_path):
+    pdf = tmp_path / "high.pdf"
+    output = tmp_path / "low.pdf"
+    # two pages of 4x3 inch images at 300 dpi, one JPEG (colour) and one greyscale
+    colour = Image.linear_gradient("L").resize((1200, 900)).convert("RGB")
+    grey = Image.linear_gradient("L").resize((1200, 900))
+    colour.save(pdf, save_all=True, append_images=[grey], resolution=300)
+
+    assert downsample_pdf(pdf, output, 100) == 2
+
+    assert image_sizes(pdf) == [(1200, 900), (1200, 900)]
+    assert image_sizes(output) == [(400, 300), (400, 300)]
+    assert output.stat().st_size < pdf.stat().st_size
+    assert len(PdfReader(output).pages) == 2
+
+
+def test_replace_embedded_pages(tmp_path):
+    book = tmp_path / "book.pdf"
+    output = tmp_path / "nopoints.pdf"
+    patch = tmp_path / "patch.pdf"
+    make_book(book)
+    original = page_texts(book)
+    make_rules(tmp_path / "rules.pdf", "full")
+    make_rules(tmp_path / "rules_nopoints.pdf", "nopoints")
+    write_raw_pdf(patch, [("nopoints version", BOOK_SIZE, [])])
+
+    replaced = replace_embedded_pages(book, tmp_path / "rules_nopoints.pdf", [(3, 2), (4, 3)], output,
+                                      tmp_path / "rules.pdf", patch, [1])
+
+    assert replaced == 2
+    texts = page_texts(output)
+    assert "nopoints version" in texts[0] and "full version" not in texts[0]
+    assert "nopoints rules page 2" in texts[2] and "rules header 1" in texts[2]
+    assert "nopoints rules page 3" in texts[3] and "decoration" in texts[3]
+    assert not any("full rules" in text for text in texts)
+    assert page_texts(book) == original
+
+
+def test_replace_embedded_pages_unmatched(tmp_path):
+    book = tmp_path / "book.pdf"
+    make_book(book)
+    make_rules(tmp_path / "rules.pdf", "full")
+    make_rules(tmp_path / "rules_nopoints.pdf", "nopoints")
+
+    with pytest.raises(ValueError, match="page 2"): # no rules on page 2
+        replace_embedded_pages(book, tmp_path / "rules_nopoints.pdf", [(2, 1)], tmp_path / "out.pdf", tmp_path / "rules.pdf")
+    with pytest.raises(ValueError, match="found 2"): # can't tell the rules from the decoration without the original rules
+        replace_embedded_pages(book, tmp_path / "rules_nopoints.pdf", [(4, 3)], tmp_path / "out.pdf")
+    with pytest.raises(ValueError, match="found 0"): # the original rules show page 3 there, not page 1
+        replace_embedded_pages(book, tmp_path / "rules_nopoints.pdf", [(4, 1)], tmp_path / "out.pdf", tmp_path / "rules.pdf")
+    assert not (tmp_path / "out.pdf").exists()
+
+
+def test_titles_from_thread(tmp_path):
+    # the pipeline and the LAB Manager parse titles from threads, which the process pools mustn't deadlock on
+    pdfs = [tmp_path / f"rules_{number}.pdf" for number in range(3)]
+    for pdf in pdfs:
+        make_pdf(pdf, 2)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        titles = pool.submit(asyncio.run, get_titles_async(pdfs))
+        matched = pool.submit(match_titles, pdfs[0], pdfs[1])
+        assert titles.result(timeout=120) == [[], [], []]
+        assert matched.result(timeout=120)
+
+
+def test_unsupported_pypdf(tmp_path, monkeypatch):
+    pdf = tmp_path / "book.pdf"
+    make_pdf(pdf, 2)
+    monkeypatch.setattr(t9a.pdf, "PYPDF_VERSION", "6.1.0")
+    with pytest.raises(UnsupportedPypdfError):
+        remove_page_range(pdf, 1, 1, tmp_path / "out.pdf")
@@ -0,0 +1,99 @@
+"""Tests for the cached queries of t9a.sla.SLAFile. Run with python -m pytest tests"""
+import pytest
+
+from t9a.sla import CACHED_SECTIONS, METADATA_SECTIONS, SLAFile
+from utility.fix_style_names import fix_styles
+
+
+def text_frame(name, text, page=0):
+    return (f'<PAGEOBJECT PTYPE="4" ANNAME="{name}" OwnPage="{page}" YPOS="100" LAYER="0">'
+            f'<StoryText><ITEXT CH="{text}"/></StoryText></PAGEOBJECT>')
+
+
+def write_sla(filename, rules_pfile="images/rules.pdf", version="Beta 1", style="HEADER Level 1"):
+    """Writes a small document with a few text frames, a rules frame on the Rules layer and a master page image"""
+    rules = f'PFILE="{rules_pfile}"' if rules_pfile else ""
+    filename.write_text(f"""<?xml version="1.0" encoding="UTF-8"?>
+<SCRIBUSUTF8NEW Version="1.5.8">
+<DOCUMENT>
+<LAYERS NAME="Background" NUMMER="0"/>
+<LAYERS NAME="Rules" NUMMER="3"/>
+<STYLE NAME="{style}"/>
+<Marks><Mark label="army" type="3" str="Vermin"/></Marks>
+<MASTEROBJECT PTYPE="2" OwnPage="0" PFILE="images/border.png"/>
+{text_frame("version_number", version)}
+{text_frame("rules_start", "10")}
+{text_frame("notes", "not in the cache", 1)}
+<PAGEOBJECT PTYPE="2" ANNAME="r1" OwnPage="9" LAYER="3" {rules}/>
+</DOCUMENT>
+</SCRIBUSUTF8NEW>
+""")
+    return filename
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    """Counts the times documents are streamed"""
+    count = [0]
+    stream_sections = SLAFile.stream_sections
+
+    def counting(self, *args):
+        count[0] += 1
+        return stream_sections(self, *args)
+    monkeypatch.setattr(SLAFile, "stream_sections", counting)
+    return count
+
+
+def queries(lab):
+    return (lab.test_frames(), lab.test_styles(), lab.get_text("version_number"), lab.get_text("rules_start"),
+            lab.get_layer_number("Rules"), lab.get_embedded_rules(), lab.get_rules_page_map(), lab.get_linked_files())
+
+
+def test_cold_cache_parses_once(tmp_path, parses):
+    sla = write_sla(tmp_path / "book.sla")
+    expected = queries(SLAFile(sla))
+
+    lab = SLAFile(sla, sections=METADATA_SECTIONS, keep_text=["version_number"], cache=True)
+    assert queries(lab) == expected
+    assert parses[0] == 1
+    assert "root" not in lab.__dict__ # the parse with all the text isn't kept
+
+    assert queries(SLAFile(sla, sections=METADATA_SECTIONS, cache=True)) == expected
+    assert parses[0] == 1 # everything came from the cache
+
+
+def test_cached_none(tmp_path, parses):
+    sla = write_sla(tmp_path / "book.sla", rules_pfile=None)
+    assert SLAFile(sla, sections=CACHED_SECTIONS, cache=True).get_embedded_rules() is None
+    assert SLAFile(sla, sections=CACHED_SECTIONS, cache=True).get_embedded_rules() is None
+    assert parses[0] == 1
+
+
+def test_unsaved_edits_not_cached(tmp_path):
+    sla = write_sla(tmp_path / "book.sla")
+    lab = SLAFile(sla, cache=True)
+    assert lab.get_text("version_number") == "Beta 1"
+
+    lab.set_attribute(lab.frames["version_number"].find("StoryText/ITEXT"), "CH", "Beta 2")
+    lab.set_attribute(lab.frames["notes"].find("StoryText/ITEXT"), "CH", "edited")
+    assert lab.get_text("version_number") == "Beta 2"
+    assert lab.get_text("notes") == "edited"
+    # the cache is still for the file on disk
+    on_disk = SLAFile(sla, sections=METADATA_SECTIONS, cache=True)
+    assert (on_disk.get_text("version_number"), on_disk.get_text("notes")) == ("Beta 1", "not in the cache")
+
+    lab.save()
+    assert SLAFile(sla, sections=METADATA_SECTIONS, cache=True).get_text("version_number") == "Beta 2"
+
+
+def test_renamed_styles(tmp_path):
+    sla = write_sla(tmp_path / "book.sla", style="Heading 1")
+    lab = SLAFile(sla, cache=True)
+    assert "HEADER Level 1" in lab.test_styles()
+
+    with lab.edit():
+        fix_styles(lab)
+        assert "HEADER Level 1" not in lab.test_styles()
+        assert "Heading 1" not in lab.styles
+    assert "HEADER Level 1" not in lab.test_styles()
+    assert "HEADER Level 1" not in SLAFile(sla, sections=METADATA_SECTIONS, cache=True).test_styles()
@@ -0,0 +1,74 @@
+"""Tests for the client side of the Scribus export worker in t9a.worker. Run with python -m pytest tests"""
+import sys
+import threading
+import time
+from multiprocessing.connection import Listener
+
+import pytest
+
+from t9a import worker
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="Unix sockets and permissions")
+
+
+def test_worker_dir_in_runtime_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    assert worker.worker_dir() == tmp_path / "t9a-export"
+    assert (tmp_path / "t9a-export").stat().st_mode & 0o777 == 0o700
+    assert worker.worker_key_file(1) == tmp_path / "t9a-export" / "export-1.key"
+
+
+def test_worker_dir_symlink(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    (tmp_path / "elsewhere").mkdir(mode=0o700)
+    (tmp_path / "t9a-export").symlink_to(tmp_path / "elsewhere")
+    with pytest.raises(PermissionError):
+        worker.worker_dir()
+
+
+def test_worker_dir_shared(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    (tmp_path / "t9a-export").mkdir()
+    (tmp_path / "t9a-export").chmod(0o777)
+    with pytest.raises(PermissionError):
+        worker.worker_dir()
+
+
+@pytest.fixture
+def listener(tmp_path, monkeypatch):
+    """A worker's socket and key, which only answer pings while serving"""
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    key = worker.create_worker_authkey()
+    with Listener(worker.worker_address(), authkey=key) as listener:
+        yield listener
+
+
+def serve_pings(listener):
+    def serve():
+        with listener.accept() as conn:
+            worker.receive_message(conn)
+            worker.send_message(conn, {"event": "pong"})
+    threading.Thread(target=serve, daemon=True).start()
+
+
+def test_ping(tmp_path, monkeypatch, listener):
+    serve_pings(listener)
+    assert worker.ping()
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "elsewhere"))
+    (tmp_path / "elsewhere").mkdir()
+    assert not worker.ping() # not started
+
+
+def test_ping_busy(listener):
+    # the worker isn't accepting connections, as it's exporting
+    start = time.monotonic()
+    assert worker.ping(timeout=0.5)
+    assert time.monotonic() - start < 5
+
+
+def test_start_worker_keeps_key(listener, monkeypatch):
+    key = worker.worker_authkey()
+    monkeypatch.setattr(worker.subprocess, "Popen", lambda *args, **kwargs: pytest.fail("started a second worker"))
+    serve_pings(listener)
+    assert worker.start_worker() is None
+    assert worker.worker_authkey() == key
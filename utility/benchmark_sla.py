@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1])) # needed to run from subdirectory
+
+BACKENDS = ["stdlib", "lxml"]
+
+
+def time_queries(filename):
+    """Times the SLAFile operations used by the LAB tools with whichever XML backend is active"""
+    import t9a
+    from t9a import etree
+    from t9a.sla import SLAFile, METADATA_SECTIONS, HEADER_SECTIONS
+
+    timings = {"backend": etree.BACKEND}
+
+    start = time.perf_counter()
+    lab = SLAFile(filename)
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lab.test_frames()
+    lab.test_styles()
+    lab.get_embedded_rules()
+    timings["metadata queries"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lab.parse_header_groups(t9a.HEADER_GROUPS)
+    timings["headers"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    SLAFile(filename, sections=METADATA_SECTIONS, keep_text=t9a.EXPECTED_FRAMES).get_embedded_rules()
+    timings["streamed metadata load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    SLAFile(filename, sections=HEADER_SECTIONS).parse_header_groups(t9a.HEADER_GROUPS)
+    timings["streamed header load"] = time.perf_counter() - start
+    return timings
+
+
+def benchmark(filename):
+    results = []
+    for backend in BACKENDS:
+        env = os.environ | {"T9A_XML_BACKEND": backend}
+        output = subprocess.run([sys.executable, __file__, "--run", str(filename)], env=env, capture_output=True, text=True)
+        timings = json.loads(output.stdout)
+        if timings["backend"] != backend:
+            print(f"{backend} is not available, skipping")
+            continue
+        results.append(timings)
+
+    print(f"{Path(filename).name} ({Path(filename).stat().st_size/1024/1024:.1f} MB)")
+    print(f"{'':<25}" + "".join(f"{r['backend']:>10}" for r in results))
+    for step in [key for key in results[0] if key != "backend"]:
+        print(f"{step:<25}" + "".join(f"{r[step]:>9.3f}s" for r in results))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--run":
+        print(json.dumps(time_queries(sys.argv[2])))
+    elif len(sys.argv) > 1:
+        benchmark(sys.argv[1])
+    else:
+        print("Missing arguments: filename")
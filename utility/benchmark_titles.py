@@ -0,0 +1,40 @@
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1])) # needed to run from subdirectory
+from t9a.pdf import parse_titles, TITLE_BACKENDS
+
+
+def benchmark(filename):
+    """Times each title backend on a rules PDF and checks that they find the same titles"""
+    results = {}
+    print(f"{Path(filename).name} ({Path(filename).stat().st_size/1024/1024:.1f} MB)")
+    for backend in TITLE_BACKENDS:
+        tracemalloc.start()
+        start = time.perf_counter()
+        results[backend] = parse_titles(filename, backend)
+        duration = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{backend:<10}{duration:>9.3f}s{peak/1024/1024:>9.1f} MB{len(results[backend]):>6} titles")
+
+    reference, *others = TITLE_BACKENDS
+    for backend in others:
+        for expected, found in zip(results[reference], results[backend]):
+            if expected != found:
+                print(f"{backend} differs from {reference}: {found} instead of {expected}")
+                break
+        else:
+            if len(results[reference]) == len(results[backend]):
+                print(f"{backend} matches {reference}")
+            else:
+                print(f"{backend} found {len(results[backend])} titles instead of {len(results[reference])}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1])
+    else:
+        print("Missing arguments: filename")
@@ -1,5 +1,8 @@
-import xml.etree.ElementTree as ET
 import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1])) # needed to run from subdirectory
+from t9a.sla import SLAFile
 
 STYLE_MAP = [
     (["header level 1", "header 1", "heading level 1", "heading 1"], "HEADER Level 1"),
@@ -11,7 +14,7 @@ STYLE_MAP = [
     (["footer right", "footer - right"], "FOOTER Right"),
 ]
 
-def fix_styles(filename):
+def fix_styles(sla: SLAFile):
     
     style_dict = {}
     for entry in STYLE_MAP:
@@ -20,18 +23,17 @@ def fix_styles(filename):
 
     # print(style_dict)
 
-    tree = ET.parse(filename)
-    root = tree.getroot()
+    root = sla.root
     for element in root.findall('./DOCUMENT/STYLE'):
         old_name = element.get('NAME').lower()
         if old_name in style_dict:
             new_name = style_dict[old_name]
-            element.set('NAME', new_name)
+            sla.set_attribute(element, 'NAME', new_name)
             print(f"{element.get('NAME')} -> {new_name}")
         if element.get('PARENT'):
             p_name = element.get('PARENT').lower()
             if p_name in style_dict:
-                element.set('PARENT', style_dict[p_name])
+                sla.set_attribute(element, 'PARENT', style_dict[p_name])
                 print(f"PARENT: {p_name} -> {style_dict[p_name]}")
 
     for element in root.iter('para'):
@@ -39,20 +41,17 @@ def fix_styles(filename):
             old_name = old_name.lower()
             if old_name in style_dict:
                 new_name = style_dict[old_name]
-                element.set('PARENT', new_name)
+                sla.set_attribute(element, 'PARENT', new_name)
 
     for element in root.iter('trail'):
         if old_name := element.get('PARENT'):
             old_name = old_name.lower()
             if old_name in style_dict:
                 new_name = style_dict[old_name]
-                element.set('PARENT', new_name)
-
-
-
-    
-    tree.write(filename)
+                sla.set_attribute(element, 'PARENT', new_name)
+    sla.invalidate_styles() # the style index still has the old names
+    sla.save() # deferred if called inside sla.edit()
 
 
 if __name__ == '__main__':
-    fix_styles(sys.argv[1])
+    fix_styles(SLAFile(sys.argv[1]))
@@ -1,10 +1,12 @@
 import logging
 import sys
-import xml.etree.ElementTree as ET
 from pathlib import Path
 
 from wand.image import Image
 
+sys.path.append(str(Path(__file__).parents[1])) # needed to run from subdirectory
+from t9a.sla import SLAFile
+
 TARGET_DPI = 300
 MAX_DPI = 310
 
@@ -73,9 +75,9 @@ def compress_image(filename,method="lzw"):
             logging.error(f"Error compressing {Path(filename).name}: {err}")
 
 
-def get_images(filename):
-    tree = ET.parse(filename)
-    root = tree.getroot()
+def get_images(sla: SLAFile):
+    filename = sla.filename
+    root = sla.root
     images_used = {}
 
     image_frames = root.findall("./DOCUMENT/MASTEROBJECT[@PTYPE='2']") + root.findall("./DOCUMENT/PAGEOBJECT[@PTYPE='2']")
@@ -96,9 +98,8 @@ def get_images(filename):
     return images_used
 
 
-def update_sla(filename,image_scales):
-    tree = ET.parse(filename)
-    root = tree.getroot()
+def update_sla(sla: SLAFile,image_scales):
+    root = sla.root
     for element in root.findall("./DOCUMENT/MASTEROBJECT[@PTYPE='2']") + root.findall("./DOCUMENT/PAGEOBJECT[@PTYPE='2']"):
         if Path(element.get('PFILE')).name in image_scales:
             image = Path(element.get('PFILE')).name
@@ -112,17 +113,18 @@ def update_sla(filename,image_scales):
             new_y = old_y * image_scales[image]
             logging.info(f"Changing scale of {image} from {old_scale_x} to {new_scale_x}")
             logging.info(f"Changing X offset of {image} from {old_x} to {new_x}")
-            element.set('LOCALSCX',str(new_scale_x))
-            element.set('LOCALSCY',str(new_scale_y))
-            element.set('LOCALX',str(new_x))
-            element.set('LOCALY',str(new_y))
+            sla.set_attribute(element, 'LOCALSCX', str(new_scale_x))
+            sla.set_attribute(element, 'LOCALSCY', str(new_scale_y))
+            sla.set_attribute(element, 'LOCALX', str(new_x))
+            sla.set_attribute(element, 'LOCALY', str(new_y))
 
-    tree.write(filename)
+    sla.save() # deferred if called inside sla.edit()
 
 
 def optimise_file(filename):
     logging.info(f"\nOpening file: {filename}\n")
-    images_used = get_images(filename)
+    sla = SLAFile(filename)
+    images_used = get_images(sla)
 
     image_scales = {}
     for entry in images_used:
@@ -136,7 +138,7 @@ def optimise_file(filename):
         elif Path(entry).suffix in TYPES_TO_COMPRESS:
             compress_image(Path(filename).parent/"images"/entry)
 
-    update_sla(filename,image_scales)
+    update_sla(sla,image_scales)
 
 
 if __name__ == "__main__":